@@ -0,0 +1,199 @@
+"""Benchmark the metadata generation hot path on synthetic, locally generated granules.
+
+One granule per mission naming scheme (Landsat, Sentinel-1, Sentinel-2 and NISAR) is written with
+`tests/granules.py`, and each stage of `generate_itslive_metadata` is timed on its own:
+`open_netcdf` and the header-only `open_granule_h5` (with and without kerchunk references), `get_geom`, `create_stac_item`,
+`generate_nsidc_metadata_files` and `save_metadata`. The throughput of `generatebatched.generate_stac_metadata`
+is then measured in items/sec on a dask LocalCluster.
+
+Results are written as JSON, together with the commit and package versions, to compare between commits:
+
+    python benchmarks/bench_generate.py --size 834 --repeat 10 --output generate.json
+"""
+
+import argparse
+import itertools
+import logging
+import sys
+import tempfile
+import time
+import warnings
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+
+# The fixtures used by the tests double as benchmark inputs
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'tests'))
+
+from common import environment_info, summarize, time_call, write_report
+
+from granules import GRANULE_NAMES, write_granule
+from hyp3_itslive_metadata.cryoforge.generate import (
+    create_stac_item,
+    generate_nsidc_metadata_files,
+    get_geom,
+    open_granule_h5,
+    open_netcdf,
+    save_metadata,
+)
+
+
+# Velocity layers written to each granule, so opening it costs about what a production granule does
+VARIABLES = ('v', 'vx', 'vy', 'v_error', 'vx_error', 'vy_error', 'chip_size_height', 'chip_size_width')
+
+PACKAGES = ('xarray', 'h5netcdf', 'h5py', 'kerchunk', 'pyproj', 'pystac', 'pandas', 'numpy', 'dask', 'distributed')
+
+
+def _stage(func: Callable, repeat: int) -> dict:
+    # a stage that fails for one mission is reported instead of aborting the whole run
+    try:
+        return time_call(func, repeat=repeat)
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+
+
+def bench_stages(path: Path, outdir: Path, repeat: int) -> dict:
+    """Time each stage of `generate_itslive_metadata` on one granule."""
+    url = str(path)
+
+    def open_and_close(with_kerchunk: bool = False) -> None:
+        ds, _ = open_netcdf(url, with_kerchunk=with_kerchunk)
+        ds.close()
+
+    stages = {
+        'open_netcdf': _stage(open_and_close, repeat),
+        'open_netcdf_kerchunk': _stage(lambda: open_and_close(with_kerchunk=True), repeat),
+        'open_granule_h5': _stage(lambda: open_granule_h5(url), repeat),
+        'open_granule_h5_kerchunk': _stage(lambda: open_granule_h5(url, with_kerchunk=True), repeat),
+    }
+
+    ds, kerchunks = open_netcdf(url, with_kerchunk=True)
+    try:
+        stages['get_geom'] = _stage(lambda: get_geom(ds, 4, 4326), repeat)
+        geom = get_geom(ds, 4, 4326)
+        geom['url'] = url
+
+        stages['create_stac_item'] = _stage(lambda: create_stac_item(ds, geom, url), repeat)
+        item = create_stac_item(ds, geom, url)
+
+        version = item.properties['version']
+        stages['generate_nsidc_metadata_files'] = _stage(
+            lambda: generate_nsidc_metadata_files(ds, item.id, version), repeat
+        )
+        try:
+            nsidc_meta = generate_nsidc_metadata_files(ds, item.id, version)
+        except RuntimeError:
+            # e.g. NISAR, which has no NSIDC platform/sensor names yet
+            nsidc_meta = ''
+
+        metadata = {
+            'stac': item,
+            'kerchunk': kerchunks,
+            'nsidc_meta': nsidc_meta,
+            'nsidc_spatial': '\n'.join(f'{round(x, 2)}\t{round(y, 2)}' for x, y in geom['corners']) + '\n',
+        }
+        stages['save_metadata'] = _stage(lambda: save_metadata(metadata, str(outdir)), repeat)
+    finally:
+        ds.close()
+
+    return stages
+
+
+def bench_batched(paths: list, items: int, workers: int) -> dict:
+    """Items/sec of `generatebatched.generate_stac_metadata` on a LocalCluster reading local granules."""
+    from dask.distributed import Client, LocalCluster, as_completed
+
+    from hyp3_itslive_metadata.cryoforge.generatebatched import FSReadWorkerPlugin, generate_stac_metadata
+
+    uris = [str(path) for path in itertools.islice(itertools.cycle(paths), items)]
+
+    start = time.perf_counter()
+    with (
+        LocalCluster(n_workers=workers, processes=True, threads_per_worker=1, dashboard_address=None) as cluster,
+        Client(cluster) as client,
+    ):
+        client.register_plugin(FSReadWorkerPlugin(fs_type='local'), name='fs_read_plugin')
+        startup = time.perf_counter() - start
+
+        # import the generation stack on every worker before timing
+        client.gather(client.map(generate_stac_metadata, uris[:workers], pure=False))
+
+        start = time.perf_counter()
+        futures = client.map(generate_stac_metadata, uris, pure=False)
+        task_timings = []
+        errors = 0
+        for future in as_completed(futures):
+            result = future.result()
+            errors += result['error'] is not None
+            task_timings.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'workers': workers,
+        'items': items,
+        'errors': errors,
+        'cluster_startup_s': startup,
+        'elapsed_s': elapsed,
+        'items_per_s': items / elapsed,
+        'completion_s': summarize(task_timings),
+    }
+
+
+def main() -> None:
+    """Generate the granules, run the per-stage and batched benchmarks and report the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=834, help='Width and height of the generated granules in pixels')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each stage')
+    parser.add_argument('--missions', default=','.join(GRANULE_NAMES), help='Comma separated missions to generate')
+    parser.add_argument('--batched-items', type=int, default=200, help='Items processed in the batched benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='LocalCluster workers for the batched benchmark')
+    parser.add_argument('--skip-batched', action='store_true', help='Only run the per-stage benchmarks')
+    parser.add_argument('--output', help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore')
+
+    report: dict[str, Any] = {
+        'benchmark': 'generate',
+        'environment': environment_info(PACKAGES),
+        'granule': {'size': args.size, 'variables': list(VARIABLES)},
+        'stages': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        paths = {}
+        for mission in args.missions.split(','):
+            granule_dir = tmp / 'granules' / mission
+            granule_dir.mkdir(parents=True)
+            paths[mission] = write_granule(granule_dir, mission=mission, size=args.size, variables=VARIABLES)
+
+            outdir = tmp / 'metadata' / mission
+            outdir.mkdir(parents=True)
+            report['stages'][mission] = bench_stages(paths[mission], outdir, args.repeat)
+
+        for mission, stages in report['stages'].items():
+            for stage, result in stages.items():
+                timing = f'{result["median_s"] * 1000:9.2f} ms' if 'median_s' in result else result['error'][:80]
+                print(f'{mission:>10} {stage:<30} {timing}')
+
+        if not args.skip_batched:
+            # granules that fail (e.g. without NSIDC names) would only measure the error path
+            supported = [
+                path
+                for mission, path in paths.items()
+                if 'error' not in report['stages'][mission]['generate_nsidc_metadata_files']
+            ]
+            report['batched'] = bench_batched(supported, args.batched_items, args.workers)
+            print(
+                f'generatebatched: {report["batched"]["items_per_s"]:.1f} items/s '
+                f'with {args.workers} workers ({report["batched"]["errors"]} errors)'
+            )
+
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
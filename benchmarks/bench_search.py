@@ -0,0 +1,95 @@
+"""Benchmark the duckdb and rustac serverless search engines on a fixed local geoparquet catalog.
+
+The catalog is generated with a fixed seed (see `tests/catalogs.py`), so results are comparable between runs
+and machines. For every engine the first (cold) search, which opens the database and loads its extensions,
+is reported separately from the median of the following (warm) searches.
+
+    python benchmarks/bench_search.py --items-per-partition 5000 --repeat 10 --output search.json
+"""
+
+import argparse
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+# The fixtures used by the tests double as benchmark inputs
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'tests'))
+
+from common import environment_info, write_report
+
+from catalogs import write_latlon_catalog
+from hyp3_itslive_metadata.cryoforge.tooling import serverless_search
+
+
+SEARCH_KWARGS = {
+    'intersects': {'type': 'Polygon', 'coordinates': [[[-48, 56], [-36, 56], [-36, 72], [-48, 72], [-48, 56]]]},
+    'datetime': '2019-01-01T00:00:00Z/2021-12-31T23:59:59Z',
+    'filter': [{'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, 50]}],
+}
+
+
+def time_engine(catalog: str, engine: str, repeat: int) -> dict:
+    """Time one cold and `repeat` warm searches of `catalog` with `engine`."""
+    timings = []
+    hrefs = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        hrefs = serverless_search(
+            base_catalog_href=catalog,
+            search_kwargs=dict(SEARCH_KWARGS),
+            engine=engine,
+            cache=False,
+            partition_type='latlon',
+        )
+        timings.append(time.perf_counter() - start)
+    return {
+        'engine': engine,
+        'matches': len(hrefs),
+        'cold_s': timings[0],
+        'warm_median_s': statistics.median(timings[1:]),
+        'warm_min_s': min(timings[1:]),
+        'warm_s': timings[1:],
+    }
+
+
+def main() -> None:
+    """Generate the catalog, benchmark each engine and report the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', help='Existing latlon catalog to search instead of generating one')
+    parser.add_argument('--items-per-partition', type=int, default=2000, help='Items per mission and grid cell')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of warm searches per engine')
+    parser.add_argument('--engines', default='duckdb,rustac', help='Comma separated engines to benchmark')
+    parser.add_argument('--output', help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    # tooling configures INFO logging, and the rust libraries log every write and query at that level
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog = args.catalog or str(write_latlon_catalog(Path(tmp), items_per_partition=args.items_per_partition))
+        results = [time_engine(catalog, engine, args.repeat) for engine in args.engines.split(',')]
+
+    if len({result['matches'] for result in results}) > 1:
+        print('Warning: engines returned a different number of matches', file=sys.stderr)
+
+    report = {
+        'benchmark': 'serverless_search',
+        'environment': environment_info(('duckdb', 'rustac', 'pyarrow')),
+        'items_per_partition': None if args.catalog else args.items_per_partition,
+        'search': SEARCH_KWARGS,
+        'results': results,
+    }
+    for result in results:
+        print(
+            f'{result["engine"]:>8}: {result["matches"]} matches, cold {result["cold_s"]:.3f}s, '
+            f'warm median {result["warm_median_s"]:.4f}s'
+        )
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
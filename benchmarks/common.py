@@ -0,0 +1,70 @@
+"""Helpers shared by the benchmark scripts: timing, environment description and JSON reports."""
+
+import importlib.metadata
+import json
+import platform
+import statistics
+import subprocess
+import time
+from collections.abc import Callable
+from datetime import UTC, datetime
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def time_call(func: Callable, repeat: int = 5, warmup: int = 1) -> dict:
+    """Call `func` `warmup` times untimed, then `repeat` times, and summarize the wall-clock timings."""
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def summarize(timings: list) -> dict:
+    """Median, min, mean and all timings (in seconds) of a list of measurements."""
+    return {
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'mean_s': statistics.fmean(timings),
+        'runs': len(timings),
+        'timings_s': timings,
+    }
+
+
+def git_commit() -> str | None:
+    """Commit of the checkout being benchmarked, or None outside of a git checkout."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def environment_info(packages: tuple = ()) -> dict:
+    """Where the numbers come from: commit, interpreter, machine and the versions of `packages`."""
+    versions: dict[str, str | None] = {}
+    for package in packages:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        'commit': git_commit(),
+        'date': datetime.now(UTC).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'packages': versions,
+    }
+
+
+def write_report(report: dict, output: str | None) -> None:
+    """Write `report` as JSON to `output`, if given."""
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2, default=str))
@@ -16,6 +16,7 @@ from requests import HTTPError
 from tqdm.auto import tqdm
 
 from hyp3_itslive_metadata.aws import determine_granule_uri_from_bucket, upload_file_to_s3_with_publish_access_keys
+from hyp3_itslive_metadata.cryoforge.timing import StageTimer, write_timings
 from hyp3_itslive_metadata.process import process_itslive_metadata
 from hyp3_itslive_metadata.stac import add_stac_item_to_catalog, update_stac_item_in_catalog
 
@@ -167,11 +168,14 @@ def hyp3_bulk_meta() -> None:
     df = pd.read_parquet(args.granules_parquet, engine='pyarrow')
 
     stac_ndjson = Path.cwd() / f'{Path(args.granules_parquet).stem}_{args.start_idx}-{args.stop_idx}.ndjson'
+    timings = []
     with stac_ndjson.open('w') as ndjson_file:
         for granule_bucket, granule_key in tqdm(
             df.loc[args.start_idx : args.stop_idx, ['bucket', 'key']].itertuples(index=False), initial=args.start_idx
         ):
-            metadata_files = process_itslive_metadata(f's3://{granule_bucket}/{granule_key}')
+            timer = StageTimer(f's3://{granule_bucket}/{granule_key}')
+            metadata_files = process_itslive_metadata(timer.url, timer=timer)
+            timings.append(timer.record())
 
             stac_line = json.dumps(json.loads(metadata_files[0].read_text()))
             ndjson_file.write(stac_line + '\n')
@@ -184,7 +188,8 @@ def hyp3_bulk_meta() -> None:
                 for metadata_file in metadata_files:
                     metadata_file.unlink()
 
-    _hyp3_upload_and_publish([stac_ndjson], bucket=args.bucket, bucket_prefix=args.bucket_prefix)
+    timings_json = write_timings(timings, stac_ndjson.with_suffix('.timings.json'))
+    _hyp3_upload_and_publish([stac_ndjson, timings_json], bucket=args.bucket, bucket_prefix=args.bucket_prefix)
 
 
 def main() -> None:
@@ -0,0 +1,326 @@
+"""
+Dead letters: structured records of the granules whose metadata could not be generated.
+
+Transient errors (throttling, timeouts, dropped connections, 5xx responses, see `fetch.is_transient`) are retried
+in the run by `generate_with_retries`. A granule that still fails becomes a dead letter (`dead_letter`) with its
+URL, the exception class and message, the stage that failed (one of `timing.STAGES`, `task` when its dask task
+was lost or `write`), the attempts made, the seconds spent and when it failed. Dead letters are appended to an
+NDJSON file by `DeadLetterWriter`, or written as parquet by `write_dead_letters`.
+
+The `dead-letters` entry point summarizes dead letter files (`status`) and reprocesses only their granules
+(`retry`), so recovering from partial failures doesn't need a full rerun. Retries are tiered: a letter of tier
+`n` is retried once `RETRY_TIERS[n]` seconds passed since it failed, and one that fails again is written back
+with tier `n + 1`, until the tiers are exhausted:
+
+    dead-letters retry output/row_group_3/dead_letters.jsonl -o output/row_group_3 -d dead_letters.retry.jsonl
+
+Recovered items are appended to the `<prefix>/<year>.ndjson` files of the output directory, the layout
+`generatebatched.BatchWriter` writes, or to a single file when the output ends with `.ndjson`.
+"""
+
+import argparse
+import collections
+import datetime
+import logging
+import posixpath
+import random
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlparse
+
+import fsspec
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .fetch import is_transient
+from .generate import generate_itslive_metadata, stac_item_json
+from .timing import StageTimer
+
+
+logger = logging.getLogger(__name__)
+
+# Dead letters of a row group or region, next to its items; not .ndjson, so they are never taken for items
+DEAD_LETTERS_FILENAME = 'dead_letters.jsonl'
+
+# Retries of a transient error within a run, and the seconds before the first one (doubled at every retry)
+RETRIES = 2
+BACKOFF = 1.0
+
+# Seconds after its failure before a dead letter of each tier is retried; letters past the last tier are kept
+RETRY_TIERS = (60, 15 * 60, 60 * 60, 6 * 60 * 60)
+
+
+def dead_letter(
+    url: str,
+    error: BaseException | str,
+    stage: str | None = None,
+    attempts: int = 1,
+    seconds: float | None = None,
+    tier: int = 0,
+) -> dict:
+    """
+    The dead letter of granule `url`, which failed with `error` in `stage` after `attempts` attempts.
+
+    `error` may be only the message of an exception raised elsewhere, in which case its class is unknown.
+    """
+    return {
+        'url': url,
+        'error_class': type(error).__name__ if isinstance(error, BaseException) else None,
+        'error': str(error),
+        'stage': stage or 'generate',
+        'attempts': attempts,
+        'transient': is_transient(error) if isinstance(error, BaseException) else False,
+        'seconds': seconds,
+        'tier': tier,
+        'failed_at': datetime.datetime.now(datetime.UTC).isoformat(),
+    }
+
+
+def _backoff_seconds(attempt: int, backoff: float) -> float:
+    return backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def generate_with_retries(
+    url: str,
+    generate: Callable[[StageTimer], Any],
+    retries: int = RETRIES,
+    backoff: float = BACKOFF,
+    tier: int = 0,
+) -> tuple[Any, StageTimer, dict | None]:
+    """
+    Run `generate(timer)` for granule `url`, retrying it up to `retries` times while it fails with transient errors.
+
+    Every attempt gets its own `StageTimer`. Returns the result of `generate` (None if it failed), the timer of
+    the last attempt and, if it failed, the dead letter of the granule with the given `tier`.
+    """
+    start = time.monotonic()
+    for attempt in range(1, retries + 2):
+        timer = StageTimer(url)
+        try:
+            return generate(timer), timer, None
+        except Exception as e:
+            if attempt > retries or not is_transient(e):
+                seconds = time.monotonic() - start
+                return (
+                    None,
+                    timer,
+                    dead_letter(url, e, timer.failed_stage, attempts=attempt, seconds=seconds, tier=tier),
+                )
+            logger.warning(f'Attempt {attempt} of {url} failed, retrying: {e}')
+        time.sleep(_backoff_seconds(attempt, backoff))
+
+
+class DeadLetterWriter:
+    """
+    Appends dead letters as NDJSON lines to a local file, copied to `remote` by `sync`.
+
+    With `mode='a'` the letters of earlier runs are kept: the remote file is downloaded first when there is no
+    local one. With `mode='w'` the file starts empty, e.g. when every granule not written yet is retried anyway.
+    """
+
+    def __init__(self, path, mode: str = 'a', remote: str | None = None, fs=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.remote = remote
+        self.fs = fs if fs is not None or remote is None else fsspec.core.url_to_fs(remote)[0]
+        if mode == 'a' and remote and not self.path.exists() and self.fs.exists(remote):
+            self.fs.get(remote, str(self.path))
+        # kept open for the life of the writer, which closes it in close()/__exit__
+        self._file = open(self.path, f'{mode}b')
+        self.count = 0
+
+    def write(self, letter: dict):
+        self._file.write(orjson.dumps(letter) + b'\n')
+        self._file.flush()
+        self.count += 1
+
+    def sync(self):
+        """Copy the file to `remote`, if there is one."""
+        if self.remote:
+            self._file.flush()
+            self.fs.put(str(self.path), self.remote)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_dead_letters(path: str, storage_options: dict | None = None) -> list[dict]:
+    """Read the dead letters of an NDJSON or (`.parquet`) parquet file, local or remote."""
+    with fsspec.open(path, 'rb', **(storage_options or {})) as f:
+        if path.endswith('.parquet'):
+            return pq.read_table(f).to_pylist()
+        return [orjson.loads(line) for line in f if line.strip()]
+
+
+def write_dead_letters(letters: Iterable[dict], path: str, storage_options: dict | None = None) -> str:
+    """Write dead letters as parquet when `path` ends with `.parquet`, and as NDJSON otherwise."""
+    letters = list(letters)
+    with fsspec.open(path, 'wb', **(storage_options or {})) as f:
+        if path.endswith('.parquet'):
+            pq.write_table(pa.Table.from_pylist(letters), f)
+        else:
+            f.write(b''.join(orjson.dumps(letter) + b'\n' for letter in letters))
+    return path
+
+
+def _generate_item(url: str, timer: StageTimer) -> bytes:
+    metadata = generate_itslive_metadata(url, timer=timer, reader='h5py', item_format='dict', keep_dataset=False)
+    return stac_item_json(metadata['stac'])
+
+
+def is_due(letter: dict, now: datetime.datetime | None = None) -> bool:
+    """Whether the backoff of the tier of `letter` has passed; never for letters past the last tier."""
+    tier = letter.get('tier') or 0
+    if tier >= len(RETRY_TIERS):
+        return False
+    now = now or datetime.datetime.now(datetime.UTC)
+    failed_at = datetime.datetime.fromisoformat(letter['failed_at'])
+    return now >= failed_at + datetime.timedelta(seconds=RETRY_TIERS[tier])
+
+
+def item_file_key(url: str, item: bytes) -> str:
+    """The `<prefix>/<year>` of the serialized STAC `item` of granule `url`, as grouped by `BatchWriter`."""
+    prefix = posixpath.dirname(urlparse(url).path).strip('/')
+    year = orjson.loads(item)['properties']['mid_datetime'][:4]
+    return posixpath.join(prefix, year)
+
+
+def retry_dead_letters(
+    letters: Iterable[dict],
+    output: str,
+    workers: int = 4,
+    retries: int = RETRIES,
+    transient_only: bool = False,
+    ignore_backoff: bool = False,
+    generate: Callable[[str, StageTimer], Any] = _generate_item,
+) -> list[dict]:
+    """
+    Generate the items of the granules of `letters` whose tier is due (see `is_due`) and append them to `output`.
+
+    `output` is a directory, local or remote, where each item is appended to the `<prefix>/<year>.ndjson` file of
+    its granule (see `item_file_key`), next to the items of its row group; or a single file ending with `.ndjson`.
+
+    Granules are generated in a pool of `workers` threads, with in-run retries of transient errors. Returns the
+    dead letters left: those not due yet, those of exhausted tiers or, with `transient_only`, of permanent errors,
+    unchanged, and those that failed again, with the next tier and their attempts added up.
+
+    Args:
+        letters (Iterable[dict]): Dead letters to retry.
+        output (str): Directory, or NDJSON file, the generated STAC items are appended to.
+        workers (int): Granules generated at once.
+        retries (int): In-run retries of a transient error.
+        transient_only (bool): Only retry letters of transient errors.
+        ignore_backoff (bool): Retry letters whose tier is not due yet too (but not those of exhausted tiers).
+        generate (Callable): Generates the serialized item of a URL, as `generate(url, timer)`.
+    """
+    due, remaining = [], []
+    for letter in letters:
+        tier = letter.get('tier') or 0
+        eligible = tier < len(RETRY_TIERS) and (ignore_backoff or is_due(letter))
+        if eligible and (letter.get('transient') or not transient_only):
+            due.append(letter)
+        else:
+            remaining.append(letter)
+    logger.info(f'Retrying {len(due)} dead letters, {len(remaining)} not due or exhausted')
+
+    def retry(letter: dict):
+        url = letter['url']
+        tier = (letter.get('tier') or 0) + 1
+        return generate_with_retries(url, lambda timer: generate(url, timer), retries=retries, tier=tier)
+
+    fs, root = fsspec.core.url_to_fs(output)
+    files = {}
+    recovered = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for letter, (item, _, failed) in zip(due, pool.map(retry, due)):
+                if failed is not None:
+                    failed['attempts'] += letter.get('attempts') or 0
+                    remaining.append(failed)
+                    continue
+                path = root if root.endswith('.ndjson') else f'{root}/{item_file_key(letter["url"], item)}.ndjson'
+                if path not in files:
+                    if path != root:
+                        fs.makedirs(posixpath.dirname(path), exist_ok=True)
+                    files[path] = fs.open(path, 'ab')
+                files[path].write(item + b'\n')
+                recovered += 1
+    finally:
+        for f in files.values():
+            f.close()
+    logger.info(f'Recovered {recovered} of {len(due)} granules into {output}')
+    return remaining
+
+
+def summarize(letters: Iterable[dict]) -> dict:
+    """Counts of dead letters by stage, error class, tier and transient or not."""
+    counts = {key: collections.Counter() for key in ('stage', 'error_class', 'tier', 'transient')}
+    total = 0
+    for letter in letters:
+        total += 1
+        for key, counter in counts.items():
+            counter[str(letter.get(key))] += 1
+    return {'dead_letters': total, **{key: dict(counter) for key, counter in counts.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and retry the dead letters of failed granules')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    status_parser = subparsers.add_parser('status', help='Count dead letters by stage, error class and tier')
+    status_parser.add_argument('paths', nargs='+', help='Dead letter files (NDJSON or .parquet)')
+
+    retry_parser = subparsers.add_parser('retry', help='Regenerate only the granules of dead letters')
+    retry_parser.add_argument('paths', nargs='+', help='Dead letter files (NDJSON or .parquet)')
+    retry_parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        help='Directory whose <prefix>/<year>.ndjson files the recovered items are appended to, or an .ndjson file',
+    )
+    retry_parser.add_argument(
+        '-d',
+        '--dead-letters',
+        default=f'{Path(DEAD_LETTERS_FILENAME).stem}.retry.jsonl',
+        help='File the dead letters left are written to (NDJSON or .parquet)',
+    )
+    retry_parser.add_argument('-w', '--workers', type=int, default=4, help='Granules generated at once')
+    retry_parser.add_argument('--retries', type=int, default=RETRIES, help='In-run retries of a transient error')
+    retry_parser.add_argument('--transient-only', action='store_true', help='Only retry transient errors')
+    retry_parser.add_argument(
+        '--ignore-backoff', action='store_true', help='Retry letters whose tier backoff has not passed yet'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p',
+        level=logging.INFO,
+    )
+    letters = [letter for path in args.paths for letter in read_dead_letters(path)]
+    if args.command == 'retry':
+        letters = retry_dead_letters(
+            letters,
+            args.output,
+            workers=args.workers,
+            retries=args.retries,
+            transient_only=args.transient_only,
+            ignore_backoff=args.ignore_backoff,
+        )
+        write_dead_letters(letters, args.dead_letters)
+        logger.info(f'Wrote {len(letters)} dead letters left to {args.dead_letters}')
+    logger.info(f'{summarize(letters)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,838 @@
+"""
+Asyncio fetch engine for granules, built on obstore's async API.
+
+`AsyncFetcher` keeps up to `max_concurrency` object requests in flight from a single event loop and hands the
+fetched granules to a CPU pool (`concurrent.futures` executor) through a bounded queue, so one worker process
+can saturate the network while the parse step runs in parallel. When the pool falls behind, the full queue
+stops new requests from starting, which bounds the number of granules held in memory.
+
+Stores are created per bucket (or host) from the granule URLs, so any bucket can be read:
+
+    fetcher = AsyncFetcher(max_concurrency=256)
+    async for result in fetcher.map(urls, parse, executor):
+        ...
+
+`AdaptiveLimiter` instead adjusts the reads in flight of a process to what S3 sustains: installed with
+`set_read_limiter`, it gates the reads of `generate.fetch_granule` (dask workers) and, given as `limiter`, those of
+`AsyncFetcher`, and retries reads throttled with 503 SlowDown after a backoff. `HedgedReader` duplicates the few
+reads that are slower than a latency percentile and takes whichever copy returns first, so stragglers don't set
+the wall time of a batch.
+"""
+
+import asyncio
+import concurrent.futures
+import errno
+import io
+import logging
+import math
+import mmap
+import os
+import posixpath
+import random
+import re
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable
+from typing import Any
+from urllib.parse import urlparse
+
+import obstore as obs
+from obstore.store import S3Store, from_url
+
+
+logger = logging.getLogger(__name__)
+
+# Objects larger than this are fetched as concurrent ranged requests of this size
+PART_SIZE = 8 * 2**20
+
+# Options of the stores created for s3:// URLs; ITS_LIVE buckets are public
+S3_OPTIONS = {'region': 'us-west-2', 'skip_signature': True}
+
+# HTTP statuses and S3/botocore error codes of throttled requests
+THROTTLE_STATUSES = frozenset({429, 503})
+THROTTLE_CODES = frozenset({'SlowDown', 'Throttling', 'ThrottlingException', 'TooManyRequests', 'RequestLimitExceeded'})
+
+# Throttling in the text of errors that carry no status, e.g. obstore's: the phrases, or a 503/429 given as a
+# status, never a bare number, which would match the dates and ids in granule names
+THROTTLE_PATTERN = re.compile(
+    r'slow ?down|reduce your request rate|too ?many ?requests'
+    r'|\b(?:status|status code|http)\W{0,3}(?:503|429)\b'
+    r'|\b(?:503|429) (?:service unavailable|slow ?down|too many requests)\b',
+    re.IGNORECASE,
+)
+
+# Lower-cased fragments of errors that are likely to pass when the request is made again
+TRANSIENT_MARKERS = (
+    'timed out',
+    'timeout',
+    'connection reset',
+    'connection aborted',
+    'connection refused',
+    'broken pipe',
+    'temporarily unavailable',
+    'internal error',
+    'service unavailable',
+    'bad gateway',
+    'incomplete read',
+    'killedworker',
+)
+
+
+def object_path(url: str, store: Any = None) -> str:
+    """
+    The path of `url` within an obstore `store`.
+
+    The bucket (or host) is dropped from the URL and, when the store has a prefix, the path is made relative
+    to it. Raises `ValueError` if `url` is in a different bucket than an `S3Store`.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'file'):
+        path = os.path.abspath(parsed.path if parsed.scheme else url)
+    else:
+        path = parsed.path
+        if isinstance(store, S3Store) and parsed.netloc != store.config.get('bucket'):
+            raise ValueError(f'{url} is not in the bucket of the store ({store.config.get("bucket")})')
+    path = path.lstrip('/')
+
+    prefix = str(getattr(store, 'prefix', None) or '').strip('/')
+    if prefix:
+        path = posixpath.relpath(path, prefix)
+    return path
+
+
+def _error_chain(error: BaseException):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def _http_status(error: BaseException) -> tuple[str | None, int | None]:
+    """The S3 error code and the HTTP status `error` carries (botocore, aiohttp, requests), if any."""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):  # botocore ClientError
+        return response.get('Error', {}).get('Code'), response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    status = getattr(error, 'status', None) or getattr(error, 'status_code', None)  # aiohttp, fsspec http
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)  # requests HTTPError
+    return None, status if isinstance(status, int) else None
+
+
+def is_throttled(error: BaseException) -> bool:
+    """
+    Whether `error`, or an error it was raised from, is a throttling response (S3 503 SlowDown, 429).
+
+    The status or error code is used when the error carries one (botocore, aiohttp, requests); s3fs raises
+    SlowDown as an `OSError` with errno `EBUSY`. Otherwise, e.g. for obstore, the message is matched against
+    `THROTTLE_PATTERN`.
+    """
+    for cause in _error_chain(error):
+        code, status = _http_status(cause)
+        if code is not None or status is not None:
+            return code in THROTTLE_CODES or status in THROTTLE_STATUSES
+        if isinstance(cause, OSError) and cause.errno == errno.EBUSY:
+            return True
+        if THROTTLE_PATTERN.search(str(cause)):
+            return True
+    return False
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether `error` is likely to pass on a retry: throttling, timeouts, dropped connections, 5xx responses or a
+    dask worker that died, as opposed to e.g. a missing or malformed granule.
+
+    Like `is_throttled`, an HTTP status carried by the error or its causes decides; the message is only matched
+    against `TRANSIENT_MARKERS` when there is none.
+    """
+    if is_throttled(error):
+        return True
+    for cause in _error_chain(error):
+        _, status = _http_status(cause)
+        if status is not None:
+            return status >= 500
+        if isinstance(cause, (ConnectionError, TimeoutError)):
+            return True
+    text = f'{type(error).__name__} {error}'.lower()
+    return any(marker in text for marker in TRANSIENT_MARKERS)
+
+
+def _nbytes(content) -> int:
+    try:
+        return memoryview(content).nbytes
+    except TypeError:
+        return 0
+
+
+class AdaptiveLimiter:
+    """
+    Additive-increase/multiplicative-decrease limit on the reads in flight in a process.
+
+    Reads take a slot (`call` from threads, `call_async` from asyncio tasks) and report their latency and size.
+    Every `window` reads the limit is adjusted: it is multiplied by `decrease` when the p99 latency of the window
+    rose above `latency_factor` times the lowest p99 seen so far, and otherwise grows by `increase` if reads
+    had to wait for a slot and the throughput (bytes/s) did not fall. A throttled read (see `is_throttled`)
+    decreases the limit at once, at most once per limit, and is retried after an exponential backoff.
+
+    Args:
+        initial (int): Starting limit.
+        minimum (int): Lowest limit.
+        maximum (int): Highest limit.
+        window (int): Reads between adjustments.
+        increase (float): Added to the limit when throughput keeps up.
+        decrease (float): Factor applied to the limit on throttling or latency spikes.
+        latency_factor (float): p99 latency, relative to the baseline, that counts as a spike.
+        max_retries (int): Retries of a throttled read before its error is raised.
+        backoff (float): Seconds before the first retry of a throttled read; doubled at every retry, with jitter.
+        clock (Callable[[], float]): Seconds since an arbitrary origin, used to time reads and windows.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 64,
+        window: int = 32,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_factor: float = 2.0,
+        max_retries: int = 5,
+        backoff: float = 0.2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._condition = threading.Condition()
+        self._async_waiters = deque()
+        self.in_flight = 0
+        self.throttled = 0
+        self.p99 = None
+        self.throughput = None
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._latencies = []
+        self._bytes = 0
+        self._waited = False
+        self._window_start = self.clock()
+
+    @property
+    def limit(self) -> int:
+        """The current limit on reads in flight."""
+        return max(self.minimum, int(self._limit))
+
+    def stats(self) -> dict:
+        """The current limit, reads in flight, reads throttled so far and the last window's p99 and bytes/s."""
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'throttled': self.throttled,
+                'p99': self.p99,
+                'throughput': self.throughput,
+            }
+
+    def _decrease(self, started: float, reason: str):
+        # reads started before the last decrease saw the old limit: they don't decrease it again
+        if started < self._last_decrease:
+            return
+        self._limit = max(self.minimum, self._limit * self.decrease)
+        self._last_decrease = self.clock()
+        logger.info(f'Read limit decreased to {self.limit}: {reason}')
+
+    def _adjust(self):
+        now = self.clock()
+        latencies = sorted(self._latencies)
+        p99 = latencies[math.ceil(0.99 * len(latencies)) - 1]
+        throughput = self._bytes / max(now - self._window_start, 1e-9)
+
+        if self._baseline is not None and p99 > self.latency_factor * self._baseline:
+            self._decrease(self._window_start, f'p99 latency {p99:.2f}s, baseline {self._baseline:.2f}s')
+        elif self._waited and (self.throughput is None or throughput >= 0.95 * self.throughput):
+            self._limit = min(self.maximum, self._limit + self.increase)
+        # the baseline drifts up slowly, so a lasting change of object sizes or network is not a spike forever
+        self._baseline = p99 if self._baseline is None else min(1.05 * self._baseline, p99)
+        self.p99, self.throughput = p99, throughput
+        self._latencies, self._bytes, self._waited, self._window_start = [], 0, False, now
+
+    def _wake(self):
+        while self._async_waiters and self.in_flight < self.limit:
+            loop, future = self._async_waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(self._grant, future)
+        self._condition.notify_all()
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self._release()
+        else:
+            future.set_result(None)
+
+    def _acquire(self) -> float:
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._waited = True
+                self._condition.wait()
+            self.in_flight += 1
+        return self.clock()
+
+    async def _acquire_async(self) -> float:
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self.in_flight < self.limit and not self._async_waiters:
+                self.in_flight += 1
+                return self.clock()
+            self._waited = True
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._condition:
+                if (loop, future) in self._async_waiters:
+                    self._async_waiters.remove((loop, future))
+                    raise
+            # the slot was granted: a cancelled future gives it back in `_grant`
+            if not future.cancelled():
+                self._release()
+            raise
+        return self.clock()
+
+    def _release(self, started: float | None = None, nbytes: int = 0, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self._decrease(started, 'throttled')
+            elif started is not None:
+                self._latencies.append(self.clock() - started)
+                self._bytes += nbytes
+                if len(self._latencies) >= self.window:
+                    self._adjust()
+            self._wake()
+
+    def _backoff_seconds(self, attempt: int) -> float:
+        return self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+
+    def call(self, read: Callable[[], Any]) -> Any:
+        """Run `read()` in a slot, retrying it when it is throttled; returns its result."""
+        for attempt in range(self.max_retries + 1):
+            started = self._acquire()
+            try:
+                content = read()
+            except Exception as e:
+                if not is_throttled(e):
+                    self._release()
+                    raise
+                self._release(started, throttled=True)
+                if attempt == self.max_retries:
+                    raise
+            except BaseException:
+                self._release()
+                raise
+            else:
+                self._release(started, nbytes=_nbytes(content))
+                return content
+            time.sleep(self._backoff_seconds(attempt))
+
+    async def call_async(self, read: Callable[[], Awaitable]) -> Any:
+        """Await `read()` in a slot, retrying it when it is throttled; returns its result."""
+        for attempt in range(self.max_retries + 1):
+            started = await self._acquire_async()
+            try:
+                content = await read()
+            except Exception as e:
+                if not is_throttled(e):
+                    self._release()
+                    raise
+                self._release(started, throttled=True)
+                if attempt == self.max_retries:
+                    raise
+            except BaseException:
+                self._release()
+                raise
+            else:
+                self._release(started, nbytes=_nbytes(content))
+                return content
+            await asyncio.sleep(self._backoff_seconds(attempt))
+
+
+_read_limiter = None
+
+
+def set_read_limiter(limiter: AdaptiveLimiter | None):
+    """Install `limiter` as the limiter of the reads of this process (see `get_read_limiter`), or remove it."""
+    global _read_limiter
+    _read_limiter = limiter
+
+
+def get_read_limiter() -> AdaptiveLimiter | None:
+    """The limiter of the reads of this process used by `generate.fetch_granule`, if one was installed."""
+    return _read_limiter
+
+
+class HedgedReader:
+    """
+    Hedged reads: a read still running after a deadline is duplicated, and whichever copy returns first wins.
+
+    The deadline is the `percentile` of the latency of the last `window` reads (at least `min_delay`), so only
+    the slowest reads are hedged. Hedges are also capped at a fraction `max_rate` of the reads: every read
+    earns `max_rate` of a hedge, and up to `burst` unused hedges are kept. Nothing is hedged before
+    `min_samples` reads completed. A read that fails before its deadline is not hedged; a copy that fails
+    while the other is still running waits for the other.
+
+    From threads (`call`), the copies run in a pool of `max_workers` threads and the losing copy runs to
+    completion in the background; from asyncio (`call_async`), the losing copy is cancelled.
+
+    Args:
+        percentile (float): Latency percentile, in [0, 100], used as the deadline.
+        max_rate (float): Largest fraction of reads hedged.
+        window (int): Latencies of the last reads the percentile is computed from.
+        min_samples (int): Reads completed before any read is hedged.
+        min_delay (float): Shortest deadline, in seconds.
+        burst (float): Unused hedges kept for bursts of slow reads.
+        max_workers (int): Threads running the reads of `call`.
+        clock (Callable[[], float]): Seconds since an arbitrary origin, used to time reads.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        max_rate: float = 0.05,
+        window: int = 256,
+        min_samples: int = 32,
+        min_delay: float = 0.05,
+        burst: float = 10.0,
+        max_workers: int = 64,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.burst = burst
+        self.max_workers = max_workers
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0.0
+        self._executor = None
+        self.reads = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def deadline(self) -> float | None:
+        """Seconds after which a read is hedged, or None before `min_samples` reads completed."""
+        with self._lock:
+            if not self._latencies or len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return max(self.min_delay, latencies[max(index, 0)])
+
+    def stats(self) -> dict:
+        """Reads so far, how many were hedged and how many of the hedges returned first, and the deadline."""
+        return {
+            'reads': self.reads,
+            'hedged': self.hedged,
+            'hedges_won': self.hedges_won,
+            'deadline': self.deadline(),
+        }
+
+    def _start(self) -> float | None:
+        deadline = self.deadline()
+        with self._lock:
+            self.reads += 1
+            self._tokens = min(self.burst, self._tokens + self.max_rate)
+        return deadline
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def _record(self, started: float, hedge_won: bool = False):
+        with self._lock:
+            self._latencies.append(self.clock() - started)
+            self.hedges_won += hedge_won
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='hedged-read'
+                )
+            return self._executor
+
+    def close(self):
+        """Stop the threads of `call` once the reads running in them finish."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def call(self, read: Callable[[], Any]) -> Any:
+        """Run `read()`, hedged with a second `read()` if it is slower than the deadline; returns its result."""
+        started = self.clock()
+        deadline = self._start()
+        primary = self.executor.submit(read)
+        if deadline is None or concurrent.futures.wait([primary], timeout=deadline).done or not self._take_hedge():
+            content = primary.result()
+            self._record(started)
+            return content
+
+        hedge = self.executor.submit(read)
+        pending = {primary, hedge}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                future = (succeeded or list(done))[0]
+                content = future.result()
+                self._record(started, hedge_won=future is hedge)
+                return content
+
+    async def call_async(self, read: Callable[[], Awaitable]) -> Any:
+        """Await `read()`, hedged with a second `read()` if it is slower than the deadline; returns its result."""
+        started = self.clock()
+        deadline = self._start()
+        primary = asyncio.ensure_future(read())
+        try:
+            done, _ = await asyncio.wait([primary], timeout=deadline)
+            if done or not self._take_hedge():
+                content = await primary
+                self._record(started)
+                return content
+
+            hedge = asyncio.ensure_future(read())
+            pending = {primary, hedge}
+            try:
+                while True:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    succeeded = [task for task in done if task.exception() is None]
+                    if succeeded or not pending:
+                        task = (succeeded or list(done))[0]
+                        content = task.result()
+                        self._record(started, hedge_won=task is hedge)
+                        return content
+            finally:
+                hedge.cancel()
+        finally:
+            primary.cancel()
+
+
+_read_hedger = None
+
+
+def set_read_hedger(hedger: HedgedReader | None):
+    """Install `hedger` to hedge the reads of this process (see `get_read_hedger`), or remove it."""
+    global _read_hedger
+    _read_hedger = hedger
+
+
+def get_read_hedger() -> HedgedReader | None:
+    """The hedger of the reads of this process used by `generate.fetch_granule`, if one was installed."""
+    return _read_hedger
+
+
+class BufferReader(io.BufferedIOBase):
+    """
+    Read-only, seekable file-like object over a buffer, without copying it.
+
+    `io.BytesIO` copies the bytes it is given (or, for `bytes`, as soon as `getbuffer` is called), so a granule
+    fetched as an obstore `Bytes` or an `mmap` would otherwise be held twice while h5py/h5netcdf read it.
+    `BufferReader` only slices a `memoryview` of it; `getbuffer` exposes the same memory like `BytesIO.getbuffer`.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = buffer
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> 'BufferReader':
+        """Memory-map a local file, so its pages are shared with the page cache instead of read into memory."""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def getbuffer(self) -> memoryview:
+        self._check_closed()
+        return self._view[:]
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        self._check_closed()
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._view.nbytes + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return position
+
+    def read(self, size: int | None = -1) -> bytes:
+        self._check_closed()
+        end = self._view.nbytes if size is None or size < 0 else min(self._position + size, self._view.nbytes)
+        data = self._view[self._position : end].tobytes() if end > self._position else b''
+        self._position = max(self._position, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, buffer) -> int:
+        self._check_closed()
+        target = memoryview(buffer).cast('B')
+        count = max(0, min(target.nbytes, self._view.nbytes - self._position))
+        target[:count] = self._view[self._position : self._position + count]
+        self._position += count
+        return count
+
+    readinto1 = readinto
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if isinstance(self._buffer, mmap.mmap):
+                try:
+                    self._buffer.close()
+                except BufferError:
+                    # still exported, e.g. by a view from getbuffer; it is unmapped once that is released
+                    pass
+            self._buffer = None
+        super().close()
+
+
+class AsyncFetcher:
+    """
+    Fetches whole objects concurrently with obstore's `get_async`/`get_ranges_async`.
+
+    Args:
+        max_concurrency (int): Requests in flight at once, across all objects.
+        part_size (int | None): Objects larger than this are fetched with concurrent ranged requests of this
+            size; `None` always fetches objects with a single request.
+        s3_options (dict, optional): Options of the `S3Store` created for each bucket.
+        limiter (AdaptiveLimiter, optional): Adjusts the requests in flight (up to its `maximum`) instead of
+            keeping `max_concurrency` requests in flight, and retries throttled requests.
+        hedger (HedgedReader, optional): Hedges requests slower than its deadline; hedges take a slot too.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 128,
+        part_size: int | None = PART_SIZE,
+        s3_options: dict | None = None,
+        limiter: AdaptiveLimiter | None = None,
+        hedger: HedgedReader | None = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.part_size = part_size
+        self.s3_options = S3_OPTIONS if s3_options is None else s3_options
+        self.limiter = limiter
+        self.hedger = hedger
+        self.stores = {}
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use, inside the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def store_for(self, url: str):
+        """The (cached) obstore store of the bucket or host of `url`, and the path of `url` in it."""
+        parsed = urlparse(url)
+        if parsed.scheme in ('', 'file'):
+            root, options = 'file:///', {}
+        else:
+            root = f'{parsed.scheme}://{parsed.netloc}'
+            options = self.s3_options if parsed.scheme == 's3' else {}
+        if root not in self.stores:
+            self.stores[root] = from_url(root, **options)
+        store = self.stores[root]
+        return store, object_path(url, store)
+
+    async def fetch(self, url: str):
+        """
+        Fetch a whole object.
+
+        The first request also returns the object size; the rest of a large object is then fetched in
+        `part_size` ranges concurrently. Returns a buffer-protocol object (obstore `Bytes` for single
+        requests, a `bytearray` for ranged ones).
+        """
+        store, path = self.store_for(url)
+        if self.part_size is None:
+
+            async def read_whole():
+                result = await obs.get_async(store, path)
+                return await result.bytes_async()
+
+            return await self._request(read_whole)
+
+        meta = {}
+
+        async def read_head():
+            result = await obs.get_async(store, path, options={'range': (0, self.part_size)})
+            meta.update(result.meta)
+            return await result.bytes_async()
+
+        head = await self._request(read_head)
+        size = meta['size']
+        if size <= len(head):
+            return head
+
+        starts = list(range(len(head), size, self.part_size))
+        ends = [min(start + self.part_size, size) for start in starts]
+        content = bytearray(size)
+        content[: len(head)] = head
+
+        async def fetch_part(start: int, end: int):
+            async def read_part():
+                [part] = await obs.get_ranges_async(store, path, starts=[start], ends=[end])
+                return part
+
+            content[start:end] = await self._request(read_part)
+
+        await asyncio.gather(*(fetch_part(start, end) for start, end in zip(starts, ends)))
+        return content
+
+    async def _request(self, read: Callable[[], Awaitable]):
+        if self.hedger is not None:
+            return await self.hedger.call_async(lambda: self._limited(read))
+        return await self._limited(read)
+
+    async def _limited(self, read: Callable[[], Awaitable]):
+        if self.limiter is not None:
+            return await self.limiter.call_async(read)
+        async with self.semaphore:
+            return await read()
+
+    async def map(
+        self,
+        urls: Iterable[str],
+        parse: Callable,
+        executor: concurrent.futures.Executor,
+        max_pending: int | None = None,
+        retries: int = 0,
+        backoff: float = 1.0,
+    ) -> AsyncIterator[dict]:
+        """
+        Fetch `urls` and run `parse(url, content, fetch_seconds)` on each of them in `executor`.
+
+        Results are yielded in completion order. A fetch failing with a transient error (see `is_transient`) is
+        retried up to `retries` times, after `backoff` seconds doubled at every retry. A failed fetch yields
+        `{'url', 'error', 'exception', 'attempts'}` instead of stopping the run; `parse` is expected to report
+        its own errors in its result.
+
+        Args:
+            urls (Iterable[str]): Objects to fetch; consumed lazily.
+            parse (Callable): Picklable function called with the URL, the object bytes and the fetch time.
+            executor (Executor): Pool running `parse`.
+            max_pending (int, optional): Fetched objects waiting for the pool, `2 * max_workers` by default.
+            retries (int): Retries of a fetch failing with a transient error.
+            backoff (float): Seconds before the first retry.
+        """
+        loop = asyncio.get_running_loop()
+        workers = getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+        fetched = asyncio.Queue(maxsize=max_pending or 2 * workers)
+        results = asyncio.Queue()
+        # fetch slots are taken before a task is created, so a long URL list doesn't become millions of tasks
+        slots = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch_one(url: str):
+            attempt = 1
+            try:
+                start = time.perf_counter()
+                while True:
+                    try:
+                        content = await self.fetch(url)
+                        break
+                    except Exception as e:
+                        if attempt > retries or not is_transient(e):
+                            raise
+                        logger.warning(f'Attempt {attempt} to fetch {url} failed, retrying: {e}')
+                    await asyncio.sleep(backoff * 2 ** (attempt - 1))
+                    attempt += 1
+                await fetched.put((url, content, time.perf_counter() - start))
+            except Exception as e:
+                logger.error(f'Failed to fetch {url}: {e}')
+                await results.put({'url': url, 'error': str(e), 'exception': e, 'attempts': attempt})
+            finally:
+                slots.release()
+
+        async def produce():
+            tasks = set()
+            try:
+                for url in urls:
+                    await slots.acquire()
+                    task = asyncio.create_task(fetch_one(url))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.wait(tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            for _ in range(workers):
+                await fetched.put(None)
+
+        async def consume():
+            while (item := await fetched.get()) is not None:
+                url, content, fetch_seconds = item
+                try:
+                    result = await loop.run_in_executor(executor, parse, url, content, fetch_seconds)
+                except Exception as e:
+                    logger.error(f'Failed to parse {url}: {e}')
+                    result = {'url': url, 'error': str(e)}
+                del item, content
+                await results.put(result)
+
+        async def run():
+            try:
+                await asyncio.gather(produce(), *(consume() for _ in range(workers)))
+            finally:
+                await results.put(None)
+
+        runner = asyncio.create_task(run())
+        try:
+            while (result := await results.get()) is not None:
+                yield result
+            await runner
+        finally:
+            runner.cancel()
@@ -6,26 +6,42 @@ Modified to use stac by Luis Lopez
 """
 
 import argparse
+import asyncio
+import base64
+import calendar
 import collections
-import io
+import functools
 import json
 import logging
+import re
+import sys
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Any
 
 import fsspec
 import geojson
+import h5py
 import kerchunk.hdf
 import numpy as np
 import obstore as obs
+import orjson
 import pandas as pd
 import pystac
+import requests
+import rustac
 import xarray as xr
-from obstore.store import S3Store
+from fsspec.implementations.reference import LazyReferenceMapper
+from obstore.store import ObjectStore
 from pyproj import CRS, Transformer
 from shapely.geometry import Polygon
 
-from .ingestitem import ingest_item
+from .fetch import BufferReader, get_read_hedger, get_read_limiter, object_path
+from .header import HEADER_COORDINATES, GranuleHeader
+from .ingestitem import post_collection, post_item
+from .timing import StageTimer, stage
 
 
 # TODO: Hard-coded here for now, but we should add this to the granule metadata and parse it from there
@@ -39,6 +55,9 @@ DATE_FORMAT = '%Y%m%d'
 # S1A_IW_SLC__1SSH_20170221T204710_20170221T204737_015387_0193F6_AB07_X_S1B_IW_SLC__1SSH_20170227T204628_20170227T204655_004491_007D11_6654_G0240V02_P094.nc
 DATE_TIME_FORMAT = '%Y%m%dT%H%M%S'
 
+# Coordinate chunks up to this size are inlined into the kerchunk references
+COORDINATE_INLINE_BYTES = 2**16
+
 
 def generate_nsidc_metadata_files(ds, filename, version):
     """
@@ -179,13 +198,61 @@ def generate_nsidc_metadata_files(ds, filename, version):
     return create_premet_file(ds, filename, version)
 
 
+def densified_ring(minx, miny, maxx, maxy, fracs=(0.25, 0.5, 0.75)):
+    """
+    Vertices of the closed, counterclockwise ring around a projected extent.
+
+    Starts at the lower left corner and adds a vertex at each of `fracs` along every edge, so the
+    ring follows the curved edges of the footprint once transformed to geographic coordinates.
+
+    Returns:
+        tuple of numpy arrays with the x and y coordinates of the ring.
+    """
+    steps = np.concatenate([[0.0], fracs])
+    ring_x = np.concatenate(
+        [
+            minx + steps * (maxx - minx),
+            maxx + steps * (maxx - maxx),
+            maxx + steps * (minx - maxx),
+            minx + steps * (minx - minx),
+            [minx],
+        ]
+    )
+    ring_y = np.concatenate(
+        [
+            miny + steps * (miny - miny),
+            miny + steps * (maxy - miny),
+            maxy + steps * (maxy - maxy),
+            maxy + steps * (miny - maxy),
+            [miny],
+        ]
+    )
+    return ring_x, ring_y
+
+
+@functools.lru_cache(maxsize=64)
+def get_transformer(crs_wkt: str, epsg: int) -> Transformer:
+    """
+    The transformer from the CRS of `crs_wkt` to EPSG `epsg`, built once per process for each pair.
+
+    Granules share a few dozen projections, and building a transformer parses the WKT and looks up the
+    PROJ database; pyproj transformers are thread-safe, so the cached ones are shared by every thread.
+    """
+    return Transformer.from_crs(CRS.from_wkt(crs_wkt), CRS.from_epsg(epsg), always_xy=True)
+
+
 def get_geom(ds, precision, projection):
     """
     Extracts a polygon from an ITS_LIVE xarray dataset using available projection metadata.
 
+    `ds` can also be a header record, e.g. a row of a `headercache` parquet file.
+
     Returns:
         shapely.Polygon object if found, otherwise None.
     """
+    if isinstance(ds, dict):
+        ds = GranuleHeader.from_record(ds)
+
     # Look for known projection keys in dataset attributes
     projection_keys = ['mapping', 'UTM_Projection', 'Polar_Stereographic']
 
@@ -199,8 +266,7 @@ def get_geom(ds, precision, projection):
     else:
         return None
 
-    crs = CRS.from_wkt(projection_cf.crs_wkt)
-    transformer = Transformer.from_crs(crs, CRS.from_epsg(projection), always_xy=True)
+    transformer = get_transformer(projection_cf.crs_wkt, projection)
     xvals = ds['x'].values
     yvals = ds['y'].values
     minval_x, pix_size_x, rot_x_ignored, maxval_y, rot_y_ignored, pix_size_y = [
@@ -213,22 +279,11 @@ def get_geom(ds, precision, projection):
     projection_cf_miny = yvals[-1] + pix_size_y / 2.0  # pix_size_y is negative!
     projection_cf_maxy = yvals[0] - pix_size_y / 2.0  # pix_size_y is negative!
 
-    ll_lonlat = np.round(
-        transformer.transform(projection_cf_minx, projection_cf_miny),
-        decimals=precision,
-    ).tolist()
-    lr_lonlat = np.round(
-        transformer.transform(projection_cf_maxx, projection_cf_miny),
-        decimals=precision,
-    ).tolist()
-    ur_lonlat = np.round(
-        transformer.transform(projection_cf_maxx, projection_cf_maxy),
-        decimals=precision,
-    ).tolist()
-    ul_lonlat = np.round(
-        transformer.transform(projection_cf_minx, projection_cf_maxy),
-        decimals=precision,
-    ).tolist()
+    # ring in counterclockwise order: ll -> lr -> ur -> ul -> ll, densified at a quarter of each edge,
+    # transformed in a single call
+    ring_x, ring_y = densified_ring(projection_cf_minx, projection_cf_miny, projection_cf_maxx, projection_cf_maxy)
+    polylist = np.round(np.column_stack(transformer.transform(ring_x, ring_y)), decimals=precision).tolist()
+    ll_lonlat, lr_lonlat, ur_lonlat, ul_lonlat = polylist[0:16:4]
 
     # find center lon lat for inclusion in feature (to determine lon lat grid cell directory)
     center_lonlat = np.round(
@@ -236,54 +291,6 @@ def get_geom(ds, precision, projection):
         decimals=4,
     ).tolist()
 
-    fracs = [0.25, 0.5, 0.75]
-    polylist = []  # ring in counterclockwise order
-
-    polylist.append(ll_lonlat)
-    dx = projection_cf_maxx - projection_cf_minx
-    dy = projection_cf_miny - projection_cf_miny
-    for frac in fracs:
-        polylist.append(
-            np.round(
-                transformer.transform(projection_cf_minx + (frac * dx), projection_cf_miny + (frac * dy)),
-                decimals=precision,
-            ).tolist()
-        )
-
-    polylist.append(lr_lonlat)
-    dx = projection_cf_maxx - projection_cf_maxx
-    dy = projection_cf_maxy - projection_cf_miny
-    for frac in fracs:
-        polylist.append(
-            np.round(
-                transformer.transform(projection_cf_maxx + (frac * dx), projection_cf_miny + (frac * dy)),
-                decimals=precision,
-            ).tolist()
-        )
-
-    polylist.append(ur_lonlat)
-    dx = projection_cf_minx - projection_cf_maxx
-    dy = projection_cf_maxy - projection_cf_maxy
-    for frac in fracs:
-        polylist.append(
-            np.round(
-                transformer.transform(projection_cf_maxx + (frac * dx), projection_cf_maxy + (frac * dy)),
-                decimals=precision,
-            ).tolist()
-        )
-
-    polylist.append(ul_lonlat)
-    dx = projection_cf_minx - projection_cf_minx
-    dy = projection_cf_miny - projection_cf_maxy
-    for frac in fracs:
-        polylist.append(
-            np.round(
-                transformer.transform(projection_cf_minx + (frac * dx), projection_cf_maxy + (frac * dy)),
-                decimals=precision,
-            ).tolist()
-        )
-
-    polylist.append(ll_lonlat)
     poly = Polygon(polylist)
     spatial_epsg = projection_cf.attrs['spatial_epsg']
     return {
@@ -295,52 +302,154 @@ def get_geom(ds, precision, projection):
     }
 
 
-def open_async_netcdf(url: str, fs):
-    if isinstance(fs, S3Store):
-        url = url.replace('s3://its-live-data/', '')
-        result = obs.get(fs, url)
-        file_content = io.BytesIO(result.bytes().to_bytes())
-    elif isinstance(fs, fsspec.AbstractFileSystem):
-        with fs.open(url, mode='rb', skip_instance_cache=True) as f:
-            file_content = io.BytesIO(f.read())
-    else:
-        raise ValueError(f'Unsupported filesystem type: {type(fs)}')
+def _read_granule(url: str, store: Any = None):
+    if store is None:
+        if url.startswith('s3://'):
+            so = {'anon': True, 'skip_instance_cache': True}  # Disable caching for S3
+        elif url.startswith('http'):
+            so = {'cache_type': 'none'}  # Disable caching for HTTP
+        else:
+            so = {}
+        with fsspec.open(url, mode='rb', **so) as f:  # type: ignore
+            return f.read()  # type: ignore
+    if isinstance(store, ObjectStore):
+        return obs.get(store, object_path(url, store)).bytes()
+    if isinstance(store, fsspec.AbstractFileSystem):
+        with store.open(url, mode='rb', skip_instance_cache=True) as f:
+            return f.read()
+    raise ValueError(f'Unsupported filesystem type: {type(store)}')
+
+
+def fetch_granule(url: str, store: Any = None, timer: StageTimer | None = None, content=None) -> BufferReader:
+    """
+    Read a whole granule into memory, as a read-only file-like object over the fetched buffer.
+
+    The buffer returned by the reader (an obstore `Bytes`, the bytes read by fsspec or, for local files, an mmap)
+    is handed to h5py/h5netcdf without being copied again. Remote reads go through the process's
+    `fetch.AdaptiveLimiter` when one is installed (`fetch.set_read_limiter`), and are hedged by its
+    `fetch.HedgedReader` when one is installed (`fetch.set_read_hedger`).
+
+    Args:
+        url (str): Local path, s3:// or https:// URL of the granule.
+        store (Any, optional): obstore store or fsspec filesystem to read with; `fsspec.open` if not given.
+        timer (StageTimer, optional): Records the fetch time and bytes read.
+        content (bytes-like, optional): The granule, already fetched (e.g. by `fetch.AsyncFetcher`), in which
+            case nothing is read and the caller records the fetch.
+    """
+    if content is not None:
+        return BufferReader(content)
+
+    with stage(timer, 'fetch'):
+        if store is None and fsspec.utils.get_protocol(url) == 'file':
+            file_content = BufferReader.from_file(fsspec.utils.stringify_path(url).removeprefix('file://'))
+        else:
+            read = functools.partial(_read_granule, url, store)
+            if (limiter := get_read_limiter()) is not None:
+                read = functools.partial(limiter.call, read)
+            hedger = get_read_hedger()
+            file_content = BufferReader(hedger.call(read) if hedger is not None else read())
+    if timer is not None:
+        timer.add_bytes(file_content.getbuffer().nbytes)
+    return file_content
+
+
+def inline_references(
+    refs: dict,
+    file_content: BufferReader,
+    variables: tuple = HEADER_COORDINATES,
+    max_bytes: int = COORDINATE_INLINE_BYTES,
+) -> dict:
+    """
+    Inline the chunks of small coordinate arrays into kerchunk references.
+
+    The chunks are copied from the granule already in memory, so opening the references later does not
+    need one request per coordinate. `refs` is modified in place and returned.
+    """
+    with file_content.getbuffer() as buffer:
+        for key, ref in refs['refs'].items():
+            if key.split('/')[0] in variables and isinstance(ref, list) and len(ref) == 3 and ref[2] <= max_bytes:
+                _, offset, size = ref
+                refs['refs'][key] = 'base64:' + base64.b64encode(buffer[offset : offset + size]).decode()
+    return refs
+
+
+def translate_references(h5file, file_content: BufferReader, url: str, timer: StageTimer | None = None) -> dict:
+    """Build the kerchunk references of an open granule, with its coordinates inlined."""
+    with stage(timer, 'kerchunk'):
+        # This will create a kerchunk reference object for the HDF5 file
+        # which can be used to access the data without downloading the entire file.
+        refs = kerchunk.hdf.SingleHdf5ToZarr(h5file, url=url, inline_threshold=100).translate()
+        return inline_references(refs, file_content)
+
+
+def open_async_netcdf(url: str, fs, timer: StageTimer | None = None, with_kerchunk: bool = False, content=None):
+    file_content = fetch_granule(url, store=fs, timer=timer, content=content)
 
-    # Convert with kerchunk
-    # h5chunks = kerchunk.hdf.SingleHdf5ToZarr(file_content, url=url, inline_threshold=100).translate()
     kerchunks = None
+    if with_kerchunk:
+        kerchunks = translate_references(file_content, file_content, url, timer=timer)
 
     # Load xarray Dataset from in-memory file
-    ds = xr.open_dataset(file_content, engine='h5netcdf')
+    with stage(timer, 'open'):
+        ds = xr.open_dataset(file_content, engine='h5netcdf')
     return ds, kerchunks
 
 
-def open_netcdf(url: str = '', with_kerchunk: bool = False) -> tuple:
-    so = {}
-    if url.startswith('s3://'):
-        so = {'anon': True, 'skip_instance_cache': True}  # Disable caching for S3
-    elif url.startswith('http'):
-        so = {'cache_type': 'none'}  # Disable caching for HTTP
-    else:
-        so = {}
+def open_netcdf(url: str = '', with_kerchunk: bool = False, timer: StageTimer | None = None, content=None) -> tuple:
+    file_content = fetch_granule(url, timer=timer, content=content)
 
     kerchunks = None
-
-    with fsspec.open(url, mode='rb', **so) as f:  # type: ignore
-        file_content = io.BytesIO(f.read())  # type: ignore
-        if with_kerchunk:
-            # Convert with kerchunk
-            # This will create a kerchunk reference object for the HDF5 file
-            # which can be used to access the data without downloading the entire file.
-            h5chunks = kerchunk.hdf.SingleHdf5ToZarr(file_content, url=url, inline_threshold=100)
-            kerchunks = h5chunks.translate()
+    if with_kerchunk:
+        kerchunks = translate_references(file_content, file_content, url, timer=timer)
 
     # Open dataset from memory
-    ds = xr.open_dataset(file_content, engine='h5netcdf')
+    with stage(timer, 'open'):
+        ds = xr.open_dataset(file_content, engine='h5netcdf')
 
     return ds, kerchunks
 
 
+def open_granule_h5(
+    url: str, store: Any = None, with_kerchunk: bool = False, timer: StageTimer | None = None, content=None
+) -> tuple[GranuleHeader, dict | None]:
+    """
+    Read the metadata header and the kerchunk references of a granule from a single h5py open.
+
+    Unlike `open_netcdf`, the granule is neither opened twice (once by kerchunk, once by xarray) nor decoded
+    into a Dataset: the returned `GranuleHeader` has the attribute interface `get_geom`, `create_stac_item`
+    and `generate_nsidc_metadata_files` use.
+    """
+    file_content = fetch_granule(url, store=store, timer=timer, content=content)
+
+    with stage(timer, 'open'):
+        h5file = h5py.File(file_content, mode='r')
+        header = GranuleHeader.from_h5(h5file, url=url)
+    try:
+        kerchunks = translate_references(h5file, file_content, url, timer=timer) if with_kerchunk else None
+    finally:
+        h5file.close()
+    return header, kerchunks
+
+
+def write_parquet_references(refs: dict, url: str, fs=None, record_size: int = 10_000) -> str:
+    """
+    Write kerchunk references as a parquet reference store (a directory), readable with `reference://`.
+
+    Args:
+        refs (dict): kerchunk references as returned by `SingleHdf5ToZarr.translate`.
+        url (str): Directory to write, local or s3://. Existing contents are removed.
+        fs (fsspec.AbstractFileSystem, optional): Filesystem to write with, derived from `url` if not given.
+        record_size (int, optional): Number of references per parquet file.
+    """
+    if fs is None:
+        fs, _ = fsspec.core.url_to_fs(url)
+    out = LazyReferenceMapper.create(url, fs=fs, record_size=record_size)
+    for key in sorted(refs['refs']):
+        out[key] = refs['refs'][key]
+    out.flush()
+    return url
+
+
 def s3_to_https_link(s3_path):
     """
     Convert an S3 URL to an HTTPS link for public access.
@@ -361,16 +470,120 @@ def s3_to_https_link(s3_path):
     return f'https://{bucket}.s3.amazonaws.com/{key}'
 
 
-def create_stac_item(ds, geom, url):
-    """Create STAC item from dataset and geometry."""
+STAC_EXTENSIONS = [
+    'https://stac-extensions.github.io/projection/v2.0.0/schema.json',
+    'https://stac-extensions.github.io/alternate-assets/v1.2.0/schema.json',
+    'https://stac-extensions.github.io/version/v1.2.0/schema.json',
+    'https://stac-extensions.github.io/sat/v1.1.0/schema.json',
+]
+
+# Asset key, file suffix, media type and role of the assets of a granule
+STAC_ASSETS = [
+    ('data', '.nc', pystac.MediaType.NETCDF, 'data'),
+    ('overview', '.png', pystac.MediaType.PNG, 'overview'),
+    ('thumbnail', '_thumb.png', pystac.MediaType.PNG, 'thumbnail'),
+]
+
+
+# img_pair_info dates as written in the granules, e.g. 20150720T15:30:49.14271 or 20150821T15:30:52.
+COMPACT_DATETIME = re.compile(r'(\d{4})(\d{2})(\d{2})T(\d{2}):(\d{2}):(\d{2})\.?(\d{0,6})')
+# Granule creation and update dates, e.g. 13-Jun-2022 19:47:09
+ATTRIBUTE_DATETIME = re.compile(r'(\d{2})-([A-Za-z]{3})-(\d{4}) (\d{2}):(\d{2}):(\d{2})')
+MONTHS = {month: f'{number:02d}' for number, month in enumerate(calendar.month_abbr) if month}
+
+
+def _utc_isoformat(value, errors: str = 'raise') -> str | None:
+    # Any other format is parsed by pandas, one value at a time
+    timestamp = pd.to_datetime(value, errors=errors)
+    if errors == 'coerce' and pd.isna(timestamp):
+        return None
+    return timestamp.tz_localize('UTC').isoformat().replace('+00:00', 'Z')
+
+
+def _iso_datetime(value) -> str | None:
+    if not isinstance(value, str):
+        return None
+    if match := COMPACT_DATETIME.fullmatch(value):
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return f'{year}-{month}-{day}T{hour}:{minute}:{second}.{fraction.ljust(6, "0")}'
+    if (match := ATTRIBUTE_DATETIME.fullmatch(value)) and (month := MONTHS.get(match[2].title())):
+        day, _, year, hour, minute, second = match.groups()
+        return f'{year}-{month}-{day}T{hour}:{minute}:{second}.000000'
+    return None
+
+
+def utc_isoformats(values: list, errors: str = 'raise') -> list:
+    """
+    Format many naive UTC date strings as STAC datetimes, e.g. `2015-07-20T15:30:49.142710Z`.
+
+    Dates in the formats of ITS_LIVE granules are converted and formatted at once as numpy `datetime64`; any
+    other value falls back to `pandas.to_datetime`. The output is the same as
+    `pd.to_datetime(value).tz_localize('UTC').isoformat()` with a `Z` suffix. With `errors='coerce'`, values
+    that can't be parsed give `None`.
+    """
+    formatted = [None] * len(values)
+    fast = {}
+    for i, value in enumerate(values):
+        if (iso := _iso_datetime(value)) is not None:
+            fast[i] = iso
+        else:
+            formatted[i] = _utc_isoformat(value, errors=errors)
+
+    if fast:
+        try:
+            parsed = np.array(list(fast.values()), dtype='datetime64[us]')
+        except ValueError:
+            # e.g. a month 13: let pandas raise, or coerce, as it would for a single value
+            for i in fast:
+                formatted[i] = _utc_isoformat(values[i], errors=errors)
+        else:
+            # like isoformat, microseconds are only written when they are not zero
+            for i, text in zip(fast, np.datetime_as_string(parsed, unit='us')):
+                formatted[i] = f'{text.removesuffix(".000000")}Z'
+    return formatted
+
+
+def stac_datetimes(img_pair_infos: list, global_attrs: list) -> list:
+    """
+    The STAC datetime properties of many granules, parsed in one batch by `utc_isoformats`.
+
+    Args:
+        img_pair_infos (list): `img_pair_info` attributes of each granule.
+        global_attrs (list): Global attributes of each granule, for their creation and update dates.
+
+    Returns:
+        list: one dict per granule with its `start_datetime`, `end_datetime`, `mid_datetime`, `created` and
+        `updated` properties.
+    """
+    start = utc_isoformats([info['acquisition_date_img1'] for info in img_pair_infos])
+    end = utc_isoformats([info['acquisition_date_img2'] for info in img_pair_infos])
+    mid = utc_isoformats([info['date_center'] for info in img_pair_infos])
+    created = utc_isoformats([attrs.get('date_created', '') for attrs in global_attrs])
+    updated = utc_isoformats([attrs.get('date_updated', '') for attrs in global_attrs], errors='coerce')
+    return [
+        {
+            'start_datetime': start[i],
+            'end_datetime': end[i],
+            'mid_datetime': mid[i],
+            'created': created[i],
+            'updated': created[i] if updated[i] is None else updated[i],  # Fallback if invalid
+        }
+        for i in range(len(img_pair_infos))
+    ]
+
+
+def stac_item_fields(ds, geom, url, dates: dict | None = None):
+    """
+    The id, datetime, geometry, properties and assets of the STAC item of a granule, as plain values.
+
+    `dates` are the granule's datetime properties from `stac_datetimes`, computed here when not given. `ds` can
+    be a Dataset, a `GranuleHeader` or a header record (see `GranuleHeader.to_record`).
+    """
+    if isinstance(ds, dict):
+        ds = GranuleHeader.from_record(ds)
     # Extract basic properties
-    start_date = (
-        pd.to_datetime(ds['img_pair_info'].acquisition_date_img1).tz_localize('UTC').isoformat().replace('+00:00', 'Z')
-    )
-    end_date = (
-        pd.to_datetime(ds['img_pair_info'].acquisition_date_img2).tz_localize('UTC').isoformat().replace('+00:00', 'Z')
-    )
-    mid_date = pd.to_datetime(ds['img_pair_info'].date_center).tz_localize('UTC')
+    if dates is None:
+        [dates] = stac_datetimes([ds['img_pair_info'].attrs], [ds.attrs])
 
     filename = url.split('/')[-1].replace('.nc', '')
     mission = ds['img_pair_info'].id_img1.split('_')[0]
@@ -400,59 +613,29 @@ def create_stac_item(ds, geom, url):
         scene_1_frame = f'{scene_1_split[5]}_{scene_1_split[7]}'
         scene_2_frame = f'{scene_2_split[5]}_{scene_2_split[7]}'
 
-    date_created = (
-        pd.to_datetime(ds.attrs.get('date_created', '')).tz_localize('UTC').isoformat().replace('+00:00', 'Z')
-    )
-    date_updated = pd.to_datetime(ds.attrs.get('date_updated', ''), errors='coerce')
-    date_updated = (
-        date_created
-        if pd.isna(date_updated)  # Fallback if invalid
-        else date_updated.tz_localize('UTC').isoformat().replace('+00:00', 'Z')
-    )
-    # Create STAC item
-    item = pystac.Item(
-        id=filename,
-        collection='itslive-granules',  # Add collection field
-        stac_extensions=[
-            'https://stac-extensions.github.io/projection/v2.0.0/schema.json',
-            'https://stac-extensions.github.io/alternate-assets/v1.2.0/schema.json',
-            'https://stac-extensions.github.io/version/v1.2.0/schema.json',
-            'https://stac-extensions.github.io/sat/v1.1.0/schema.json',
-        ],
-        geometry={
-            'type': 'Polygon',
-            'coordinates': geojson.Feature(geometry=geom['polygon'])['geometry']['coordinates'],
-        },
-        bbox=geom['bbox'],
-        datetime=mid_date,
-        # TODO: this should use a parametrized json template
-        properties={
-            'mid_datetime': pd.to_datetime(mid_date).isoformat().replace('+00:00', 'Z'),
-            'created': date_created,
-            'updated': date_updated,
-            'latitude': round(geom['center'][1], 4),
-            'longitude': round(geom['center'][0], 4),
-            'date_dt': round(float(ds['img_pair_info'].date_dt), 0),
-            'platform': mission,
-            'scene_1_id': scene_1_id,
-            'scene_2_id': scene_2_id,
-            'scene_1_frame': scene_1_frame,
-            'scene_2_frame': scene_2_frame,
-            'sat:orbit_state': sat_orbit_direction,
-            'start_datetime': str(start_date),
-            'end_datetime': str(end_date),
-            'percent_valid_pixels': int(round(float(ds['img_pair_info'].roi_valid_percentage), 0)),
-            'proj:code': f'EPSG:{geom["epsg"]}',
-            'version': str(version),
-        },
-    )
+    # TODO: this should use a parametrized json template
+    properties = {
+        'mid_datetime': dates['mid_datetime'],
+        'created': dates['created'],
+        'updated': dates['updated'],
+        'latitude': round(geom['center'][1], 4),
+        'longitude': round(geom['center'][0], 4),
+        'date_dt': round(float(ds['img_pair_info'].date_dt), 0),
+        'platform': mission,
+        'scene_1_id': scene_1_id,
+        'scene_2_id': scene_2_id,
+        'scene_1_frame': scene_1_frame,
+        'scene_2_frame': scene_2_frame,
+        'sat:orbit_state': sat_orbit_direction,
+        'start_datetime': dates['start_datetime'],
+        'end_datetime': dates['end_datetime'],
+        'percent_valid_pixels': int(round(float(ds['img_pair_info'].roi_valid_percentage), 0)),
+        'proj:code': f'EPSG:{geom["epsg"]}',
+        'version': str(version),
+    }
 
-    # Add assets
-    for key, ext, media_type, role in [
-        ('data', '.nc', pystac.MediaType.NETCDF, 'data'),
-        ('overview', '.png', pystac.MediaType.PNG, 'overview'),
-        ('thumbnail', '_thumb.png', pystac.MediaType.PNG, 'thumbnail'),
-    ]:
+    assets = {}
+    for key, ext, media_type, role in STAC_ASSETS:
         canonical_url = url.replace('.nc', ext)
         s3_url = canonical_url.replace('.s3.amazonaws.com', '').replace('https', 's3')
         extra_fields = (
@@ -467,99 +650,483 @@ def create_stac_item(ds, geom, url):
             if key in ['data']
             else {}
         )
+        assets[key] = {
+            'href': s3_to_https_link(canonical_url),
+            'media_type': str(media_type),
+            'roles': [role],
+            'extra_fields': extra_fields,
+        }
 
-        item.add_asset(
-            key=key,
-            asset=pystac.Asset(
-                href=s3_to_https_link(canonical_url),
-                media_type=media_type,
-                roles=[role],
-                extra_fields=extra_fields,
-            ),
-        )
+    return {
+        'id': filename,
+        'datetime': pd.Timestamp(dates['mid_datetime']),
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': geojson.Feature(geometry=geom['polygon'])['geometry']['coordinates'],
+        },
+        'bbox': geom['bbox'],
+        'properties': properties,
+        'assets': assets,
+    }
+
+
+def create_stac_item(ds, geom, url, dates: dict | None = None):
+    """Create STAC item from dataset and geometry."""
+    fields = stac_item_fields(ds, geom, url, dates=dates)
+    # Create STAC item
+    item = pystac.Item(
+        id=fields['id'],
+        collection='itslive-granules',  # Add collection field
+        stac_extensions=list(STAC_EXTENSIONS),
+        geometry=fields['geometry'],
+        bbox=fields['bbox'],
+        datetime=fields['datetime'],
+        properties=fields['properties'],
+    )
+
+    # Add assets
+    for key, asset in fields['assets'].items():
+        item.add_asset(key=key, asset=pystac.Asset(**asset))
 
     return item
 
 
-def generate_itslive_metadata(url: str, store: Any = None, with_kerchunk: bool = False) -> dict:
+def create_stac_item_dict(ds, geom, url, dates: dict | None = None) -> dict:
+    """
+    Build the STAC item of a granule directly as a dict, without constructing pystac objects.
+
+    The result is equal, key order included, to `create_stac_item(ds, geom, url).to_dict()`, so it serializes
+    to the same JSON (see `stac_item_json`).
+    """
+    fields = stac_item_fields(ds, geom, url, dates=dates)
+    properties = dict(fields['properties'])
+    properties['datetime'] = properties['mid_datetime']
+
+    assets = {}
+    for key, asset in fields['assets'].items():
+        assets[key] = {'href': asset['href'], 'type': asset['media_type'], **asset['extra_fields']}
+        assets[key]['roles'] = asset['roles']
+
+    return {
+        'type': 'Feature',
+        'stac_version': pystac.get_stac_version(),
+        'stac_extensions': list(STAC_EXTENSIONS),
+        'id': fields['id'],
+        # copied, like pystac does, so the item doesn't share lists with `geom`
+        'geometry': {
+            'type': fields['geometry']['type'],
+            'coordinates': [[list(point) for point in ring] for ring in fields['geometry']['coordinates']],
+        },
+        'bbox': list(fields['bbox']),
+        'properties': properties,
+        'links': [],
+        'assets': assets,
+        'collection': 'itslive-granules',
+    }
+
+
+def create_stac_item_dicts(datasets: list, geoms: list, urls: list) -> list:
+    """
+    Build the STAC items of many granules as dicts, like `create_stac_item_dict`.
+
+    The dates of all the granules are parsed in one batch (see `stac_datetimes`) instead of one by one, which
+    dominates the cost of building items from cached headers.
+    """
+    datasets = [GranuleHeader.from_record(ds) if isinstance(ds, dict) else ds for ds in datasets]
+    dates = stac_datetimes([ds['img_pair_info'].attrs for ds in datasets], [ds.attrs for ds in datasets])
+    return [
+        create_stac_item_dict(ds, geom, url, dates=granule_dates)
+        for ds, geom, url, granule_dates in zip(datasets, geoms, urls, dates)
+    ]
+
+
+def stac_item_json(item, indent: bool = False) -> bytes:
+    """
+    Serialize a STAC item, given as a dict or a `pystac.Item`, to JSON bytes with orjson.
+
+    With `indent`, the output is the same as `json.dumps(item, indent=2)`.
+    """
+    if isinstance(item, pystac.Item):
+        item = item.to_dict()
+    return orjson.dumps(item, option=orjson.OPT_INDENT_2 if indent else 0)
+
+
+def generate_itslive_metadata(
+    url: str,
+    store: Any = None,
+    with_kerchunk: bool = False,
+    timer: StageTimer | None = None,
+    reader: str = 'xarray',
+    content=None,
+    item_format: str = 'pystac',
+    keep_dataset: bool = True,
+) -> dict:
     """
     Generate metadata for ITS_LIVE granule dataset.
 
     Args:
         url (str): URL to the ITS_LIVE granule dataset.
         store (Any, optional): Optional store for async reading. Defaults to None.
+        with_kerchunk (bool, optional): Also build the kerchunk references of the granule.
+        timer (StageTimer, optional): Records the time of each stage, bytes read and peak RSS of this granule.
+            It is returned as `timer` so `save_metadata` adds its own stage to the same record.
+        reader (str, optional): "xarray" to open the granule as an `xarray.Dataset`, or "h5py" to build the
+            metadata and kerchunk references from a single h5py open (`open_granule_h5`), in which case `ds`
+            is a `GranuleHeader`.
+        content (bytes-like, optional): The granule, already fetched, instead of reading it from `url`.
+        item_format (str, optional): "pystac" to return the STAC item as a `pystac.Item`, or "dict" to build it
+            directly as a dict (`create_stac_item_dict`), which is cheaper to build, pickle and serialize.
+        keep_dataset (bool, optional): Return the open dataset as `ds`. Otherwise it is closed before returning
+            (or raising) and `ds` is None, so batch workers don't keep every granule they read alive.
     """
-    if store:
-        ds, kerchunks = open_async_netcdf(url, store)
+    if item_format not in ('pystac', 'dict'):
+        raise ValueError(f'Unknown item format {item_format}, expected pystac or dict')
+    if reader == 'h5py':
+        ds, kerchunks = open_granule_h5(url, store=store, with_kerchunk=with_kerchunk, timer=timer, content=content)
+    elif reader != 'xarray':
+        raise ValueError(f'Unknown reader {reader}, expected xarray or h5py')
+    elif store:
+        ds, kerchunks = open_async_netcdf(url, store, timer=timer, with_kerchunk=with_kerchunk, content=content)
     else:
-        ds, kerchunks = open_netcdf(url, with_kerchunk=with_kerchunk)
+        ds, kerchunks = open_netcdf(url, with_kerchunk=with_kerchunk, timer=timer, content=content)
     if ds is None:
         raise ValueError(f'Could not open {url}')
 
-    geom = get_geom(ds, precision=4, projection=4326)
-    if geom is None:
-        raise ValueError(f'Could not extract geometry from {url}')
-    geom['url'] = url
-    item = create_stac_item(ds, geom, url)
-    # item.validate() # <- will break because the schema is wrong for the collection property.
-    nsidc_meta = generate_nsidc_metadata_files(ds, item.id, item.properties['version'])
-    nsidc_spatial = '\n'.join([f'{round(coord[0], 2)}\t{round(coord[1], 2)}' for coord in geom['corners']])
+    try:
+        with stage(timer, 'geometry'):
+            geom = get_geom(ds, precision=4, projection=4326)
+        if geom is None:
+            raise ValueError(f'Could not extract geometry from {url}')
+        geom['url'] = url
+        with stage(timer, 'stac'):
+            item = create_stac_item(ds, geom, url) if item_format == 'pystac' else create_stac_item_dict(ds, geom, url)
+        # item.validate() # <- will break because the schema is wrong for the collection property.
+        item_id, properties = (
+            (item.id, item.properties) if item_format == 'pystac' else (item['id'], item['properties'])
+        )
+        with stage(timer, 'nsidc'):
+            nsidc_meta = generate_nsidc_metadata_files(ds, item_id, properties['version'])
+            nsidc_spatial = '\n'.join([f'{round(coord[0], 2)}\t{round(coord[1], 2)}' for coord in geom['corners']])
+    finally:
+        if not keep_dataset:
+            ds.close()
     return {
-        'ds': ds,
+        'ds': ds if keep_dataset else None,
         'url': url,
         'stac': item,
         'kerchunk': kerchunks,
         'nsidc_meta': nsidc_meta.strip().replace(' ', '') + '\n',
         'nsidc_spatial': nsidc_spatial + '\n',
+        'timer': timer,
     }
 
 
-def save_metadata(metadata: dict, outdir: str = '.') -> tuple[str, str, str, str]:
-    """Save STAC item to filesystem or S3"""
-    fs = fsspec.filesystem(outdir.split('://')[0] if '://' in outdir else 'file')
-    stac_id = metadata['stac'].id
+# Threads writing the sidecar files of remote outdirs, shared by every `save_metadata` call of the process
+SAVE_THREADS = 16
+_save_pool = None
+_save_pool_lock = threading.Lock()
+
+
+def get_save_pool() -> ThreadPoolExecutor:
+    """The process-wide pool `save_metadata` writes the sidecars of remote outdirs concurrently with."""
+    global _save_pool
+    if _save_pool is None:
+        with _save_pool_lock:
+            if _save_pool is None:
+                _save_pool = ThreadPoolExecutor(max_workers=SAVE_THREADS, thread_name_prefix='save-metadata')
+    return _save_pool
+
+
+@functools.lru_cache(maxsize=None)
+def get_output_filesystem(protocol: str) -> fsspec.AbstractFileSystem:
+    """The filesystem sidecars are written with for `protocol`, created once per process."""
+    return fsspec.filesystem(protocol)
+
+
+def save_metadata(
+    metadata: dict, outdir: str = '.', kerchunk_format: str = 'json', compact: bool = False
+) -> tuple[str, str, str, str]:
+    """
+    Save STAC item to filesystem or S3
+
+    The STAC item in `metadata` can be a `pystac.Item` or a dict from `create_stac_item_dict`. The kerchunk
+    references, when present, are written as `<id>.ref.json` or, with `kerchunk_format='parquet'`, as a
+    `<id>.ref.parquet` reference store.
+
+    The filesystem of each protocol is reused across calls (`get_output_filesystem`). For remote outdirs the
+    sidecar files are written concurrently (`get_save_pool`), so a granule costs about one PUT latency instead of
+    one per file. With `compact`, the STAC item and kerchunk JSON files are written without indentation.
+    """
+    if kerchunk_format not in ('json', 'parquet'):
+        raise ValueError(f'Unknown kerchunk format {kerchunk_format}, expected json or parquet')
+    with stage(metadata.get('timer'), 'save'):
+        return _save_metadata(metadata, outdir, kerchunk_format, compact)
+
+
+def _write_file(fs: fsspec.AbstractFileSystem, path: str, content: bytes):
+    with fs.open(path, 'wb') as f:
+        f.write(content)
+
+
+def _save_metadata(metadata: dict, outdir: str, kerchunk_format: str, compact: bool) -> tuple[str, str, str, str]:
+    protocol = outdir.split('://')[0] if '://' in outdir else 'file'
+    fs = get_output_filesystem(protocol)
+    item = metadata['stac'] if isinstance(metadata['stac'], dict) else metadata['stac'].to_dict()
+    stac_id = item['id']
 
     if outdir.startswith('s3'):
-        stac_s3_url = metadata['stac'].assets.get('data').extra_fields.get('alternate', [])['s3']['href']
+        stac_s3_url = item['assets']['data']['alternate']['s3']['href']
         granule_path = '/'.join(stac_s3_url.split('/')[0:-1])
-    else:
+    elif protocol == 'file':
         granule_path = Path(outdir)
+    else:
+        granule_path = outdir.rstrip('/')
 
     logging.info(f'Saving metadata to {granule_path}')
 
     stac_item = f'{granule_path}/{stac_id}.stac.json'
-    with fs.open(stac_item, 'w') as f:
-        json.dump(metadata['stac'].to_dict(), f, indent=2)
-
     premet = f'{granule_path}/{stac_id}.nc.premet'
-    with fs.open(premet, 'w') as f:
-        f.write(metadata['nsidc_meta'])
-
     spatial = f'{granule_path}/{stac_id}.nc.spatial'
-    with fs.open(spatial, 'w') as f:
-        f.write(metadata['nsidc_spatial'])
+    writes = [
+        functools.partial(_write_file, fs, stac_item, stac_item_json(item, indent=not compact)),
+        functools.partial(_write_file, fs, premet, metadata['nsidc_meta'].encode()),
+        functools.partial(_write_file, fs, spatial, metadata['nsidc_spatial'].encode()),
+    ]
 
-    kerchunk = f'{granule_path}/{stac_id}.ref.json'
-    if metadata['kerchunk'] is not None:
-        with fs.open(kerchunk, 'w') as f:
-            json.dump(metadata['kerchunk'], f, indent=2)
+    if kerchunk_format == 'parquet':
+        kerchunk = f'{granule_path}/{stac_id}.ref.parquet'
+        if metadata['kerchunk'] is not None:
+            writes.append(functools.partial(write_parquet_references, metadata['kerchunk'], kerchunk, fs=fs))
+    else:
+        kerchunk = f'{granule_path}/{stac_id}.ref.json'
+        if metadata['kerchunk'] is not None:
+            refs = (
+                orjson.dumps(metadata['kerchunk']) if compact else json.dumps(metadata['kerchunk'], indent=2).encode()
+            )
+            writes.append(functools.partial(_write_file, fs, kerchunk, refs))
+
+    if protocol == 'file':
+        for write in writes:
+            write()
+    else:
+        # result() re-raises the first failed write, after every write was submitted
+        for future in [get_save_pool().submit(write) for write in writes]:
+            future.result()
 
     return stac_item, premet, spatial, kerchunk
 
 
+def iter_granule_urls(source: str) -> Iterator[str]:
+    """
+    Granule URIs listed one per line in the file `source`, or in stdin when `source` is `-`.
+
+    Blank lines and lines starting with `#` are skipped. URIs are yielded as they are read, so a list piped from
+    another command is processed while it is still being written.
+    """
+    if source == '-':
+        yield from _granule_lines(sys.stdin)
+        return
+    with open(source) as f:
+        yield from _granule_lines(f)
+
+
+def _granule_lines(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        url = line.strip()
+        if url and not url.startswith('#'):
+            yield url
+
+
+class CombinedWriter:
+    """
+    Writes STAC items to a single file as they are generated: stac-geoparquet when `path` ends with `.parquet`,
+    NDJSON otherwise.
+
+    Parquet items are buffered and written by `rustac.GeoparquetWriter` in batches of `batch_size`, driven on a
+    private event loop since its methods are coroutines. NDJSON lines are written as they come.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.count = 0
+        self._parquet = path.endswith('.parquet')
+        self._batch = []
+        self._writer = None
+        if self._parquet:
+            self._loop = asyncio.new_event_loop()
+        else:
+            # kept open for the life of the writer, which closes it in close()/__exit__
+            self._file = fsspec.open(path, 'wb').open()
+
+    def write(self, item: dict):
+        self.count += 1
+        if not self._parquet:
+            self._file.write(stac_item_json(item) + b'\n')
+            return
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+
+        async def write():
+            if self._writer is None:
+                self._writer = await rustac.GeoparquetWriter.open(batch, self.path)
+            else:
+                await self._writer.write(batch)
+
+        self._loop.run_until_complete(write())
+
+    def close(self):
+        if not self._parquet:
+            self._file.close()
+            return
+        if self._batch:
+            self._flush()
+        if self._writer is not None:
+
+            async def finish():
+                await self._writer.finish()
+
+            self._loop.run_until_complete(finish())
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def generate_many(
+    urls: Iterable[str],
+    outdir: str = '.',
+    workers: int = 4,
+    kerchunk_format: str | None = None,
+    reader: str = 'h5py',
+    combined: str | None = None,
+    stac_server: str | None = None,
+    collection: str = 'itslive-granules',
+    compact: bool = False,
+) -> dict:
+    """
+    Generate and save the metadata of many granules concurrently, writing their outputs as each one finishes.
+
+    Granules are generated and their sidecars saved (`save_metadata`) in a pool of `workers` threads, with at
+    most twice as many granules in flight, so `urls` can be a stream (`iter_granule_urls`) of any length. The
+    run shares one read filesystem per protocol (local granules are memory-mapped), the cached transformers of
+    `get_transformer` and, when ingesting, one HTTP session. A granule that fails is logged and counted and the
+    run goes on.
+
+    Args:
+        urls (Iterable[str]): Granule URIs, local paths, s3:// or https:// URLs.
+        outdir (str): Directory, local or s3://, the sidecar files are written to.
+        workers (int): Granules processed at once.
+        kerchunk_format (str, optional): Also write the kerchunk references, as "json" or "parquet".
+        reader (str): "h5py" (default) or "xarray", see `generate_itslive_metadata`.
+        combined (str, optional): Also write every STAC item to this file, as stac-geoparquet when it ends with
+            `.parquet` and as NDJSON otherwise.
+        stac_server (str, optional): Ingest every STAC item into `collection` of this STAC server.
+        collection (str): Collection the items are ingested into.
+        compact (bool): Write the STAC item and kerchunk JSON sidecars without indentation.
+
+    Returns:
+        dict: The number of granules `done` and `failed`.
+    """
+    # s3 granules are read through one anonymous filesystem; http(s) ones through fsspec's cached instance
+    s3 = fsspec.filesystem('s3', anon=True)
+
+    def process(url: str) -> dict:
+        metadata = generate_itslive_metadata(
+            url,
+            store=s3 if url.startswith('s3://') else None,
+            with_kerchunk=kerchunk_format is not None,
+            reader=reader,
+            item_format='dict',
+            keep_dataset=False,
+        )
+        save_metadata(metadata, outdir, kerchunk_format=kerchunk_format or 'json', compact=compact)
+        return metadata['stac']
+
+    counts = {'done': 0, 'failed': 0}
+    writer = CombinedWriter(combined) if combined else None
+    session = requests.Session() if stac_server else None
+    urls = iter(urls)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            while True:
+                for url in urls:
+                    pending[pool.submit(process, url)] = url
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    url = pending.pop(future)
+                    try:
+                        item = future.result()
+                        if writer is not None:
+                            writer.write(item)
+                        if session is not None:
+                            post_item(stac_server, collection, item, session=session)
+                    except Exception as e:
+                        counts['failed'] += 1
+                        logging.error(f'Failed to process {url}: {e}')
+                        continue
+                    counts['done'] += 1
+                    logging.info(f'Done processing {url}')
+    finally:
+        if writer is not None:
+            writer.close()
+        if session is not None:
+            session.close()
+    logging.info(f'Processed {counts["done"]} granules, {counts["failed"]} failed')
+    return counts
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Generate metadata sidecar files for ITS_LIVE granules')
-    parser.add_argument('-g', '--granule', required=True, help='Path to a single ITS_LIVE NetCDF file')
+    granules = parser.add_mutually_exclusive_group(required=True)
+    granules.add_argument('-g', '--granule', help='Path to a single ITS_LIVE NetCDF file')
+    granules.add_argument(
+        '--granules',
+        help='File listing granule URIs, one per line, or - to read them from stdin; they are processed concurrently',
+    )
     parser.add_argument('-o', '--outdir', required=True, help='Output directory')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Granules processed at once with --granules')
+    parser.add_argument(
+        '--combined',
+        help='With --granules, also write every STAC item to this file (stac-geoparquet if it ends with .parquet, '
+        'NDJSON otherwise)',
+    )
+    parser.add_argument('-c', '--collection', default='itslive-granules', help='STAC collection to ingest into')
 
     parser.add_argument(
         '-i',
         '--ingest',
         action='store_true',
-        help='Path to the input file (optional)',
-        default=None,  # Default value if not provided
+        help='Ingest the generated STAC items into --collection of --target',
     )
     parser.add_argument('-t', '--target', help='STAC endpoint')
+    parser.add_argument(
+        '-k',
+        '--kerchunk',
+        choices=['json', 'parquet'],
+        help='Also write the kerchunk references of the granule, as JSON or as a parquet reference store',
+    )
+    parser.add_argument(
+        '--compact', action='store_true', help='Write the STAC item and kerchunk JSON files without indentation'
+    )
+    parser.add_argument(
+        '--reader',
+        choices=['xarray', 'h5py'],
+        default='h5py',
+        help='Read metadata and references from a single h5py open (default), or open the granule with xarray',
+    )
     parser.add_argument(
         '-r',
         '--reload-collection',
@@ -579,15 +1146,35 @@ def main():
     )
     args = parse_args()
 
+    if args.ingest and args.reload_collection:
+        post_collection(args.target)
+
+    if args.granules:
+        counts = generate_many(
+            iter_granule_urls(args.granules),
+            args.outdir,
+            workers=args.workers,
+            kerchunk_format=args.kerchunk,
+            reader=args.reader,
+            combined=args.combined,
+            stac_server=args.target if args.ingest else None,
+            collection=args.collection,
+            compact=args.compact,
+        )
+        if counts['failed']:
+            sys.exit(1)
+        return
+
     logging.info(f'Processing {args.granule}')
-    metadata = generate_itslive_metadata(args.granule, store=None)  # not async
-    save_metadata(metadata, args.outdir)
+    metadata = generate_itslive_metadata(
+        args.granule, store=None, with_kerchunk=args.kerchunk is not None, reader=args.reader
+    )  # not async
+    save_metadata(metadata, args.outdir, kerchunk_format=args.kerchunk or 'json', compact=args.compact)
 
     logging.info(f'Done processing {args.granule}')
 
     if args.ingest:
-        stac_item = Path(args.outdir) / Path(metadata['stac'].id).name.replace('.nc', '.stac.json')
-        ingest_item(args.reload_collection, args.target, str(stac_item))
+        post_item(args.target, args.collection, metadata['stac'].to_dict())
         logging.info(f'Ingested {metadata["stac"].id}')
 
 
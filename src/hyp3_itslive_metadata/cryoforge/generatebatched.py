@@ -1,12 +1,18 @@
 import argparse
+import asyncio
+import json
 import logging
+import multiprocessing
 import os
 import re
 import warnings
 from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import fsspec
 import orjson
 import pyarrow.fs as pafs
 import pyarrow.parquet as pq
@@ -15,12 +21,23 @@ from dask.distributed import Client, LocalCluster, as_completed
 from distributed import WorkerPlugin
 from tqdm import tqdm
 
-from .generate import generate_itslive_metadata
-from .tooling import trim_memory
+from .deadletter import DEAD_LETTERS_FILENAME, RETRIES, DeadLetterWriter, dead_letter, generate_with_retries
+from .fetch import AdaptiveLimiter, AsyncFetcher, HedgedReader
+from .generate import generate_itslive_metadata, stac_item_json
+from .shards import read_shard
+from .timing import TIMINGS_FILENAME, StageTimer, write_timings
+from .tooling import HedgedReadPlugin, ReadLimiterPlugin, RecyclePlugin, read_limits, trim_workers, worker_metrics
+from .workqueue import LEASE_SECONDS, check_lease, open_queue, run_worker
 
 
 os.environ['PYTHONUNBUFFERED'] = '1'
 
+# Progress ledger of a row group, next to its ndjson files
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+# Remote directory of the parts of the ndjson files appended between checkpoint saves
+CHECKPOINT_PARTS = 'checkpoint_parts'
+
 
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -44,6 +61,8 @@ class FSReadWorkerPlugin(WorkerPlugin):
             self.fs_read = S3Store(
                 bucket='its-live-data', region='us-west-2', client_options={'timeout': '90s'}, skip_signature=True
             )
+        elif fs_type == 'local':
+            self.fs_read = fsspec.filesystem('file')
 
     def setup(self, worker):
         worker.fs_read = self.fs_read
@@ -84,7 +103,22 @@ def get_files(pf: pq.ParquetFile, row_group_index: int = 0):
     return files
 
 
-def generate_stac_metadata(full_uri: str):
+def get_shard_files(manifest: str, shard: int) -> list:
+    """Files of one shard of a manifest written by `shards.write_manifest`, as (prefix, filename, year) tuples."""
+    storage_options = {'anon': True} if manifest.startswith('s3://') else None
+    table = read_shard(manifest, shard, columns=['prefix', 'path'], storage_options=storage_options)
+    return [
+        (prefix, path, get_mid_date_from_filename(path)[0:4])
+        for prefix, path in zip(table['prefix'].to_pylist(), table['path'].to_pylist())
+    ]
+
+
+def generate_stac_metadata(full_uri: str, retries: int = RETRIES):
+    """
+    Generate the serialized STAC item of a granule on a dask worker, retrying transient errors `retries` times.
+
+    A granule that fails returns its dead letter (`deadletter.dead_letter`) as `dead_letter`.
+    """
     from distributed import get_worker
 
     worker = get_worker()
@@ -92,11 +126,42 @@ def generate_stac_metadata(full_uri: str):
         fs = get_worker().fs_read
     else:
         fs = s3fs.S3FileSystem(anon=True)
+
+    def generate(timer):
+        item = generate_itslive_metadata(
+            full_uri, fs, timer=timer, reader='h5py', item_format='dict', keep_dataset=False
+        )['stac']
+        # serialized on the worker: bytes are cheaper to send back than pickled pystac objects
+        return stac_item_json(item)
+
+    metadata, timer, letter = generate_with_retries(full_uri, generate, retries=retries)
+    return {
+        'metadata': metadata,
+        'url': full_uri,
+        'error': letter and letter['error'],
+        'timing': timer.record(),
+        'dead_letter': letter,
+    }
+
+
+def parse_granule(full_uri: str, content, fetch_seconds: float, reader: str = 'h5py'):
+    """Generate the STAC item of a granule fetched by `fetch.AsyncFetcher`, like `generate_stac_metadata`."""
+    timer = StageTimer(full_uri)
+    timer.add('fetch', fetch_seconds)
+    timer.add_bytes(memoryview(content).nbytes)
     try:
-        metadata = generate_itslive_metadata(full_uri, fs)['stac']
-        return {'metadata': metadata, 'url': full_uri, 'error': None}
+        metadata = generate_itslive_metadata(
+            full_uri, timer=timer, reader=reader, content=content, item_format='dict', keep_dataset=False
+        )
+        return {'metadata': stac_item_json(metadata['stac']), 'url': full_uri, 'error': None, 'timing': timer.record()}
     except Exception as e:
-        return {'metadata': None, 'url': full_uri, 'error': str(e)}
+        # the granule is already in memory: parsing it again would fail the same way
+        letter = dead_letter(full_uri, e, timer.failed_stage, seconds=sum(timer.stages.values()))
+        return {'metadata': None, 'url': full_uri, 'error': str(e), 'timing': timer.record(), 'dead_letter': letter}
+
+
+def granule_uri(prefix: str, filename: str) -> str:
+    return f's3://its-live-data/{prefix.rstrip("/")}/{filename}'
 
 
 class BatchWriter:
@@ -125,13 +190,20 @@ class BatchWriter:
             # Open in append mode to support multiple writes
             self.file_handles[file_key] = open(file_path, 'ab')
 
-        # Write the item
-        self.file_handles[file_key].write(orjson.dumps(feature.to_dict()) + b'\n')
+        # Write the item, serialized by `generate_stac_metadata` or as a pystac Item
+        self.file_handles[file_key].write((feature if isinstance(feature, bytes) else stac_item_json(feature)) + b'\n')
         self.file_handles[file_key].flush()
         self.file_counts[file_key] += 1
         self.processed_count += 1
         return True
 
+    def path(self, file_key: str) -> Path:
+        return self.base_path / f'{file_key}.ndjson'
+
+    def flush(self):
+        for handle in self.file_handles.values():
+            handle.flush()
+
     def close(self):
         # Close all open file handles
         for handle in self.file_handles.values():
@@ -156,6 +228,150 @@ class BatchWriter:
         return self.processed_count
 
 
+class Checkpoint:
+    """
+    Durable progress of a row group, so a preempted task resumes instead of starting over.
+
+    The ledger (`checkpoint.json` in the writer's directory) holds the URLs whose items were written and, for
+    every `<prefix>/<year>.ndjson`, its size in bytes and item count at that point. It is saved every `every`
+    items, atomically, and synced to `remote`: each save uploads only the bytes appended to every ndjson file
+    since the previous one, as a part under `checkpoint_parts/` listed in the ledger, so a row group uploads its
+    items once instead of its growing files at every save. Parts are uploaded before the ledger, so it never
+    points past uploaded data. `restore` pulls them back, truncates each file to its recorded size and drops
+    files written after the last save, so nothing is written twice. Once the whole files are uploaded, `finish`
+    drops the parts.
+
+    Args:
+        writer (BatchWriter): Writer of the row group.
+        remote (str, optional): Directory (e.g. s3://) the ledger and ndjson files are synced to.
+        fs (fsspec.AbstractFileSystem, optional): Filesystem of `remote`, derived from it if not given.
+        every (int, optional): Items written between saves.
+    """
+
+    def __init__(self, writer: BatchWriter, remote: str | None = None, fs=None, every: int = 1000):
+        self.writer = writer
+        self.remote = remote.rstrip('/') if remote else None
+        self.fs = fs if fs is not None or remote is None else fsspec.core.url_to_fs(remote)[0]
+        self.every = every
+        self.path = writer.base_path / CHECKPOINT_FILENAME
+        self.done = set()
+        self.pending = 0
+        # start offsets of the uploaded parts of each file, and the bytes of each file they hold
+        self.parts = defaultdict(list)
+        self.synced = {}
+
+    def _remote_path(self, local: Path) -> str:
+        return f'{self.remote}/{local.relative_to(self.writer.base_path).as_posix()}'
+
+    def _part_path(self, file_key: str, start: int) -> str:
+        return f'{self.remote}/{CHECKPOINT_PARTS}/{file_key}/{start:015d}.part'
+
+    def _load(self) -> dict | None:
+        if not self.path.exists() and self.remote and self.fs.exists(self._remote_path(self.path)):
+            self.fs.get(self._remote_path(self.path), str(self.path))
+            state = json.loads(self.path.read_text())
+            for file_key, file in state['files'].items():
+                local = self.writer.path(file_key)
+                local.parent.mkdir(parents=True, exist_ok=True)
+                if 'parts' not in file:
+                    self.fs.get(self._remote_path(local), str(local))
+                    continue
+                with open(local, 'wb') as f:
+                    for start in file['parts']:
+                        f.write(self.fs.cat_file(self._part_path(file_key, start)))
+            logging.info(f'Downloaded checkpoint of {len(state["done"])} granules from {self.remote}')
+        return json.loads(self.path.read_text()) if self.path.exists() else None
+
+    def restore(self) -> set:
+        """Restore the ledger and the ndjson files to the last save, and return the URLs already written."""
+        state = self._load()
+        files = state['files'] if state else {}
+        for local in self.writer.base_path.rglob('*.ndjson'):
+            file_key = local.relative_to(self.writer.base_path).with_suffix('').as_posix()
+            if file_key not in files:
+                local.unlink()
+            elif local.stat().st_size < files[file_key]['offset']:
+                raise RuntimeError(f'{local} is shorter than its checkpoint; remove {self.path} to start over')
+            else:
+                os.truncate(local, files[file_key]['offset'])
+        missing = [file_key for file_key in files if not self.writer.path(file_key).exists()]
+        if missing:
+            raise RuntimeError(f'{missing} of the checkpoint are missing; remove {self.path} to start over')
+
+        self.done = set(state['done']) if state else set()
+        self.writer.file_counts.update({file_key: file['count'] for file_key, file in files.items()})
+        self.writer.processed_count = sum(file['count'] for file in files.values())
+        # a file synced whole (after `finish`) is uploaded again from its start as the first of its parts
+        for file_key, file in files.items():
+            if 'parts' in file:
+                self.parts[file_key] = list(file['parts'])
+                self.synced[file_key] = file['offset']
+        if state:
+            logging.info(f'Resuming after {len(self.done)} granules from {self.path}')
+        return self.done
+
+    def record(self, url: str):
+        """Mark the item of `url` as written, saving the ledger every `every` items."""
+        self.done.add(url)
+        self.pending += 1
+        if self.pending >= self.every:
+            self.save()
+
+    def _upload_parts(self, files: dict):
+        for file_key, file in files.items():
+            start = self.synced.get(file_key, 0)
+            if file['offset'] > start:
+                with open(self.writer.path(file_key), 'rb') as f:
+                    f.seek(start)
+                    content = f.read(file['offset'] - start)
+                part_path = self._part_path(file_key, start)
+                self.fs.makedirs(part_path.rsplit('/', 1)[0], exist_ok=True)
+                self.fs.pipe_file(part_path, content)
+                self.parts[file_key].append(start)
+                self.synced[file_key] = file['offset']
+            if self.parts.get(file_key):
+                file['parts'] = self.parts[file_key]
+
+    def _write_ledger(self, state: dict):
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.path)
+        if self.remote:
+            self.fs.makedirs(self.remote, exist_ok=True)
+            self.fs.put(str(self.path), self._remote_path(self.path))
+
+    def save(self):
+        # a task that lost the lease of its row group stops here, before it overwrites the new owner's files
+        check_lease()
+        self.writer.flush()
+        files = {
+            file_key: {'offset': self.writer.path(file_key).stat().st_size, 'count': count}
+            for file_key, count in self.writer.file_counts.items()
+        }
+        if self.remote:
+            self._upload_parts(files)
+        self._write_ledger({'done': sorted(self.done), 'files': files})
+        self.pending = 0
+
+    def finish(self):
+        """
+        Drop the parts, once the whole ndjson files of the last save were uploaded to `remote`.
+
+        The ledger then points at the whole files, and is uploaded before the parts are deleted.
+        """
+        if not self.remote or not self.path.exists():
+            return
+        state = json.loads(self.path.read_text())
+        for file in state['files'].values():
+            file.pop('parts', None)
+        self._write_ledger(state)
+        self.parts.clear()
+        self.synced.clear()
+        parts = f'{self.remote}/{CHECKPOINT_PARTS}'
+        if self.fs.exists(parts):
+            self.fs.rm(parts, recursive=True)
+
+
 def upload_group_row(
     group_path: Path,
     mission: str = 'sentinel2',
@@ -171,7 +387,7 @@ def upload_group_row(
 
     for root, _, files in os.walk(group_path):
         for file in files:
-            if file.endswith('.ndjson'):
+            if file.endswith('.ndjson') or file in (TIMINGS_FILENAME, CHECKPOINT_FILENAME, DEAD_LETTERS_FILENAME):
                 local_path = os.path.join(root, file)
                 rel_path = os.path.relpath(local_path, local_dir)
                 s3_path = f'{target.rstrip("/")}/{mission}/{row_path}/{rel_path}'
@@ -179,6 +395,201 @@ def upload_group_row(
                 print(f'Test - uploaded {local_path} → {s3_path}')
 
 
+def write_result(
+    writer: BatchWriter,
+    result: dict,
+    sources: dict,
+    checkpoint: Checkpoint | None = None,
+    dead_letters: DeadLetterWriter | None = None,
+) -> bool:
+    """Write the item of a granule result to the prefix/year of its URL, or log its error and write its dead letter."""
+    prefix, filename, year = sources[result['url']]
+    if result.get('metadata') is None:
+        logging.error(f'Failed to generate metadata for {prefix}, {year}, {filename}: {result["error"]}')
+        if dead_letters is not None:
+            dead_letters.write(result.get('dead_letter') or dead_letter(result['url'], result['error']))
+        return False
+    written = writer.write_item(result['metadata'], prefix, year, filename)
+    if written and checkpoint is not None:
+        checkpoint.record(result['url'])
+    return written
+
+
+def iter_windowed(client: Client, func, urls: Iterable[str], window: int) -> Iterator[dict]:
+    """
+    Run `func(url)` on a dask cluster with at most `window` tasks in flight, yielding results as they complete.
+
+    A new task is only submitted when one finishes, so the futures (and results) held by the client don't grow
+    with the number of `urls`. A task that raises (e.g. because its worker died) yields
+    `{'url', 'metadata': None, 'error', 'dead_letter'}` instead of stopping the run.
+    """
+    urls = iter(urls)
+    pending = {}
+    completed = as_completed()
+
+    def submit() -> bool:
+        for url in urls:
+            future = client.submit(func, url, pure=False)
+            pending[future] = url
+            completed.add(future)
+            return True
+        return False
+
+    for _ in range(window):
+        if not submit():
+            break
+
+    for future in completed:
+        url = pending.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            letter = dead_letter(url, e, stage='task')
+            result = {'metadata': None, 'url': url, 'error': str(e), 'timing': None, 'dead_letter': letter}
+        future.release()
+        submit()
+        yield result
+
+
+def process_files_async(
+    files: list,
+    writer: BatchWriter,
+    num_workers: int = 4,
+    max_concurrency: int = 128,
+    checkpoint: Checkpoint | None = None,
+    recycle_tasks: int | None = None,
+    adaptive_reads: int | None = None,
+    hedge_reads: float | None = None,
+    dead_letters: DeadLetterWriter | None = None,
+) -> list:
+    """
+    Generate and write the STAC items of `files` with the asyncio fetch engine instead of a dask cluster.
+
+    Granules are fetched with up to `max_concurrency` requests in flight, or with `adaptive_reads` as many as
+    a `fetch.AdaptiveLimiter` allows up to `adaptive_reads`, and parsed in a pool of `num_workers` processes,
+    each replaced by a new one after `recycle_tasks` granules. Up to a fraction `hedge_reads` of the requests,
+    the slowest, are hedged (`fetch.HedgedReader`), and fetches failing with transient errors are retried.
+    Written items are recorded in `checkpoint` and failed granules written to `dead_letters`.
+    Returns the timing records of the granules.
+    """
+    sources = {granule_uri(prefix, filename): (prefix, filename, year) for prefix, filename, year in files}
+    timings = []
+
+    async def run():
+        limiter = AdaptiveLimiter(maximum=adaptive_reads) if adaptive_reads else None
+        hedger = HedgedReader(max_rate=hedge_reads) if hedge_reads else None
+        fetcher = AsyncFetcher(
+            max_concurrency=max(max_concurrency, adaptive_reads or 0), limiter=limiter, hedger=hedger
+        )
+        # spawned rather than forked: the obstore runtime threads are already running when the pool starts
+        with (
+            ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                max_tasks_per_child=recycle_tasks,
+            ) as pool,
+            tqdm(total=len(sources), desc='STAC generation') as progress,
+        ):
+            async for result in fetcher.map(sources, parse_granule, pool, retries=RETRIES):
+                progress.update()
+                timings.append(result.get('timing'))
+                if 'exception' in result:
+                    error = result.pop('exception')
+                    result['dead_letter'] = dead_letter(result['url'], error, 'fetch', attempts=result['attempts'])
+                write_result(writer, result, sources, checkpoint, dead_letters)
+        if limiter is not None:
+            logging.info(f'Adaptive reads: {limiter.stats()}')
+        if hedger is not None:
+            logging.info(f'Hedged reads: {hedger.stats()}')
+
+    asyncio.run(run())
+    return timings
+
+
+def process_files_dask(
+    files: list,
+    writer: BatchWriter,
+    io_driver: str = 'fsspec',
+    num_workers: int = 4,
+    batch_size: int = 20000,
+    max_in_flight: int | None = None,
+    client: Client | None = None,
+    checkpoint: Checkpoint | None = None,
+    recycle_tasks: int | None = None,
+    recycle_memory: float | None = None,
+    adaptive_reads: int | None = None,
+    hedge_reads: float | None = None,
+    dead_letters: DeadLetterWriter | None = None,
+) -> list:
+    """
+    Generate and write the STAC items of `files` on a dask cluster.
+
+    At most `max_in_flight` granules (4 per worker thread by default) are submitted at once, and each item is
+    written as soon as its task completes, to the prefix/year of the URL it carries, and recorded in `checkpoint`.
+    Granules that fail after the retries of `generate_stac_metadata`, or can't be written, go to `dead_letters`.
+    The memory of the workers is trimmed every `batch_size` granules (`tooling.trim_workers`). Returns the timing
+    records of the granules.
+
+    Args:
+        client (Client, optional): Cluster to run on; a LocalCluster of `num_workers` processes is started
+            (and closed) when not given.
+        recycle_tasks (int, optional): Restart a worker of the LocalCluster after about this many granules.
+        recycle_memory (float, optional): Restart a worker of the LocalCluster once its RSS exceeds this many GiB
+            (see `tooling.RecyclePlugin`).
+        adaptive_reads (int, optional): Give each worker of the LocalCluster this many threads and let a
+            `fetch.AdaptiveLimiter` adjust its reads in flight up to it (see `tooling.ReadLimiterPlugin`).
+        hedge_reads (float, optional): Hedge up to this fraction of the reads of each worker of the LocalCluster,
+            the slowest (see `tooling.HedgedReadPlugin`).
+    """
+    sources = {granule_uri(prefix, filename): (prefix, filename, year) for prefix, filename, year in files}
+    threads_per_worker = adaptive_reads or 1
+    max_in_flight = max_in_flight or 4 * num_workers * threads_per_worker
+
+    own_client = client is None
+    if own_client:
+        from dask import config as cfg
+
+        cfg.set({'distributed.scheduler.worker-ttl': None})
+
+        client = Client(
+            LocalCluster(n_workers=num_workers, processes=True, threads_per_worker=threads_per_worker),
+            timeout='300s',
+            heartbeat_interval='60s',
+        )
+        print(f'Using Dask client with {num_workers} workers with I/O driver: {io_driver}')
+        read_plugin = FSReadWorkerPlugin(fs_type=io_driver)
+        client.register_plugin(read_plugin, name='fs_read_plugin')
+        if recycle_tasks or recycle_memory:
+            max_rss = int(recycle_memory * 2**30) if recycle_memory else None
+            client.register_plugin(RecyclePlugin(max_tasks=recycle_tasks, max_rss=max_rss))
+        if adaptive_reads:
+            client.register_plugin(ReadLimiterPlugin(maximum=adaptive_reads))
+        if hedge_reads:
+            client.register_plugin(HedgedReadPlugin(max_rate=hedge_reads))
+
+    timings = []
+    try:
+        results = iter_windowed(client, generate_stac_metadata, sources, window=max_in_flight)
+        for count, result in enumerate(tqdm(results, total=len(sources), desc='STAC generation'), start=1):
+            timings.append(result.get('timing'))
+            try:
+                write_result(writer, result, sources, checkpoint, dead_letters)
+            except Exception as e:
+                logging.error(f'Error processing {sources[result["url"]]}: {e}')
+                if dead_letters is not None:
+                    dead_letters.write(dead_letter(result['url'], e, stage='write'))
+            if count % batch_size == 0:
+                trim_workers(client)
+                if adaptive_reads and own_client:
+                    logging.info(f'Read limits of the workers: {read_limits(client)}')
+                if hedge_reads and own_client:
+                    logging.info(f'Reads hedged by the workers: {worker_metrics(client, "reads_hedged")}')
+    finally:
+        if own_client:
+            client.close()
+    return timings
+
+
 def process_row_group(
     file: str = '',
     row_group_index: int = 0,
@@ -186,10 +597,31 @@ def process_row_group(
     processes=False,
     num_workers: int = 4,
     batch_size: int = 20000,
+    max_concurrency: int = 128,
+    max_in_flight: int | None = None,
+    checkpoint_every: int = 1000,
+    manifest: bool = False,
+    use_batch_task_id: bool = True,
+    recycle_tasks: int | None = None,
+    recycle_memory: float | None = None,
+    adaptive_reads: int | None = None,
+    hedge_reads: float | None = None,
 ):
     """
     Process a row group containing potentially many files.
-    Breaks the row group into batches for distributed processing.
+    Granules are processed on a dask cluster with at most `max_in_flight` tasks at once (`process_files_dask`).
+    With `io_driver='async'`, granules are instead fetched by the asyncio engine (`process_files_async`)
+    with up to `max_concurrency` requests in flight.
+    Progress is checkpointed to the row group's output prefix every `checkpoint_every` items, and a restarted
+    task skips the granules already written.
+    Granules that still fail after in-run retries of transient errors are written to `dead_letters.jsonl`,
+    uploaded with the items, for `dead-letters retry`.
+    With `manifest`, `file` is a shard manifest from `shards.plan_shards` and `row_group_index` a shard id.
+    In a Coiled batch task `row_group_index` is the `COILED_BATCH_TASK_ID`, unless `use_batch_task_id` is False
+    (the index was claimed from a work queue, see `process_queue`).
+    Workers are restarted after `recycle_tasks` granules or once they use `recycle_memory` GiB.
+    With `adaptive_reads`, the reads in flight of each worker (or of the async engine) adapt to S3 up to it.
+    With `hedge_reads`, up to that fraction of the reads, those slower than the 95th percentile, are hedged.
     """
     # Get files to process for this row group
     if file.startswith('s3://'):
@@ -199,13 +631,16 @@ def process_row_group(
         fs = None
         prefix = file
 
-    if (task_id := int(os.environ.get('COILED_BATCH_TASK_ID', -1))) >= 0:
+    if use_batch_task_id and (task_id := int(os.environ.get('COILED_BATCH_TASK_ID', -1))) >= 0:
         row_group_index = task_id
 
     logging.info(f'Using bach id {row_group_index}')
 
-    pf = pq.ParquetFile(prefix, filesystem=fs)
-    files = get_files(pf, row_group_index)
+    if manifest:
+        files = get_shard_files(file, row_group_index)
+    else:
+        pf = pq.ParquetFile(prefix, filesystem=fs)
+        files = get_files(pf, row_group_index)
     if not files:
         logging.info(f'No files to process for row group {row_group_index}')
         return 0
@@ -213,66 +648,83 @@ def process_row_group(
     logging.info(f'Processing row group {row_group_index} with {len(files)} files')
 
     # Setup output directory
-    output_path = Path(f'output/row_group_{row_group_index}')
+    mission = 'sentinel1-extra'
+    target = 'its-live-data/test-space/cloud-experiments/catalog/'
+    row_path = f'shard_{row_group_index}' if manifest else f'row_group_{row_group_index}'
+    output_path = Path(f'output/{row_path}')
     writer = BatchWriter(output_path)
     writer.expected_count = len(files)
-    from dask import config as cfg
-
-    cfg.set({'distributed.scheduler.worker-ttl': None})
 
-    client = Client(
-        LocalCluster(n_workers=num_workers, processes=True, threads_per_worker=1),
-        timeout='300s',
-        heartbeat_interval='60s',
+    checkpoint = Checkpoint(
+        writer,
+        remote=f's3://{target.rstrip("/")}/{mission}/{row_path}',
+        fs=s3fs.S3FileSystem(anon=False),
+        every=checkpoint_every,
     )
-    print(f'Using Dask client with {num_workers} workers with I/O driver: {io_driver}')
-    read_plugin = FSReadWorkerPlugin(fs_type=io_driver)
-    client.register_worker_plugin(read_plugin, name='fs_read_plugin')
-
-    # Process in batches
-    total_batches = (len(files) + batch_size - 1) // batch_size
-    for batch_num in range(total_batches):
-        start_idx = batch_num * batch_size
-        end_idx = min((batch_num + 1) * batch_size, len(files))
-        batch_files = files[start_idx:end_idx]
-
-        logging.info(f'Processing batch {batch_num + 1}/{total_batches} with {len(batch_files)} files')
-
-        # Submit processing tasks
-        futures = []
-        for prefix, filename, year in batch_files:
-            full_uri = f's3://its-live-data/{prefix.rstrip("/")}/{filename}'
-            futures.append(client.submit(generate_stac_metadata, full_uri))
-
-        # Process each future as it completes (robust to failures)
-        batch_results = []
-        for future in tqdm(as_completed(futures), total=len(futures), desc='STAC generation'):
-            batch_results.append(future.result())
-
-        for result, (prefix, filename, year) in zip(batch_results, batch_files):
-            try:
-                if result['metadata'] is not None:
-                    writer.write_item(result['metadata'], prefix, year, filename)
-                else:
-                    logging.error(f'Failed to generate metadata for {prefix}, {year}, {filename}: {result["error"]}')
-            except Exception as e:
-                print(f'Error processing {prefix}, {year}, {filename}: {e}')
-
-        trim_memory()
+    done = checkpoint.restore()
+    files = [(prefix, filename, year) for prefix, filename, year in files if granule_uri(prefix, filename) not in done]
+    logging.info(f'{len(done)} granules already written, {len(files)} left')
+    # every granule not written yet is generated again, so earlier dead letters are dropped
+    dead_letters = DeadLetterWriter(output_path / DEAD_LETTERS_FILENAME, mode='w')
+
+    if io_driver == 'async':
+        timings = process_files_async(
+            files,
+            writer,
+            num_workers=num_workers,
+            max_concurrency=max_concurrency,
+            checkpoint=checkpoint,
+            recycle_tasks=recycle_tasks,
+            adaptive_reads=adaptive_reads,
+            hedge_reads=hedge_reads,
+            dead_letters=dead_letters,
+        )
+    else:
+        timings = process_files_dask(
+            files,
+            writer,
+            io_driver=io_driver,
+            num_workers=num_workers,
+            batch_size=batch_size,
+            max_in_flight=max_in_flight,
+            checkpoint=checkpoint,
+            recycle_tasks=recycle_tasks,
+            recycle_memory=recycle_memory,
+            adaptive_reads=adaptive_reads,
+            hedge_reads=hedge_reads,
+            dead_letters=dead_letters,
+        )
 
-    client.close()
+    checkpoint.save()
     writer.close()
+    dead_letters.close()
+    if dead_letters.count:
+        logging.warning(f'{dead_letters.count} granules failed, see {dead_letters.path} (dead-letters retry)')
     processed_count = writer.report()
-    upload_group_row(
-        output_path,
-        mission='sentinel1-extra',
-        row_path=f'row_group_{row_group_index}',
-        target='its-live-data/test-space/cloud-experiments/catalog/',
-    )
+    timings_path = write_timings(timings, output_path / TIMINGS_FILENAME)
+    logging.info(f'Wrote stage timings of {len(timings)} granules to {timings_path}')
+    check_lease()
+    upload_group_row(output_path, mission=mission, row_path=row_path, target=target)
+    checkpoint.finish()
     logging.info(f'Completed row group {row_group_index}')
     return processed_count
 
 
+def process_queue(queue: str, lease_seconds: float = LEASE_SECONDS, **kwargs) -> dict:
+    """
+    Process the row groups (or shards) claimed from a work queue until it is drained.
+
+    Every batch task runs the same command and pulls units from `queue` (see `workqueue.open_queue`) instead of
+    processing the one row group of its `COILED_BATCH_TASK_ID`; `kwargs` are passed to `process_row_group`.
+    A row group whose lease is lost stops at its next checkpoint save, before uploading anything.
+    """
+    return run_worker(
+        open_queue(queue),
+        lambda unit: process_row_group(row_group_index=int(unit), use_batch_task_id=False, **kwargs),
+        lease_seconds=lease_seconds,
+    )
+
+
 def generate_stac_catalog():
     parser = argparse.ArgumentParser(description='Generate ITS_LIVE STAC metadata')
     subparsers = parser.add_subparsers(dest='command', required=True)
@@ -282,13 +734,51 @@ def generate_stac_catalog():
     row_group_parser.add_argument(
         '-f', '--file-list', type=str, required=True, help='Parquet file containing a list of files to process'
     )
-    row_group_parser.add_argument('-i', '--row-group-index', type=int, help='Row group index to process')
+    row_group_parser.add_argument('-i', '--row-group-index', type=int, help='Row group index (or shard id) to process')
+    row_group_parser.add_argument(
+        '--manifest', action='store_true', help='The file list is a shard manifest (see plan-shards) and -i a shard id'
+    )
+    row_group_parser.add_argument(
+        '-d',
+        '--driver',
+        type=str,
+        default='fsspec',
+        help='Filesystem driver to use (fsspec, obstore or local), or async for the asyncio obstore engine',
+    )
     row_group_parser.add_argument(
-        '-d', '--driver', type=str, default='fsspec', help='Filesystem driver to use (fsspec or obstore)'
+        '-c', '--max-concurrency', type=int, default=128, help='Requests in flight with the async driver'
     )
     row_group_parser.add_argument('-w', '--workers', type=int, default=4, help='Dask workers per batch')
     row_group_parser.add_argument(
-        '-b', '--batch-size', type=int, default=20000, help='Processing batch size within row group'
+        '-b', '--batch-size', type=int, default=20000, help='Granules processed between memory trims'
+    )
+    row_group_parser.add_argument(
+        '-m', '--max-in-flight', type=int, help='Dask tasks submitted at once (default: 4 per worker)'
+    )
+    row_group_parser.add_argument(
+        '--checkpoint-every', type=int, default=1000, help='Items written between progress checkpoints'
+    )
+    row_group_parser.add_argument(
+        '--recycle-tasks', type=int, default=5000, help='Restart a worker after this many granules (0: never)'
+    )
+    row_group_parser.add_argument(
+        '--recycle-memory', type=float, help='Restart a dask worker once its RSS exceeds this many GiB'
+    )
+    row_group_parser.add_argument(
+        '--adaptive-reads',
+        type=int,
+        help='Adapt the reads in flight of each worker (threads) or of the async driver to S3, up to this many',
+    )
+    row_group_parser.add_argument(
+        '--hedge-reads',
+        type=float,
+        help='Duplicate reads slower than the 95th percentile, for up to this fraction of the reads (e.g. 0.05)',
+    )
+    row_group_parser.add_argument(
+        '-q', '--queue', help='Claim row groups (or shards) from this work queue instead of -i (see work-queue)'
+    )
+    row_group_parser.add_argument(
+        '--lease-seconds', type=float, default=LEASE_SECONDS, help='Lease of a claimed unit, renewed while it runs'
     )
 
     # Consolidation command
@@ -298,13 +788,42 @@ def generate_stac_catalog():
 
     args = parser.parse_args()
 
-    if args.command == 'process-row-group':
+    if args.command == 'process-row-group' and args.queue:
+        processed = process_queue(
+            args.queue,
+            lease_seconds=args.lease_seconds,
+            file=args.file_list,
+            io_driver=args.driver,
+            num_workers=args.workers,
+            batch_size=args.batch_size,
+            max_concurrency=args.max_concurrency,
+            max_in_flight=args.max_in_flight,
+            checkpoint_every=args.checkpoint_every,
+            manifest=args.manifest,
+            recycle_tasks=args.recycle_tasks or None,
+            recycle_memory=args.recycle_memory,
+            adaptive_reads=args.adaptive_reads,
+            hedge_reads=args.hedge_reads,
+        )
+        logging.info(
+            f'Processed {processed["done"]} units of {args.queue} '
+            f'({processed["failed"]} failed, {processed["lost"]} lost)'
+        )
+    elif args.command == 'process-row-group':
         processed_count = process_row_group(
             file=args.file_list,
             row_group_index=args.row_group_index,
             io_driver=args.driver,
             num_workers=args.workers,
             batch_size=args.batch_size,
+            max_concurrency=args.max_concurrency,
+            max_in_flight=args.max_in_flight,
+            checkpoint_every=args.checkpoint_every,
+            manifest=args.manifest,
+            recycle_tasks=args.recycle_tasks or None,
+            recycle_memory=args.recycle_memory,
+            adaptive_reads=args.adaptive_reads,
+            hedge_reads=args.hedge_reads,
         )
         logging.info(f'Processed {processed_count} files for row group {args.row_group_index}')
 
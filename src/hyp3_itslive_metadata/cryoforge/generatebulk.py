@@ -12,17 +12,35 @@ import orjson
 import s3fs
 from dask.distributed import Client, LocalCluster, progress
 
+from .deadletter import DEAD_LETTERS_FILENAME, RETRIES, DeadLetterWriter, generate_with_retries
 from .generate import generate_itslive_metadata
-from .tooling import list_s3_objects, trim_memory
+from .shards import shard_groups
+from .tooling import (
+    HedgedReadPlugin,
+    ReadLimiterPlugin,
+    RecyclePlugin,
+    list_s3_objects,
+    read_limits,
+    trim_workers,
+    worker_metrics,
+)
+from .workqueue import check_lease, open_queue, run_worker
 
 
-def generate_stac_metadata(url: str):
-    try:
-        metadata = generate_itslive_metadata(url)
-    except Exception as e:
-        logging.error(f'Failed to generate STAC metadata for {url}: {str(e)}')
-        return {}
-    return metadata['stac']
+def generate_stac_metadata(url: str, retries: int = RETRIES):
+    """
+    The STAC item of a granule as `{'item', 'dead_letter'}`, retrying transient errors `retries` times.
+
+    A granule that fails has no item and its dead letter (`deadletter.dead_letter`).
+    """
+    metadata, _, letter = generate_with_retries(
+        url,
+        lambda timer: generate_itslive_metadata(url, timer=timer, reader='h5py', keep_dataset=False)['stac'],
+        retries=retries,
+    )
+    if letter is not None:
+        logging.error(f'Failed to generate STAC metadata for {url}: {letter["error"]}')
+    return {'item': metadata, 'dead_letter': letter}
 
 
 # Configure logging
@@ -336,20 +354,116 @@ class RegionTracker:
                     logging.info('Failed to upload consolidated file to S3: %s', str(e))
 
 
-def generate_items(regions_path, workers=4, sync=False, batch_size=200, reingest=False):
+def shard_regions(regions_path, manifest, shard):
+    """The regions of `regions_path` in one shard of a manifest from `shards.plan_shards(..., group_by='region')`."""
+    storage_options = {'anon': True} if manifest.startswith('s3://') else None
+    return [
+        f'{regions_path.rstrip("/")}/{region}'
+        for region in shard_groups(manifest, shard, group_by='region', storage_options=storage_options)
+    ]
+
+
+def start_client(workers, recycle_tasks=None, recycle_memory=None, adaptive_reads=None, hedge_reads=None):
+    """
+    Start a LocalCluster whose workers restart after `recycle_tasks` tasks or `recycle_memory` GiB of RSS.
+
+    With `adaptive_reads`, workers have that many threads and their reads in flight adapt to S3 up to it. With
+    `hedge_reads`, workers hedge up to that fraction of their reads, the slowest (see `tooling.HedgedReadPlugin`).
+    """
+    client = Client(LocalCluster(n_workers=workers, threads_per_worker=adaptive_reads or 2))
+    if recycle_tasks or recycle_memory:
+        max_rss = int(recycle_memory * 2**30) if recycle_memory else None
+        client.register_plugin(RecyclePlugin(max_tasks=recycle_tasks, max_rss=max_rss))
+    if adaptive_reads:
+        client.register_plugin(ReadLimiterPlugin(maximum=adaptive_reads))
+    if hedge_reads:
+        client.register_plugin(HedgedReadPlugin(max_rate=hedge_reads))
+    return client
+
+
+def generate_items(
+    regions_path,
+    workers=4,
+    sync=False,
+    batch_size=200,
+    reingest=False,
+    manifest=None,
+    shard=None,
+    queue=None,
+    recycle_tasks=None,
+    recycle_memory=None,
+    adaptive_reads=None,
+    hedge_reads=None,
+):
+    """
+    Generate the STAC items of a region of the archive.
+
+    In a Coiled batch task the region is the `COILED_BATCH_TASK_ID`-th directory of `regions_path`. With a
+    `manifest` (from `shards.plan_shards(..., group_by='region')` over `regions_path`), the task (or `shard`)
+    instead processes every region of its shard, so tasks have about the same number of bytes to process.
+    With a `queue` of the manifest's shards (see `workqueue`), the task claims shards until the queue is drained.
+    Dask workers are restarted after `recycle_tasks` granules or once they use `recycle_memory` GiB, and with
+    `adaptive_reads` their reads in flight adapt to S3 and with `hedge_reads` slow reads are hedged
+    (see `start_client`).
+    """
     s3_read = s3fs.S3FileSystem(anon=True, client_kwargs={'region_name': 'us-west-2'})
     s3_write = s3fs.S3FileSystem(anon=False, client_kwargs={'region_name': 'us-west-2'})
 
-    if (task_id := int(os.environ.get('COILED_BATCH_TASK_ID', '-1'))) >= 0:
+    if queue:
+        if not manifest:
+            raise ValueError('A work queue needs the manifest of its shards')
+        client = start_client(
+            workers,
+            recycle_tasks=recycle_tasks,
+            recycle_memory=recycle_memory,
+            adaptive_reads=adaptive_reads,
+            hedge_reads=hedge_reads,
+        )
+
+        def process_shard(unit):
+            regions = shard_regions(regions_path, manifest, int(unit))
+            logging.info(f'Processing {len(regions)} regions of shard {unit}')
+            for current_region in regions:
+                check_lease()
+                generate_region_items(
+                    current_region, client, s3_write, sync=sync, batch_size=batch_size, reingest=reingest
+                )
+
+        processed = run_worker(open_queue(queue), process_shard)
+        logging.info(
+            f'Processed {processed["done"]} shards of {queue} ({processed["failed"]} failed, {processed["lost"]} lost)'
+        )
+        client.close()
+        return
+
+    task_id = int(os.environ.get('COILED_BATCH_TASK_ID', '-1'))
+    if manifest:
+        shard = task_id if task_id >= 0 else shard
+        regions = shard_regions(regions_path, manifest, shard)
+        logging.info(f'Processing {len(regions)} regions of shard {shard}')
+    elif task_id >= 0:
         region_paths = s3_read.ls(regions_path)
-        current_region = f's3://{region_paths[task_id]}' if task_id < len(region_paths) else None
+        regions = [f's3://{region_paths[task_id]}'] if task_id < len(region_paths) else []
     else:
-        current_region = regions_path
+        regions = [regions_path]
 
-    if not current_region:
+    if not regions:
         logging.info('No region to process')
         return
 
+    client = start_client(
+        workers,
+        recycle_tasks=recycle_tasks,
+        recycle_memory=recycle_memory,
+        adaptive_reads=adaptive_reads,
+        hedge_reads=hedge_reads,
+    )
+    for current_region in regions:
+        generate_region_items(current_region, client, s3_write, sync=sync, batch_size=batch_size, reingest=reingest)
+    client.close()
+
+
+def generate_region_items(current_region, client, s3_write, sync=False, batch_size=200, reingest=False):
     s3_target = 's3://its-live-data/test-space/stac_catalogs'
     region_id = os.path.relpath(current_region, start='s3://its-live-data/velocity_image_pair').strip('/')
     output_path = Path(region_id)
@@ -358,6 +472,13 @@ def generate_items(regions_path, workers=4, sync=False, batch_size=200, reingest
     region_tracker = RegionTracker(output_path, f'{s3_target}/{region_id}', s3_write)
     if sync:
         region_tracker.sync_remote_chunks_to_local()
+    # batches already processed are skipped, so their dead letters are kept unless the region is reingested
+    dead_letters = DeadLetterWriter(
+        output_path / DEAD_LETTERS_FILENAME,
+        mode='w' if reingest else 'a',
+        remote=f'{s3_target}/{region_id}/{DEAD_LETTERS_FILENAME}' if sync else None,
+        fs=s3_write,
+    )
 
     if reingest:
         region_tracker.metadata = {
@@ -370,7 +491,6 @@ def generate_items(regions_path, workers=4, sync=False, batch_size=200, reingest
         }
         region_tracker._save_metadata(sync_immediately=sync)
 
-    client = Client(LocalCluster(n_workers=workers, threads_per_worker=2))
     last_batch = region_tracker.metadata['last_batch']
     logging.info('Starting batch processing from batch %d', last_batch + 1)
 
@@ -382,11 +502,23 @@ def generate_items(regions_path, workers=4, sync=False, batch_size=200, reingest
         logging.info(f'Processing batch {batch_num} with {len(batch)} files')
         futures = [client.submit(generate_stac_metadata, url) for url in batch]
         progress(futures)
-        region_tracker.process_batch(batch_num, client.gather(futures), sync)
-        trim_memory()
+        results = client.gather(futures)
+        for result in results:
+            if result['dead_letter'] is not None:
+                dead_letters.write(result['dead_letter'])
+        if sync:
+            dead_letters.sync()
+        region_tracker.process_batch(batch_num, [result['item'] for result in results], sync)
+        trim_workers(client)
+        if any((limits := read_limits(client)).values()):
+            logging.info(f'Read limits of the workers: {limits}')
+        if any((hedged := worker_metrics(client, 'reads_hedged')).values()):
+            logging.info(f'Reads hedged by the workers: {hedged}')
 
-    client.close()
     region_tracker.consolidate_chunks(sync=sync)
+    dead_letters.close()
+    if dead_letters.count:
+        logging.warning(f'{dead_letters.count} granules of {region_id} failed, see {dead_letters.path}')
 
 
 def generate_stac_catalog():
@@ -396,6 +528,21 @@ def generate_stac_catalog():
     parser.add_argument('-b', '--batch', type=int, default=200, help='Batch size')
     parser.add_argument('-s', '--sync', action='store_true', help='Sync to S3')
     parser.add_argument('-r', '--reingest', action='store_true', help='Reset progress and reingest all data')
+    parser.add_argument('-m', '--manifest', help='Shard manifest of the regions of --path (see plan-shards)')
+    parser.add_argument('--shard', type=int, default=0, help='Shard of --manifest to process outside of Coiled')
+    parser.add_argument(
+        '--recycle-tasks', type=int, default=5000, help='Restart a worker after this many granules (0: never)'
+    )
+    parser.add_argument('--recycle-memory', type=float, help='Restart a worker once its RSS exceeds this many GiB')
+    parser.add_argument(
+        '--adaptive-reads', type=int, help='Adapt the reads in flight of each worker to S3, up to this many (threads)'
+    )
+    parser.add_argument(
+        '--hedge-reads',
+        type=float,
+        help='Duplicate reads slower than the 95th percentile, for up to this fraction of the reads (e.g. 0.05)',
+    )
+    parser.add_argument('-q', '--queue', help='Claim shards of --manifest from this work queue (see work-queue)')
 
     args = parser.parse_args()
 
@@ -405,6 +552,13 @@ def generate_stac_catalog():
         sync=args.sync,
         batch_size=args.batch,
         reingest=args.reingest,
+        manifest=args.manifest,
+        shard=args.shard,
+        queue=args.queue,
+        recycle_tasks=args.recycle_tasks or None,
+        recycle_memory=args.recycle_memory,
+        adaptive_reads=args.adaptive_reads,
+        hedge_reads=args.hedge_reads,
     )
 
 
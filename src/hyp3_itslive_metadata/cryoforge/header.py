@@ -0,0 +1,168 @@
+"""
+Metadata-only access to ITS_LIVE granules.
+
+Generating metadata only needs the global attributes, the `img_pair_info` and projection attributes and the
+first/last `x`/`y` coordinates of a granule. `GranuleHeader` holds exactly that and exposes the same attribute
+interface as the `xarray.Dataset` used by `generate.get_geom` and `generate.create_stac_item`, so it can be read
+with h5py from a few ranged requests instead of downloading and decoding the whole file.
+
+A header can also be flattened to a record (`GranuleHeader.to_record`) and read back (`GranuleHeader.from_record`),
+which is how `headercache` stores headers as parquet rows.
+"""
+
+import json
+
+import fsspec
+import h5py
+import numpy as np
+
+
+# Variables whose attributes are used for metadata generation
+HEADER_VARIABLES = ('img_pair_info', 'mapping', 'UTM_Projection', 'Polar_Stereographic')
+# Coordinates of which only the first and last values are kept
+HEADER_COORDINATES = ('x', 'y')
+
+# HDF5 dimension-scale and netCDF-4 bookkeeping attributes hidden by netCDF readers
+_INTERNAL_ATTRIBUTES = {
+    'CLASS',
+    'DIMENSION_LIST',
+    'NAME',
+    'REFERENCE_LIST',
+    '_Netcdf4Dimid',
+    '_Netcdf4Coordinates',
+    '_NCProperties',
+    '_nc3_strict',
+}
+
+
+def _clean_attrs(attrs) -> dict:
+    """Decode h5py attributes the way a netCDF reader would, unpacking single values."""
+    cleaned = {}
+    for key, value in attrs.items():
+        if key in _INTERNAL_ATTRIBUTES or isinstance(value, h5py.Reference):
+            continue
+        if isinstance(value, np.ndarray) and value.size == 1:
+            value = value.reshape(-1)[0]
+        if isinstance(value, bytes | np.bytes_):
+            value = value.decode('utf-8', errors='replace')
+        elif isinstance(value, np.generic):
+            value = value.item()
+        cleaned[key] = value
+    return cleaned
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def encode_attrs(attrs: dict) -> str:
+    """Attributes as JSON; arrays are written as lists and NaN is kept."""
+    return json.dumps(attrs, default=_json_default)
+
+
+def decode_attrs(text: str) -> dict:
+    """Attributes written by `encode_attrs`, with lists read back as numpy arrays."""
+    return {key: np.array(value) if isinstance(value, list) else value for key, value in json.loads(text).items()}
+
+
+class HeaderVariable:
+    """Attributes (and, for coordinates, the end values) of one granule variable."""
+
+    def __init__(self, attrs: dict, values: np.ndarray | None = None):
+        self.attrs = attrs
+        self.values = values
+
+    def __getattr__(self, name):
+        # Mirrors xarray, where `ds['img_pair_info'].date_dt` reads an attribute
+        try:
+            return self.__dict__['attrs'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class GranuleHeader:
+    """The subset of an ITS_LIVE granule needed to generate its metadata, with a Dataset-like interface."""
+
+    def __init__(self, attrs: dict, variables: dict, url: str = ''):
+        self.attrs = attrs
+        self.variables = variables
+        self.url = url
+
+    def __getitem__(self, name: str) -> HeaderVariable:
+        return self.variables[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.variables
+
+    def close(self):
+        """Nothing to release; present so a header can be used wherever a Dataset is closed."""
+
+    def to_record(self, etag: str | None = None) -> dict:
+        """
+        Flatten the header to a record of plain values, e.g. a parquet row.
+
+        The global attributes and the attributes of every variable are JSON strings (their names and types
+        differ between missions), and the end values of the coordinates are `<name>_values` lists.
+        Variables missing from the granule are `None`.
+        """
+        record = {'url': self.url, 'etag': etag, 'attrs': encode_attrs(self.attrs)}
+        for name in HEADER_VARIABLES + HEADER_COORDINATES:
+            record[name] = encode_attrs(self.variables[name].attrs) if name in self.variables else None
+        for name in HEADER_COORDINATES:
+            values = self.variables[name].values if name in self.variables else None
+            record[f'{name}_values'] = None if values is None else np.asarray(values).tolist()
+        return record
+
+    @classmethod
+    def from_record(cls, record: dict) -> 'GranuleHeader':
+        """The header of a record written by `to_record`."""
+        variables = {}
+        for name in HEADER_VARIABLES + HEADER_COORDINATES:
+            if record.get(name) is not None:
+                values = record.get(f'{name}_values')
+                variables[name] = HeaderVariable(
+                    decode_attrs(record[name]), values=None if values is None else np.asarray(values)
+                )
+        return cls(decode_attrs(record['attrs']), variables, url=record.get('url') or '')
+
+    @classmethod
+    def from_h5(cls, h5file: h5py.File, url: str = '') -> 'GranuleHeader':
+        """Read the header from an open HDF5/netCDF-4 file, touching only the coordinate end chunks."""
+        variables = {}
+        for name in HEADER_VARIABLES:
+            if name in h5file:
+                variables[name] = HeaderVariable(_clean_attrs(h5file[name].attrs))
+        for name in HEADER_COORDINATES:
+            if name in h5file:
+                coordinate = h5file[name]
+                variables[name] = HeaderVariable(
+                    _clean_attrs(coordinate.attrs), values=np.array([coordinate[0], coordinate[-1]])
+                )
+        return cls(_clean_attrs(h5file.attrs), variables, url=url)
+
+
+def read_granule_header(url: str, fs=None, block_size: int = 2**20) -> GranuleHeader:
+    """
+    Read a granule header with ranged requests instead of downloading the granule.
+
+    Args:
+        url (str): Local path, s3:// or https:// URL of the granule.
+        fs (fsspec.AbstractFileSystem, optional): Filesystem to open `url` with. Defaults to an anonymous
+            filesystem for the URL's protocol.
+        block_size (int, optional): Size of the cached blocks fetched from remote storage.
+    """
+    open_kwargs = {'mode': 'rb', 'cache_type': 'blockcache', 'block_size': block_size}
+    if fs is not None:
+        opened = fs.open(url, **open_kwargs)
+    else:
+        storage_options = {'anon': True} if url.startswith('s3://') else {}
+        opened = fsspec.open(url, **open_kwargs, **storage_options)
+
+    with opened as f, h5py.File(f, mode='r') as h5file:
+        return GranuleHeader.from_h5(h5file, url=url)
@@ -0,0 +1,241 @@
+"""
+Parquet cache of granule headers.
+
+Generating STAC items, NSIDC files or footprints only needs the header of a granule (see `header.GranuleHeader`):
+its global attributes, the `img_pair_info` and projection attributes and the end values of `x`/`y`.
+`build_header_cache` reads the headers of many granules once, with ranged requests, and writes them to one
+parquet file with a row per granule, keyed by URL and ETag:
+
+    build_header_cache(urls, 'headers.parquet')
+
+Rebuilding the cache with `previous=` only re-reads the granules whose ETag changed, and a change to the STAC
+item schema becomes a CPU-only pass over the cache instead of another crawl of the archive:
+
+    stac_items_from_cache('headers.parquet', 'items.ndjson')
+"""
+
+import argparse
+import logging
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import fsspec
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .generate import create_stac_item_dicts, get_geom, stac_item_json
+from .header import HEADER_COORDINATES, HEADER_VARIABLES, GranuleHeader, read_granule_header
+
+
+logger = logging.getLogger(__name__)
+
+HEADER_CACHE_SCHEMA = pa.schema(
+    [
+        ('url', pa.string()),
+        ('etag', pa.string()),
+        ('attrs', pa.string()),
+        *[(name, pa.string()) for name in HEADER_VARIABLES + HEADER_COORDINATES],
+        *[(f'{name}_values', pa.list_(pa.float64())) for name in HEADER_COORDINATES],
+    ]
+)
+
+
+def _filesystem(url: str, storage_options: dict | None = None):
+    if storage_options is None:
+        storage_options = {'anon': True} if url.startswith('s3://') else {}
+    fs, _ = fsspec.core.url_to_fs(url, **storage_options)
+    return fs
+
+
+def granule_etag(fs, url: str) -> str:
+    """
+    The ETag of a granule on S3; for other filesystems, `fs.ukey` (for local files, derived from size and mtime).
+
+    s3fs doesn't override `ukey`, whose default hashes the whole `info()` entry, and that differs between a
+    listing and a HEAD response of the same object, so S3 granules are keyed by the ETag of their entry instead.
+    """
+    protocols = (fs.protocol,) if isinstance(fs.protocol, str) else fs.protocol
+    if 's3' in protocols:
+        return fs.info(url)['ETag'].strip('"')
+    return str(fs.ukey(url))
+
+
+def iter_header_records(path: str, batch_size: int = 10_000, storage_options: dict | None = None) -> Iterator[list]:
+    """Stream the records of a header cache in batches of `batch_size` rows."""
+    with fsspec.open(path, 'rb', **(storage_options or {})) as f:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+
+
+def read_cached_headers(path: str, urls: Iterable[str] | None = None, storage_options: dict | None = None) -> dict:
+    """
+    Read headers from a cache.
+
+    Returns:
+        dict: `{url: GranuleHeader}` of all the cached granules, or only of `urls` when given.
+    """
+    fs, path = fsspec.core.url_to_fs(path, **(storage_options or {}))
+    filters = None if urls is None else [('url', 'in', list(urls))]
+    table = pq.read_table(path, filesystem=fs, filters=filters)
+    return {record['url']: GranuleHeader.from_record(record) for record in table.to_pylist()}
+
+
+def build_header_cache(
+    urls: Iterable[str],
+    output: str,
+    previous: str | None = None,
+    max_workers: int = 16,
+    row_group_size: int = 10_000,
+    storage_options: dict | None = None,
+) -> dict:
+    """
+    Read the headers of `urls` and write them to a parquet cache at `output`.
+
+    Granules are read concurrently with ranged requests (`header.read_granule_header`), each with the filesystem
+    of its protocol, and at most `2 * max_workers` at a time are queued. Rows of a `previous` cache (which can be
+    `output` itself) are reused when the granule's ETag has not changed. Granules that can't be read are logged
+    and left out of the cache. The cache is written next to `output` and only moved over it once complete.
+
+    Args:
+        urls (Iterable[str]): Local paths or s3:// URLs of the granules.
+        output (str): Local or s3:// path of the cache.
+        previous (str, optional): Existing cache to update.
+        max_workers (int, optional): Granules read at once.
+        row_group_size (int, optional): Rows per parquet row group.
+        storage_options (dict, optional): Options of the filesystem of the granules, anonymous S3 by default.
+
+    Returns:
+        dict: the number of granules `extracted`, `reused` from `previous` and `failed`.
+    """
+    urls = list(dict.fromkeys(urls))
+    counts = {'extracted': 0, 'reused': 0, 'failed': 0}
+
+    cached = {}
+    if previous is not None and fsspec.core.url_to_fs(previous)[0].exists(previous):
+        cached = {record['url']: record for batch in iter_header_records(previous) for record in batch}
+        logger.info(f'Loaded {len(cached)} cached headers from {previous}')
+
+    filesystems = {}
+    for url in urls:
+        protocol = fsspec.core.split_protocol(url)[0]
+        if protocol not in filesystems:
+            filesystems[protocol] = _filesystem(url, storage_options)
+
+    def extract(url: str):
+        try:
+            fs = filesystems[fsspec.core.split_protocol(url)[0]]
+            etag = granule_etag(fs, url)
+            record = cached.get(url)
+            if record is not None and record['etag'] == etag:
+                return record, 'reused'
+            return read_granule_header(url, fs=fs).to_record(etag=etag), 'extracted'
+        except Exception as e:
+            logger.error(f'Failed to read the header of {url}: {e}')
+            return None, 'failed'
+
+    # a crash mid-run leaves the previous cache, which may be `output`, as it was
+    output_fs, output_path = fsspec.core.url_to_fs(output)
+    partial = f'{output_path}.partial'
+    rows = []
+    try:
+        with (
+            output_fs.open(partial, 'wb') as f,
+            pq.ParquetWriter(f, HEADER_CACHE_SCHEMA) as writer,
+            ThreadPoolExecutor(max_workers=max_workers) as pool,
+        ):
+            remaining = iter(urls)
+            pending = set()
+            while True:
+                for url in remaining:
+                    pending.add(pool.submit(extract, url))
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record, status = future.result()
+                    counts[status] += 1
+                    if record is not None:
+                        rows.append(record)
+                if len(rows) >= row_group_size:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=HEADER_CACHE_SCHEMA))
+                    rows = []
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=HEADER_CACHE_SCHEMA))
+    except BaseException:
+        if output_fs.exists(partial):
+            output_fs.rm(partial)
+        raise
+    output_fs.mv(partial, output_path)
+
+    logger.info(
+        f'Wrote {counts["extracted"] + counts["reused"]} headers to {output} '
+        f'({counts["extracted"]} read, {counts["reused"]} reused, {counts["failed"]} failed)'
+    )
+    return counts
+
+
+def stac_items_from_cache(
+    cache: str, output: str, batch_size: int = 10_000, storage_options: dict | None = None
+) -> int:
+    """
+    Generate the STAC items of all the granules of a header cache as ndjson, without reading any granule.
+
+    Returns:
+        int: the number of items written.
+    """
+    count = 0
+    with fsspec.open(output, 'wb') as f:
+        for records in iter_header_records(cache, batch_size=batch_size, storage_options=storage_options):
+            headers, geoms = [], []
+            for record in records:
+                header = GranuleHeader.from_record(record)
+                if (geom := get_geom(header, 4, 4326)) is None:
+                    logger.warning(f'Skipping {header.url}: projection metadata missing')
+                    continue
+                headers.append(header)
+                geoms.append(geom)
+
+            items = create_stac_item_dicts(headers, geoms, [header.url for header in headers])
+            f.write(b''.join(stac_item_json(item) + b'\n' for item in items))
+            count += len(items)
+
+    logger.info(f'Wrote {count} STAC items to {output}')
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cache ITS_LIVE granule headers as parquet and generate metadata from it'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = subparsers.add_parser('extract', help='Read granule headers into a cache')
+    extract_parser.add_argument(
+        '-u', '--urls', required=True, help='Text file with one granule path or s3:// URL per line'
+    )
+    extract_parser.add_argument('-o', '--output', required=True, help='Local or s3:// path of the cache')
+    extract_parser.add_argument('-p', '--previous', help='Existing cache to update; only changed granules are read')
+    extract_parser.add_argument('-w', '--workers', type=int, default=16, help='Granules read at once')
+
+    stac_parser = subparsers.add_parser('stac', help='Generate STAC items from a cache')
+    stac_parser.add_argument('-c', '--cache', required=True, help='Local or s3:// path of the cache')
+    stac_parser.add_argument('-o', '--output', required=True, help='ndjson file of the items')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p',
+        level=logging.INFO,
+    )
+    if args.command == 'extract':
+        with fsspec.open(args.urls, 'rt') as f:
+            urls = [line.strip() for line in f if line.strip()]
+        build_header_cache(urls, args.output, previous=args.previous, max_workers=args.workers)
+    elif args.command == 'stac':
+        stac_items_from_cache(args.cache, args.output)
+
+
+if __name__ == '__main__':
+    main()
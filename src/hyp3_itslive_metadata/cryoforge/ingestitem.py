@@ -8,14 +8,15 @@ from urllib.parse import urljoin
 import requests
 
 
-def post_or_put(url: str, data: dict):
-    """Post or put data to url."""
+def post_or_put(url: str, data: dict, session: requests.Session | None = None):
+    """Post or put data to url, with `session` when given so its connections are reused."""
+    http = session or requests
     logging.info(f'Posting to {url}')
-    r = requests.post(url, json=data)
+    r = http.post(url, json=data)
     if r.status_code == 409:
         new_url = url + f'/{data["id"]}'
         # Exists, so update
-        r = requests.put(new_url, json=data)
+        r = http.put(new_url, json=data)
         # Unchanged may throw a 404
         if not r.status_code == 404:
             r.raise_for_status()
@@ -23,17 +24,33 @@ def post_or_put(url: str, data: dict):
         r.raise_for_status()
 
 
-def ingest_item(load_collection: bool = False, stac_server: str = '', collection: str = '', stac_item: str = ''):
+def ingest_item(
+    load_collection: bool = False,
+    stac_server: str = '',
+    collection: str = '',
+    stac_item: str = '',
+    session: requests.Session | None = None,
+):
     """ingest stac item into the itslive collection."""
     if load_collection:
-        with open('./cryoforge/stac-collection.json') as f:
-            original_collection = json.load(f)
-            post_or_put(urljoin(stac_server, '/collections'), original_collection)
+        post_collection(stac_server, session=session)
 
     with open(stac_item) as f:
         item = json.load(f)
 
-    post_or_put(urljoin(stac_server, f'collections/{collection}/items'), item)
+    post_item(stac_server, collection, item, session=session)
+
+
+def post_collection(stac_server: str, session: requests.Session | None = None):
+    """Post (or update) the itslive collection to a STAC server."""
+    with open('./cryoforge/stac-collection.json') as f:
+        original_collection = json.load(f)
+    post_or_put(urljoin(stac_server, '/collections'), original_collection, session=session)
+
+
+def post_item(stac_server: str, collection: str, item: dict, session: requests.Session | None = None):
+    """Post (or update) a STAC item, already in memory, to a collection of a STAC server."""
+    post_or_put(urljoin(stac_server, f'collections/{collection}/items'), item, session=session)
 
 
 def ingest_stac():
@@ -1,45 +1,104 @@
 import argparse
+import hashlib
 import json
 import logging
 import sys
+from pathlib import Path
+from urllib.parse import urlparse
 
-import xarray as xr
-from pyproj import Transformer
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pystac_client import Client
 
-from hyp3_itslive_metadata.cryoforge.tooling import serverless_search
+from hyp3_itslive_metadata.cryoforge.generate import get_geom
+from hyp3_itslive_metadata.cryoforge.header import read_granule_header
+from hyp3_itslive_metadata.cryoforge.headercache import read_cached_headers
+from hyp3_itslive_metadata.cryoforge.tooling import get_duckdb_pool, iter_serverless_search
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Catalog searched by each query engine when --catalog is not given
+DEFAULT_CATALOGS = {
+    'duckstac': 's3://its-live-data/test-space/stac/geoparquet/h3r2',
+    'rustac': 's3://its-live-data/test-space/stac/geoparquet/latlon',
+}
 
-def get_bbox_wgs84(nc_url):
-    ds = xr.open_dataset(nc_url, backend_kwargs={'storage_options': {'anon': True}})
-    x = ds.coords.get('x')
-    y = ds.coords.get('y')
-    epsg = ds['mapping'].attrs.get('spatial_epsg')
 
-    if x is None or y is None or epsg is None:
-        raise ValueError('x, y coordinates or EPSG code missing')
-
-    minx, maxx = float(x.min()), float(x.max())
-    miny, maxy = float(y.min()), float(y.max())
-
-    transformer = Transformer.from_crs(f'EPSG:{epsg}', 'EPSG:4326', always_xy=True)
-    lon_min, lat_min = transformer.transform(minx, miny)
-    lon_max, lat_max = transformer.transform(maxx, maxy)
+def get_indexed_bbox(stac_catalog, granule_id):
+    """Bounding box of a granule already indexed in a STAC API, or None if it is not there."""
+    search = Client.open(stac_catalog).search(collections=['itslive-granules'], ids=[granule_id], max_items=1)
+    for item in search.items_as_dicts():
+        return item['bbox']
+    return None
 
-    return [lon_min, lat_min, lon_max, lat_max]
 
+def get_bbox_wgs84(nc_url, catalog=None, header_cache=None):
+    """
+    WGS84 bounding box of the densified footprint of a granule.
 
-def search_stac(stac_catalog, args: dict = {}):
-    max_items = args.get('max_items', 100)
-    percent_valid_pixels = args.get('percent_valid_pixels', None)
-    bbox = args.get('bbox', '-180,-90,180,90')
+    When `catalog` is a STAC API the footprint is looked up by granule id, otherwise (or if the granule is
+    not indexed yet) only the granule header is read, with ranged requests, and its footprint computed
+    with the same logic as `generate.get_geom`. With a `header_cache` (see `headercache`), a cached header
+    is used instead of reading the granule.
+    """
+    if catalog and catalog.startswith('http'):
+        granule_id = Path(urlparse(nc_url).path).name.replace('.nc', '')
+        try:
+            bbox = get_indexed_bbox(catalog, granule_id)
+        except Exception as e:
+            logger.warning(f'Could not look up {granule_id} in {catalog}: {e}')
+            bbox = None
+        if bbox:
+            logger.info(f'Using indexed footprint of {granule_id}')
+            return bbox
+
+    header = read_cached_headers(header_cache, urls=[nc_url]).get(nc_url) if header_cache else None
+    if header is None:
+        header = read_granule_header(nc_url)
+    if 'x' not in header or 'y' not in header:
+        raise ValueError('x, y coordinates missing')
+
+    geom = get_geom(header, precision=4, projection=4326)
+    if geom is None:
+        raise ValueError('Projection metadata missing')
+
+    return geom['bbox']
+
+
+def bbox_to_geometry(bbox):
+    """GeoJSON polygon for a [lon_min, lat_min, lon_max, lat_max] bounding box."""
+    return {
+        'type': 'Polygon',
+        'coordinates': [
+            [
+                [bbox[0], bbox[1]],
+                [bbox[2], bbox[1]],
+                [bbox[2], bbox[3]],
+                [bbox[0], bbox[3]],
+                [bbox[0], bbox[1]],
+            ]
+        ],
+    }
+
+
+def iter_stac_records(stac_catalog, args, properties=()):
+    """
+    Yield one {'href', *properties} record per matching data asset from a STAC API search.
+
+    Items are requested `args.page_size` at a time and read as plain dicts, so only the current page
+    is held in memory.
+    """
+    max_items = args.max_items if 'max_items' in args else 100
+    page_size = args.page_size if 'page_size' in args else None
+    percent_valid_pixels = args.percent_valid_pixels if 'percent_valid_pixels' in args else None
+    bbox = args.bbox if 'bbox' in args and args.bbox else [-180, -90, 180, 90]
 
     catalog = Client.open(stac_catalog)
-    search_kwargs = {'collections': ['itslive-granules'], 'bbox': bbox, 'max_items': max_items}
+    search_kwargs = {'collections': ['itslive-granules'], 'bbox': bbox, 'max_items': max_items, 'limit': page_size}
+    if 'datetime' in args and args.datetime:
+        search_kwargs['datetime'] = args.datetime
 
     # TODO: add more filters and flexibility
     if percent_valid_pixels is not None:
@@ -48,18 +107,22 @@ def search_stac(stac_catalog, args: dict = {}):
 
     search = catalog.search(**search_kwargs)
 
-    hrefs = []
-    for item in search.items():
-        for asset in item.assets.values():
-            if 'data' in asset.roles and asset.href.endswith('.nc'):
-                hrefs.append(asset.href)
+    for item in search.items_as_dicts():
+        for asset in item['assets'].values():
+            if 'data' in asset.get('roles', []) and asset['href'].endswith('.nc'):
+                yield {'href': asset['href'], **{prop: item['properties'].get(prop) for prop in properties}}
 
-    return hrefs
 
+def search_stac(stac_catalog, args):
+    return [record['href'] for record in iter_stac_records(stac_catalog, args)]
 
-def search_duckstac(catalog: str = 's3://its-live-data/test-space/stac/geoparquet/h3r2', args: dict = {}):
+
+def get_search_kwargs(args) -> dict:
+    """Build the `serverless_search` search kwargs (geometry, datetime and filters) from the CLI arguments."""
     filters = [
-        {'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, args.percent_valid_pixels]},
+        {'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, args.percent_valid_pixels]}
+        if args.percent_valid_pixels is not None
+        else {},
         {'op': '=', 'args': [{'property': 'proj:code'}, args.epsg]} if args.epsg else {},
     ]
     if args.geojson:
@@ -69,44 +132,145 @@ def search_duckstac(catalog: str = 's3://its-live-data/test-space/stac/geoparque
         except Exception as e:
             raise ValueError(f'Error reading GeoJSON file: {e}')
     elif args.bbox:
-        geom = {
-            'type': 'Polygon',
-            'coordinates': [
-                [
-                    [args.bbox[0], args.bbox[1]],
-                    [args.bbox[2], args.bbox[1]],
-                    [args.bbox[2], args.bbox[3]],
-                    [args.bbox[0], args.bbox[3]],
-                    [args.bbox[0], args.bbox[1]],
-                ]
-            ],
-        }
+        geom = bbox_to_geometry(args.bbox)
     else:
         raise ValueError('Either --geojson, --granule or --bbox must be provided.')
 
     search_args = {'intersects': geom, 'filter': filters}
     if args.datetime:
         search_args['datetime'] = args.datetime
+    return search_args
+
 
+def iter_duckstac_records(
+    catalog: str = 's3://its-live-data/test-space/stac/geoparquet/h3r2', args: dict = {}, properties=()
+):
     cache = args.cache if 'cache' in args else False
+    duckdb_pool = get_duckdb_pool(
+        threads=args.duckdb_threads if 'duckdb_threads' in args else None,
+        memory_limit=args.duckdb_memory_limit if 'duckdb_memory_limit' in args else None,
+    )
 
-    results = serverless_search(
+    return iter_serverless_search(
         base_catalog_href=catalog,
-        search_kwargs=search_args,
+        search_kwargs=get_search_kwargs(args),
         engine='duckdb',
         cache=cache,
         reduce_spatial_search=True,
         partition_type='h3',
         resolution=2,
         overlap='bbox_overlap',
+        duckdb_pool=duckdb_pool,
+        properties=properties,
     )
 
-    return results
+
+def search_duckstac(catalog: str = 's3://its-live-data/test-space/stac/geoparquet/h3r2', args: dict = {}):
+    return sorted({record['href'] for record in iter_duckstac_records(catalog, args)})
+
+
+def iter_rustac_records(
+    catalog: str = 's3://its-live-data/test-space/stac/geoparquet/latlon', args: dict = {}, properties=()
+):
+    cache = args.cache if 'cache' in args else False
+    return iter_serverless_search(
+        base_catalog_href=catalog,
+        search_kwargs=get_search_kwargs(args),
+        engine='rustac',
+        cache=cache,
+        reduce_spatial_search=True,
+        partition_type='latlon',
+        properties=properties,
+    )
 
 
 def search_rustac(catalog: str = 's3://its-live-data/test-space/stac/geoparquet/latlon', args: dict = {}):
-    print('Rustac search is not implemented yet.')
-    return None
+    return sorted({record['href'] for record in iter_rustac_records(catalog, args)})
+
+
+def iter_search_records(catalog, args, properties=()):
+    """Stream search records from the engine selected by `args.query_engine`."""
+    if args.query_engine == 'duckstac':
+        return iter_duckstac_records(catalog, args, properties)
+    elif args.query_engine == 'rustac':
+        return iter_rustac_records(catalog, args, properties)
+    else:
+        return iter_stac_records(catalog, args, properties)
+
+
+class HrefDeduplicator:
+    """Remembers seen hrefs as 64-bit digests, a fraction of the memory of keeping the strings themselves."""
+
+    def __init__(self):
+        self._digests = set()
+
+    def add(self, href: str) -> bool:
+        """Remember `href`, returning False if it was already seen."""
+        digest = int.from_bytes(hashlib.blake2b(href.encode(), digest_size=8).digest(), 'little')
+        if digest in self._digests:
+            return False
+        self._digests.add(digest)
+        return True
+
+
+def write_records(records, output=None, output_format='text', dedup=False, batch_size=10000):
+    """
+    Write search records as they arrive instead of collecting them first.
+
+    Args:
+        records: Iterable of {'href', *properties} records.
+        output (str, optional): Local path to write to; stdout if not given (text format only).
+        output_format (str, optional): "text" for one href per line, or "parquet" for the href and the
+            record properties as columns, written `batch_size` rows at a time.
+        dedup (bool, optional): Skip hrefs that were already written.
+
+    Returns:
+        int: Number of records written.
+    """
+    deduplicator = HrefDeduplicator() if dedup else None
+    count = 0
+
+    if output_format == 'parquet':
+        if not output:
+            raise ValueError('Parquet output requires --output')
+        writer = None
+        batch = []
+        for record in records:
+            if deduplicator and not deduplicator.add(record['href']):
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                writer = _write_parquet_batch(writer, batch, output)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer = _write_parquet_batch(writer, batch, output)
+            count += len(batch)
+        if writer is not None:
+            writer.close()
+        return count
+
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        for record in records:
+            if deduplicator and not deduplicator.add(record['href']):
+                continue
+            out.write(record['href'] + '\n')
+            count += 1
+    finally:
+        if output:
+            out.close()
+    return count
+
+
+def _write_parquet_batch(writer, batch, output):
+    if writer is None:
+        table = pa.Table.from_pylist(batch)
+        writer = pq.ParquetWriter(output, table.schema)
+    else:
+        table = pa.Table.from_pylist(batch, schema=writer.schema)
+    writer.write_table(table)
+    return writer
 
 
 def search_items():
@@ -118,11 +282,17 @@ def search_items():
         '--query-engine', help='Query engine to use (duckstac, rustac, or pystac_client)', default='pystac_client'
     )
     parser.add_argument('--granule', help='URL of an overlapping ITS_LIVE .nc granule file')
+    parser.add_argument('--header-cache', help='Parquet header cache (see header-cache) to read --granule from')
     parser.add_argument('--bbox', help="Bounding box in the format 'lon_min,lat_min,lon_max,lat_max'")
     parser.add_argument('--geojson', help='Geojson file with a geometry type to filter items')
     parser.add_argument('--datetime', help="Datetime range in STAC format: 'YYYY-MM-DDTHH:MM:SSZ/YYYY-MM-DDTHH:MM:SSZ'")
     parser.add_argument('--cache', help='Cache geoparquet files in disk if present', action='store_true')
+    parser.add_argument('--duckdb-threads', type=int, help='Number of DuckDB threads (default: all cores)')
+    parser.add_argument('--duckdb-memory-limit', type=str, help="DuckDB memory limit, e.g. '4GB'")
     parser.add_argument('--max-items', type=int, default=100, help='Maximum number of items to return (default: 100)')
+    parser.add_argument(
+        '--page-size', type=int, help='Items requested per page from a STAC API (pystac_client engine only)'
+    )
     parser.add_argument(
         '--percent-valid-pixels', type=int, help='Filter items by minimum percent valid pixels (e.g., 90)'
     )
@@ -132,17 +302,38 @@ def search_items():
         type=str,
         help='Local path to write URLs from matching items, if not used the output will be printed to stdout',
     )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Write URLs as they arrive instead of sorting them first, so memory does not grow with the results',
+    )
+    parser.add_argument('--dedup', action='store_true', help='Drop duplicate URLs while streaming')
+    parser.add_argument(
+        '--format',
+        choices=['text', 'parquet'],
+        default='text',
+        help='Output format; parquet is always streamed and requires --output',
+    )
+    parser.add_argument(
+        '--properties', type=str, help="Comma separated item properties to add as parquet columns, e.g. 'datetime'"
+    )
     args = parser.parse_args()
     results = []
 
     try:
+        if args.catalog:
+            catalog = args.catalog
+        else:
+            catalog = DEFAULT_CATALOGS.get(args.query_engine, 'https://stac.itslive.cloud/')
+
         if args.granule:
-            bbox = get_bbox_wgs84(args.granule)
+            bbox = get_bbox_wgs84(args.granule, catalog=catalog, header_cache=args.header_cache)
             args.bbox = bbox  # Set bbox from granule
         elif args.bbox:
             bbox = list(map(float, args.bbox.split(',')))
             if len(bbox) != 4:
                 raise ValueError('Bounding box must contain exactly four values.')
+            args.bbox = bbox
         elif args.geojson:
             try:
                 with open(args.geojson, 'r') as f:
@@ -154,21 +345,26 @@ def search_items():
                     max(coord[0] for coord in bbox),
                     max(coord[1] for coord in bbox),
                 ]
+                args.bbox = bbox
             except Exception as e:
                 raise ValueError(f'Error reading GeoJSON file: {e}')
         else:
             raise ValueError('Either --granule or --bbox must be provided.')
-        if args.catalog:
-            catalog = args.catalog
-        else:
-            catalog = 'https://stac.itslive.cloud/'
+
+        if args.stream or args.format == 'parquet':
+            properties = tuple(args.properties.split(',')) if args.properties else ()
+            records = iter_search_records(catalog, args, properties)
+            count = write_records(records, output=args.output, output_format=args.format, dedup=args.dedup)
+            if not count:
+                print('No matching items found.', file=sys.stderr)
+            return
 
         if args.query_engine == 'duckstac':
             results = search_duckstac(catalog, args)
         elif args.query_engine == 'rustac':
             results = search_rustac(catalog, args)
         else:
-            results = search_stac(catalog, bbox, args)
+            results = search_stac(catalog, args)
     except Exception as e:
         print(f'Error: {e}', file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,287 @@
+"""
+Long-running search service around serverless_search.
+
+A single process keeps the catalog partition manifest, the DuckDB database (with its extensions and
+object cache) and the local parquet cache warm, and answers STAC-style item searches over HTTP or a
+Unix socket, so each search costs a query instead of a new interpreter plus remote listing.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from hyp3_itslive_metadata.cryoforge.search_items import bbox_to_geometry
+from hyp3_itslive_metadata.cryoforge.tooling import get_duckdb_pool, list_partitions, serverless_search
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_search_request(body: dict) -> dict:
+    """
+    Translate a STAC API item-search body into `serverless_search` search kwargs.
+
+    Supports `intersects` or `bbox` (list or comma separated string), `datetime` and a cql2-json `filter`;
+    a top level "and" filter is split into the list of expressions `serverless_search` expects.
+    """
+    if body.get('intersects'):
+        geom = body['intersects']
+    elif body.get('bbox'):
+        bbox = body['bbox']
+        if isinstance(bbox, str):
+            bbox = [float(value) for value in bbox.split(',')]
+        if len(bbox) != 4:
+            raise ValueError('Bounding box must contain exactly four values.')
+        geom = bbox_to_geometry(bbox)
+    else:
+        raise ValueError('Either intersects or bbox must be provided.')
+
+    search_kwargs = {'intersects': geom}
+    if body.get('datetime'):
+        search_kwargs['datetime'] = body['datetime']
+
+    cql_filter = body.get('filter')
+    if isinstance(cql_filter, str):
+        cql_filter = json.loads(cql_filter)
+    if not cql_filter:
+        search_kwargs['filter'] = []
+    elif cql_filter.get('op') == 'and':
+        search_kwargs['filter'] = cql_filter['args']
+    else:
+        search_kwargs['filter'] = [cql_filter]
+
+    return search_kwargs
+
+
+class SearchService:
+    """Holds the warm state shared by every request: partition manifest, DuckDB pool and parquet cache."""
+
+    def __init__(
+        self,
+        catalog: str = 's3://its-live-data/test-space/stac/geoparquet/h3r2',
+        engine: str = 'duckdb',
+        partition_type: str = 'h3',
+        resolution: int = 2,
+        overlap: str = 'bbox_overlap',
+        cache: bool = True,
+        duckdb_pool=None,
+    ):
+        self.catalog = catalog.rstrip('/')
+        self.engine = engine
+        self.partition_type = partition_type
+        self.resolution = resolution
+        self.overlap = overlap
+        self.cache = cache
+        self.duckdb_pool = duckdb_pool or get_duckdb_pool()
+        self.partitions = set()
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Re-list the catalog partitions and make sure the DuckDB database is open."""
+        partitions = list_partitions(self.catalog, partition_type=self.partition_type)
+        with self._lock:
+            self.partitions = partitions
+        if self.engine == 'duckdb':
+            # opens the database and loads the extensions before the first request
+            self.duckdb_pool.cursor()
+        logger.info(f'Loaded {len(partitions)} partitions from {self.catalog}')
+        return len(partitions)
+
+    def search(self, body: dict) -> list:
+        """Run one STAC-style search and return the matching data hrefs."""
+        search_kwargs = parse_search_request(body)
+        return serverless_search(
+            base_catalog_href=self.catalog,
+            search_kwargs=search_kwargs,
+            engine=self.engine,
+            cache=self.cache,
+            reduce_spatial_search=True,
+            partition_type=self.partition_type,
+            resolution=self.resolution,
+            overlap=self.overlap,
+            duckdb_pool=self.duckdb_pool,
+            partitions=self.partitions,
+        )
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints:
+        GET  /health   service status
+        GET  /search   search with query parameters (bbox, datetime, filter)
+        POST /search   search with a JSON STAC item-search body
+        POST /refresh  re-list the catalog partitions
+    """
+
+    server_version = 'cryoforge-search'
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _search(self, body: dict):
+        service = self.server.search_service
+        start = time.perf_counter()
+        try:
+            hrefs = service.search(body)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            logger.exception('Search failed')
+            self._send_json(500, {'error': str(e)})
+            return
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+        self._send_json(200, {'hrefs': hrefs, 'numberReturned': len(hrefs), 'elapsed_ms': elapsed_ms})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            service = self.server.search_service
+            self._send_json(200, {'status': 'ok', 'catalog': service.catalog, 'partitions': len(service.partitions)})
+        elif url.path == '/search':
+            self._search({key: values[-1] for key, values in parse_qs(url.query).items()})
+        else:
+            self._send_json(404, {'error': f'Unknown path {url.path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            self._send_json(400, {'error': f'Invalid JSON body: {e}'})
+            return
+
+        if url.path == '/search':
+            self._search(body)
+        elif url.path == '/refresh':
+            self._send_json(200, {'partitions': self.server.search_service.refresh()})
+        else:
+            self._send_json(404, {'error': f'Unknown path {url.path}'})
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.address_string()} - {format % args}')
+
+
+class PoolMixIn:
+    """
+    Handle requests in a fixed pool of `workers` threads instead of a new thread per request.
+
+    The threads outlive the requests, so their per-thread state, the DuckDB cursors of `DuckDBPool`, is reused by
+    every request they handle instead of being created again for each one.
+    """
+
+    workers = 8
+    _pool = None
+
+    def process_request(self, request, client_address):
+        # only called from the serve_forever thread
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='search')
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+
+class SearchHTTPServer(PoolMixIn, HTTPServer):
+    pass
+
+
+class UnixSearchServer(PoolMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def make_server(
+    service: SearchService,
+    host: str = '127.0.0.1',
+    port: int = 8040,
+    socket_path: str | None = None,
+    workers: int = 8,
+):
+    """
+    Create an HTTP server for `service`, on a Unix socket if `socket_path` is given.
+
+    Requests are handled by a pool of `workers` threads (`PoolMixIn`).
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixSearchServer(socket_path, SearchRequestHandler)
+    else:
+        server = SearchHTTPServer((host, port), SearchRequestHandler)
+    server.workers = workers
+    server.search_service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve ITS_LIVE geoparquet catalog searches from a warm process.')
+    parser.add_argument(
+        '--catalog',
+        default='s3://its-live-data/test-space/stac/geoparquet/h3r2',
+        help='Base href of the partitioned geoparquet catalog',
+    )
+    parser.add_argument('--query-engine', default='duckdb', help='Query engine to use (duckdb or rustac)')
+    parser.add_argument('--partition-type', default='h3', help='Catalog partitioning (h3 or latlon)')
+    parser.add_argument('--resolution', type=int, default=2, help='H3 resolution of the catalog partitions')
+    parser.add_argument('--no-cache', action='store_true', help='Query remote parquet files instead of a disk cache')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8040, help='Port to listen on')
+    parser.add_argument('--socket', help='Listen on this Unix socket path instead of host/port')
+    parser.add_argument('--workers', type=int, default=8, help='Requests handled at once, each with its own cursor')
+    parser.add_argument('--duckdb-threads', type=int, help='Number of DuckDB threads (default: all cores)')
+    parser.add_argument('--duckdb-memory-limit', type=str, help="DuckDB memory limit, e.g. '4GB'")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    service = SearchService(
+        catalog=args.catalog,
+        engine=args.query_engine,
+        partition_type=args.partition_type,
+        resolution=args.resolution,
+        cache=not args.no_cache,
+        duckdb_pool=get_duckdb_pool(threads=args.duckdb_threads, memory_limit=args.duckdb_memory_limit),
+    )
+    server = make_server(service, host=args.host, port=args.port, socket_path=args.socket, workers=args.workers)
+    logger.info(f'Serving searches on {args.socket or f"http://{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Size-aware planning of the shards processed by Coiled batch tasks.
+
+Row groups of a file list and regions of the archive vary from a few granules to hundreds of thousands, and the
+slowest task sets the wall time of a batch job. `plan_shards` splits a listing of granules (with their sizes,
+see `list_granules`) into shards of about equal cost and `write_manifest` writes them as a parquet manifest with
+one row group per shard:
+
+    listing = list_granules('s3://its-live-data/velocity_image_pair/landsatOLI/v02/')
+    write_manifest(plan_shards(listing, 500), 'manifest.parquet')
+
+`generate-from-parquet process-row-group --manifest` and `generate-catalog --manifest` then take the shard id
+(or `COILED_BATCH_TASK_ID`) instead of a row group or region index.
+"""
+
+import argparse
+import heapq
+import logging
+import posixpath
+
+import fsspec
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+logger = logging.getLogger(__name__)
+
+# Cost of a granule: a fixed cost per file plus a cost per byte, in "files": by default a 16 MiB granule costs
+# as much as the per-file overhead
+FILE_COST = 1.0
+BYTE_COST = 1 / 2**24
+
+
+def list_granules(root: str, extension: str = '.nc', storage_options: dict | None = None) -> pa.Table:
+    """
+    List the granules under `root` with their sizes.
+
+    Returns:
+        pa.Table: `prefix` (directory of the granule, without the bucket for s3://), `path` (file name),
+        `region` (first directory below `root`) and `size` in bytes, sorted by prefix and path.
+    """
+    if storage_options is None:
+        storage_options = {'anon': True} if root.startswith('s3://') else {}
+    fs, root_path = fsspec.core.url_to_fs(root, **storage_options)
+    root_path = root_path.rstrip('/')
+    strip_bucket = root.startswith('s3://')
+
+    rows = {'prefix': [], 'path': [], 'region': [], 'size': []}
+    for key, info in sorted(fs.find(root_path, detail=True).items()):
+        if not key.endswith(extension):
+            continue
+        directory = posixpath.dirname(key)
+        relative = posixpath.relpath(directory, root_path)
+        rows['prefix'].append(directory.split('/', 1)[1] if strip_bucket else directory)
+        rows['path'].append(posixpath.basename(key))
+        rows['region'].append('' if relative == '.' else relative.split('/', 1)[0])
+        rows['size'].append(int(info.get('size') or 0))
+    logger.info(f'Listed {len(rows["path"])} granules under {root}')
+    return pa.table(rows, schema=pa.schema([(name, pa.int64() if name == 'size' else pa.string()) for name in rows]))
+
+
+def granule_costs(listing: pa.Table, file_cost: float = FILE_COST, byte_cost: float = BYTE_COST) -> np.ndarray:
+    """The cost of each granule of a listing; without a `size` column every granule costs `file_cost`."""
+    costs = np.full(listing.num_rows, file_cost, dtype='float64')
+    if 'size' in listing.column_names:
+        costs += byte_cost * listing['size'].fill_null(0).to_numpy(zero_copy_only=False)
+    return costs
+
+
+def plan_shards(
+    listing: pa.Table,
+    num_shards: int,
+    group_by: str | None = None,
+    file_cost: float = FILE_COST,
+    byte_cost: float = BYTE_COST,
+) -> pa.Table:
+    """
+    Assign every granule of `listing` to one of `num_shards` shards of about equal cost.
+
+    Without `group_by`, granules are sorted by prefix and path and cut into contiguous runs of equal cost, so a
+    shard differs from the mean by less than one granule and mostly covers whole prefixes. With `group_by` (e.g.
+    `region`, for `generatebulk`, which processes whole regions), granules of a group stay in one shard and the
+    groups are packed largest first into the least loaded shard.
+
+    Returns:
+        pa.Table: `listing` with a `shard` column and a `cost` column, sorted by shard, prefix and path.
+    """
+    if num_shards < 1:
+        raise ValueError(f'num_shards must be at least 1, got {num_shards}')
+    listing = listing.sort_by([('prefix', 'ascending'), ('path', 'ascending')])
+    costs = granule_costs(listing, file_cost=file_cost, byte_cost=byte_cost)
+
+    if group_by is None:
+        # the shard of a granule is where the middle of its cost falls in the cumulative cost
+        total = costs.sum() or 1.0
+        midpoints = np.cumsum(costs) - costs / 2
+        shards = np.minimum((midpoints / total * num_shards).astype('int64'), num_shards - 1)
+    else:
+        groups, inverse = np.unique(listing[group_by].to_numpy(zero_copy_only=False), return_inverse=True)
+        group_costs = np.bincount(inverse, weights=costs, minlength=len(groups))
+        loads = [(0.0, shard) for shard in range(num_shards)]
+        group_shards = np.zeros(len(groups), dtype='int64')
+        for group in np.argsort(-group_costs, kind='stable'):
+            load, shard = heapq.heappop(loads)
+            group_shards[group] = shard
+            heapq.heappush(loads, (load + group_costs[group], shard))
+        shards = group_shards[inverse]
+
+    planned = listing.append_column('shard', pa.array(shards, pa.int32())).append_column('cost', pa.array(costs))
+    planned = planned.sort_by([('shard', 'ascending'), ('prefix', 'ascending'), ('path', 'ascending')])
+
+    shard_costs = np.bincount(shards, weights=costs, minlength=num_shards)
+    logger.info(
+        f'Planned {num_shards} shards of {listing.num_rows} granules: cost {shard_costs.min():.1f} to '
+        f'{shard_costs.max():.1f} (mean {shard_costs.mean():.1f})'
+    )
+    return planned
+
+
+def write_manifest(planned: pa.Table, path: str, storage_options: dict | None = None) -> str:
+    """Write a plan from `plan_shards` as parquet, with one row group per shard (empty shards are skipped)."""
+    with fsspec.open(path, 'wb', **(storage_options or {})) as f, pq.ParquetWriter(f, planned.schema) as writer:
+        shards = planned['shard'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, shards[1:] != shards[:-1]]) if len(shards) else []
+        for start, end in zip(starts, [*starts[1:], len(shards)]):
+            writer.write_table(planned.slice(start, end - start))
+    return path
+
+
+def read_shard(manifest: str, shard: int, columns: list | None = None, storage_options: dict | None = None) -> pa.Table:
+    """Read the granules of one shard of a manifest."""
+    fs, path = fsspec.core.url_to_fs(manifest, **(storage_options or {}))
+    table = pq.read_table(path, filesystem=fs, columns=columns, filters=[('shard', '=', shard)])
+    if {'prefix', 'path'} <= set(table.column_names):
+        table = table.sort_by([('prefix', 'ascending'), ('path', 'ascending')])
+    return table
+
+
+def shard_groups(manifest: str, shard: int, group_by: str = 'region', storage_options: dict | None = None) -> list:
+    """The distinct `group_by` values (e.g. regions) of one shard of a manifest."""
+    table = read_shard(manifest, shard, columns=[group_by], storage_options=storage_options)
+    return sorted(pc.unique(table[group_by]).to_pylist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan balanced shards of ITS_LIVE granules for batch tasks')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-r', '--root', help='Local or s3:// prefix to list granules from')
+    source.add_argument('-f', '--file-list', help='Parquet listing with prefix, path and optionally size columns')
+    parser.add_argument('-n', '--shards', type=int, required=True, help='Number of shards (batch tasks)')
+    parser.add_argument('-o', '--output', required=True, help='Manifest parquet to write')
+    parser.add_argument(
+        '-g', '--group-by', help='Keep granules with the same value of this column (e.g. region) together'
+    )
+    parser.add_argument('--file-cost', type=float, default=FILE_COST, help='Cost of a granule, in files')
+    parser.add_argument('--byte-cost', type=float, default=BYTE_COST, help='Cost of a byte, in files')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p',
+        level=logging.INFO,
+    )
+    if args.root:
+        listing = list_granules(args.root)
+    else:
+        fs, path = fsspec.core.url_to_fs(
+            args.file_list, **({'anon': True} if args.file_list.startswith('s3://') else {})
+        )
+        listing = pq.read_table(path, filesystem=fs)
+    planned = plan_shards(
+        listing, args.shards, group_by=args.group_by, file_cost=args.file_cost, byte_cost=args.byte_cost
+    )
+    write_manifest(planned, args.output)
+    logger.info(f'Wrote the manifest of {args.shards} shards to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Per-stage timing of metadata generation.
+
+A `StageTimer` passed to `generate_itslive_metadata` (and carried on to `save_metadata` in the returned
+metadata) records the wall time of each stage of one granule, the number of bytes read and the peak RSS,
+so a drop in throughput can be attributed to S3 (fetch), h5netcdf (open), PROJ (geometry) or our own code.
+`aggregate_timings` turns many of those records into histograms for a whole run.
+"""
+
+import json
+import math
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import numpy as np
+import psutil
+
+
+# Stages of `generate_itslive_metadata` and `save_metadata`, in the order they run
+STAGES = ('fetch', 'kerchunk', 'open', 'geometry', 'stac', 'nsidc', 'save')
+
+# Histogram bucket edges: log-spaced from 1 ms to ~17 min for durations, 1 KiB to 64 GiB for sizes
+DURATION_EDGES = [0.0, *(0.001 * 2**i for i in range(21)), math.inf]
+SIZE_EDGES = [0, *(2**i for i in range(10, 37)), math.inf]
+
+TIMINGS_FILENAME = 'timings.json'
+
+
+class StageTimer:
+    """
+    Collects the timing record of one granule.
+
+    Durations of a stage entered more than once are added up. RSS is sampled at the end of every stage,
+    which is when the largest buffers (e.g. the fetched granule) are still alive. The stage an error was raised
+    in is kept as `failed_stage`.
+    """
+
+    def __init__(self, url: str = ''):
+        self.url = url
+        self.stages = {}
+        self.failed_stage: str | None = None
+        self.bytes_read = 0
+        self.peak_rss = 0
+        self._process = psutil.Process()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        except BaseException:
+            # the innermost stage raised first
+            self.failed_stage = self.failed_stage or name
+            raise
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        """Record `seconds` spent in stage `name`, e.g. for a stage timed elsewhere such as an async fetch."""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    def add_bytes(self, count: int):
+        self.bytes_read += count
+
+    def record(self) -> dict:
+        """The structured record of this granule, ready to be serialized or aggregated."""
+        return {
+            'url': self.url,
+            'stages': dict(self.stages),
+            'total_s': sum(self.stages.values()),
+            'bytes_read': self.bytes_read,
+            'peak_rss_bytes': self.peak_rss,
+        }
+
+
+def stage(timer: StageTimer | None, name: str):
+    """`timer.stage(name)`, or a no-op context when no timer is given."""
+    return timer.stage(name) if timer is not None else nullcontext()
+
+
+def _summarize(values: list, edges: list) -> dict:
+    values = np.asarray(values, dtype=float)
+    counts, _ = np.histogram(values, bins=edges)
+    return {
+        'count': int(values.size),
+        'sum': float(values.sum()),
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+        # the last edge is infinite, which JSON can't represent; the last bucket is open-ended
+        'histogram': {'edges': edges[:-1], 'counts': counts.tolist()},
+    }
+
+
+def aggregate_timings(records: list) -> dict:
+    """
+    Aggregate timing records into per-stage duration histograms plus bytes read and peak RSS histograms.
+
+    Each summary has the count, sum, mean, p50/p90/p99 and max, and a histogram whose `edges` are the lower
+    bounds of log-spaced buckets (durations in seconds, sizes in bytes).
+    """
+    records = [record for record in records if record]
+    summary = {'granules': len(records), 'stages': {}}
+    if not records:
+        return summary
+
+    stage_names = [name for name in STAGES if any(name in record['stages'] for record in records)]
+    stage_names += sorted({name for record in records for name in record['stages']} - set(stage_names))
+    for name in stage_names:
+        durations = [record['stages'][name] for record in records if name in record['stages']]
+        summary['stages'][name] = _summarize(durations, DURATION_EDGES)
+
+    summary['total_s'] = _summarize([record['total_s'] for record in records], DURATION_EDGES)
+    summary['bytes_read'] = _summarize([record['bytes_read'] for record in records], SIZE_EDGES)
+    summary['peak_rss_bytes'] = _summarize([record['peak_rss_bytes'] for record in records], SIZE_EDGES)
+    return summary
+
+
+def write_timings(records: list, path) -> Path:
+    """Aggregate `records` and write the histograms as JSON to `path`."""
+    path = Path(path)
+    path.write_text(json.dumps(aggregate_timings(records), indent=2))
+    return path
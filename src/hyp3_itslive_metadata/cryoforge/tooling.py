@@ -1,70 +1,332 @@
+import ctypes
+import ctypes.util
 import fnmatch
+import functools
 import gc
 import json
 import logging
 import math
 import os
+import random
 import re
+import threading
+import time
 import urllib
 from typing import List
 from urllib.parse import urlparse
 
 import boto3
-import dask
 import duckdb
 import h3
 import psutil
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
 import rustac
 import s3fs
 from botocore import UNSIGNED
 from botocore.client import Config
+from distributed import WorkerPlugin
+from distributed.core import Status
 from shapely.geometry import box, shape
 
+from .fetch import AdaptiveLimiter, HedgedReader, get_read_hedger, set_read_hedger, set_read_limiter
+
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-# Connect to DuckDB
-con = duckdb.connect()
-con.execute('INSTALL spatial')
-con.execute('LOAD spatial')
-con.execute("SET s3_region='us-west-2'")
+s3_fs = s3fs.S3FileSystem(anon=True, default_fill_cache=False, skip_instance_cache=True)
 
 
-s3_fs = s3fs.S3FileSystem(anon=True, default_fill_cache=False, skip_instance_cache=True)
+class DuckDBPool:
+    """
+    Shares a single DuckDB database between threads, handing out one cursor per thread.
+
+    The database is opened lazily on first use; extensions are installed and loaded only once
+    and every cursor shares the same object cache (parquet footers) and http metadata cache,
+    so a long-lived process pays the setup and remote metadata cost a single time.
+
+    Args:
+        threads (int, optional): Number of DuckDB worker threads. Defaults to DuckDB's own choice (all cores).
+        memory_limit (str, optional): DuckDB memory limit, e.g. '4GB'. Defaults to DuckDB's own choice.
+        s3_region (str, optional): Region used by httpfs for s3:// paths.
+        extensions (tuple, optional): Extensions to install and load when the database is opened.
+    """
+
+    def __init__(
+        self,
+        threads: int | None = None,
+        memory_limit: str | None = None,
+        s3_region: str = 'us-west-2',
+        extensions: tuple = ('spatial', 'httpfs'),
+    ):
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self.s3_region = s3_region
+        self.extensions = tuple(extensions)
+        self._con = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self) -> duckdb.DuckDBPyConnection:
+        config = {'enable_object_cache': True}
+        if self.threads:
+            config['threads'] = self.threads
+        if self.memory_limit:
+            config['memory_limit'] = self.memory_limit
+
+        con = duckdb.connect(config=config)
+        for extension in self.extensions:
+            con.install_extension(extension)
+            con.load_extension(extension)
+        con.execute('SET enable_http_metadata_cache=true')
+        if 'httpfs' in self.extensions:
+            con.execute(f"SET s3_region='{self.s3_region}'")
+        logger.debug(f'Opened DuckDB database with {config} and extensions {self.extensions}')
+        return con
+
+    @property
+    def connection(self) -> duckdb.DuckDBPyConnection:
+        """The shared connection, opened on first access."""
+        if self._con is None:
+            with self._lock:
+                if self._con is None:
+                    self._con = self._connect()
+        return self._con
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Return the cursor owned by the calling thread, creating it if needed."""
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def close(self):
+        """Close the shared connection; cursors handed out before are invalidated."""
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+            self._local = threading.local()
+
+
+_duckdb_pool = None
+_duckdb_pool_lock = threading.Lock()
+
+
+def get_duckdb_pool(**kwargs) -> DuckDBPool:
+    """
+    Return the process-wide DuckDB pool.
+
+    Keyword arguments are passed to `DuckDBPool` and only take effect when the pool is created,
+    i.e. on the first call in a process.
+    """
+    global _duckdb_pool
+    if _duckdb_pool is None:
+        with _duckdb_pool_lock:
+            if _duckdb_pool is None:
+                _duckdb_pool = DuckDBPool(**kwargs)
+    return _duckdb_pool
+
+
+_rustac_client = None
+_rustac_client_lock = threading.Lock()
+
+
+def get_rustac_client(**kwargs) -> rustac.DuckdbClient:
+    """
+    Return the process-wide rustac DuckDB client.
+
+    Creating a client starts a DuckDB database and loads its extensions, so searches reuse one client
+    instead of paying that for every partition. Keyword arguments are passed to `rustac.DuckdbClient`
+    and only take effect on the first call in a process.
+    """
+    global _rustac_client
+    if _rustac_client is None:
+        with _rustac_client_lock:
+            if _rustac_client is None:
+                _rustac_client = rustac.DuckdbClient(**kwargs)
+    return _rustac_client
+
+
+@functools.cache
+def _libc_malloc_trim():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').malloc_trim
+    except (OSError, AttributeError):
+        # not glibc (macOS, musl): there is no malloc_trim
+        return None
+
+
+def malloc_trim() -> bool:
+    """Return the free memory of the glibc malloc heap to the OS; False where malloc_trim is unavailable."""
+    trim = _libc_malloc_trim()
+    return bool(trim(0)) if trim is not None else False
 
 
 def trim_memory() -> int:
     """
-    Efficiently trim memory in a Dask worker context.
+    Collect garbage and return the freed memory to the OS (`malloc_trim`).
+
+    Freed memory otherwise stays in the process's malloc arenas, so the RSS of a long running worker only grows.
+    This trims the process it runs in: use `trim_workers` to trim the workers of a dask cluster.
 
     Returns:
-        int: Approximate number of objects collected
+        int: Number of objects collected
     """
-    # Force garbage collection
     collected = gc.collect()
+    malloc_trim()
+    return collected
 
-    # Attempt to release memory back to the system
+
+def trim_workers(client) -> dict:
+    """Run `trim_memory` on every worker of a dask cluster; returns the objects collected per worker."""
     try:
-        # Dask-specific memory management
-        dask.distributed.worker.logger.debug('Attempting memory trim')
+        return client.run(trim_memory)
+    except Exception as e:
+        logger.warning(f'Could not trim the memory of the workers: {e}')
+        return {}
 
-        # Release worker local memory if using distributed
-        dask.distributed.worker.memory_limit = None
-    except Exception:
-        pass
 
-    # Additional system-level memory management
-    try:
-        # Force Python to return memory to the system
-        psutil.Process().memory_maps(grouped=True)
-    except Exception:
-        pass
+class RecyclePlugin(WorkerPlugin):
+    """
+    Restarts a dask worker after about `max_tasks` tasks or once its RSS stays above `max_rss` bytes.
 
-    return collected
+    Fragmentation and leaks in the native libraries (HDF5, GDAL, PROJ) grow the RSS of a worker that never
+    restarts until it is OOM-killed, losing its tasks. After each task the plugin checks both limits (trimming
+    memory first when the RSS is over). A worker over a limit starts no new task, like a retiring worker, and once
+    it has finished its running tasks and its results have been fetched (or after `grace_seconds`), it is retired
+    and its nanny starts a fresh process. Workers without a nanny are closed instead.
+
+    Args:
+        max_tasks (int, optional): Tasks a worker runs before it is restarted.
+        max_rss (int, optional): RSS in bytes above which a worker is restarted.
+        grace_seconds (float, optional): How long a paused worker waits for its results to be fetched.
+    """
+
+    name = 'recycle'
+
+    def __init__(self, max_tasks: int | None = None, max_rss: int | None = None, grace_seconds: float = 60):
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.grace_seconds = grace_seconds
+
+    def setup(self, worker):
+        self.worker = worker
+        self.process = psutil.Process()
+        self.tasks = 0
+        # +-10%, so workers started together are not all restarted at once
+        self.task_limit = round(self.max_tasks * random.uniform(0.9, 1.1)) if self.max_tasks else None
+        self.recycling = None
+        self.closing = False
+
+    def recycle_reason(self) -> str | None:
+        """Why the worker should be restarted now, or None."""
+        if self.task_limit and self.tasks >= self.task_limit:
+            return f'ran {self.tasks} tasks'
+        if self.max_rss and self.process.memory_info().rss > self.max_rss:
+            trim_memory()
+            if (rss := self.process.memory_info().rss) > self.max_rss:
+                return f'RSS of {rss / 2**30:.2f} GiB'
+        return None
+
+    def transition(self, key, start, finish, **kwargs):
+        if self.recycling:
+            self.close(force=False)
+        elif start == 'executing':
+            self.tasks += 1
+            if (reason := self.recycle_reason()) is not None:
+                self.recycling = reason
+                logger.info(f'Restarting worker {self.worker.address} once its tasks are done: {reason}')
+                # like a retiring worker, it finishes its running tasks but starts and receives no new ones
+                self.worker.status = Status.closing_gracefully
+                self.worker.loop.call_later(self.grace_seconds, self.close, True)
+                self.close(force=False)
+
+    def close(self, force: bool):
+        # results still held by a worker are lost if no other worker can take them when it is retired
+        if self.closing or (not force and (self.worker.state.executing or len(self.worker.data))):
+            return
+        self.closing = True
+        self.worker.loop.add_callback(self.restart)
+
+    async def restart(self):
+        await self.worker.scheduler.retire_workers(
+            workers=[self.worker.address], close_workers=False, remove=True, stimulus_id=f'recycle-{time.time()}'
+        )
+        await self.worker.close(nanny=False, reason=f'recycle: {self.recycling}')
+
+
+class ReadLimiterPlugin(WorkerPlugin):
+    """
+    Installs a `fetch.AdaptiveLimiter` as the read limiter of each dask worker process (`fetch.set_read_limiter`).
+
+    The reads of all the threads of a worker share it, so a worker should have about as many threads as the
+    limiter's `maximum`. The current limit and the reads throttled so far are reported as the `read_limit` and
+    `reads_throttled` worker metrics (`client.scheduler_info()`).
+
+    Args:
+        options: Arguments of `AdaptiveLimiter`.
+    """
+
+    name = 'read-limiter'
+
+    def __init__(self, **options):
+        self.options = options
+
+    def setup(self, worker):
+        limiter = AdaptiveLimiter(**self.options)
+        set_read_limiter(limiter)
+        worker.metrics['read_limit'] = lambda worker: limiter.limit
+        worker.metrics['reads_throttled'] = lambda worker: limiter.throttled
+
+    def teardown(self, worker):
+        set_read_limiter(None)
+
+
+class HedgedReadPlugin(WorkerPlugin):
+    """
+    Installs a `fetch.HedgedReader` as the read hedger of each dask worker process (`fetch.set_read_hedger`).
+
+    The reads hedged so far, and how many of the hedges returned first, are reported as the `reads_hedged` and
+    `hedges_won` worker metrics (`client.scheduler_info()`).
+
+    Args:
+        options: Arguments of `HedgedReader`.
+    """
+
+    name = 'hedged-reads'
+
+    def __init__(self, **options):
+        self.options = options
+
+    def setup(self, worker):
+        hedger = HedgedReader(**self.options)
+        set_read_hedger(hedger)
+        worker.metrics['reads_hedged'] = lambda worker: hedger.hedged
+        worker.metrics['hedges_won'] = lambda worker: hedger.hedges_won
+
+    def teardown(self, worker):
+        if (hedger := get_read_hedger()) is not None:
+            hedger.close()
+        set_read_hedger(None)
+
+
+def worker_metrics(client, metric: str) -> dict:
+    """The `metric` of every worker of a dask cluster, by worker name (None where a worker doesn't report it)."""
+    return {
+        info.get('name', address): info.get('metrics', {}).get(metric)
+        for address, info in client.scheduler_info()['workers'].items()
+    }
+
+
+def read_limits(client) -> dict:
+    """The `read_limit` metric of every worker of a dask cluster with a `ReadLimiterPlugin`."""
+    return worker_metrics(client, 'read_limit')
 
 
 def post_or_put(url: str, data: dict):
@@ -204,10 +466,10 @@ def cache_parquet_file(s3_paths: List[str], cache_root: str = '/tmp/duck_cache')
     local_paths = []
     for s3_path in s3_paths:
         local_path = s3_path_to_local_path(s3_path, cache_root=cache_root)
-        matching_files = s3_fs.glob(s3_path)
 
         # Download file if not already cached
         if not os.path.exists(local_path):
+            matching_files = s3_fs.glob(s3_path)
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
             logger.debug(f'Downloading {len(matching_files)} parquet files to: {local_path}')
             s3_fs.get(matching_files, local_path)
@@ -240,6 +502,7 @@ def get_overlapping_grid_names(
     date_range: str = 'all',
     resolution: int = 2,
     overlap: str = 'overlap',
+    partitions: set | None = None,
 ):
     """
     Generates a list of S3 path prefixes corresponding to spatial grid tiles that overlap
@@ -269,6 +532,9 @@ def get_overlapping_grid_names(
     overlap : str, optional
         Only used if `partition_type` is "h3". Passed to the `h3shape_to_cells_experimental` function
         to control overlap behavior.
+    partitions : set, optional
+        Existing partition prefixes as returned by `list_partitions`. When given, candidate tiles are
+        checked against it instead of issuing one existence request per tile.
 
     Returns:
     -------
@@ -284,6 +550,8 @@ def get_overlapping_grid_names(
 
     logger.debug(f'Extracted year ranges: {year_ranges}')
 
+    exists = path_exists if partitions is None else partitions.__contains__
+
     if partition_type == 'latlon':
         # ITS_LIVE uses a fixed 10 by 10 grid  (centroid as name for the cell e.g. N60W040)
         def lat_prefix(lat):
@@ -315,7 +583,7 @@ def get_overlapping_grid_names(
                     grids.add(name)
 
         prefixes = [f'{base_href}/{p}/{i}' for p in missions for i in list(grids)]
-        search_prefixes = [f'{path}/**/*.parquet' for path in prefixes if path_exists(path)]
+        search_prefixes = [f'{path}/**/*.parquet' for path in prefixes if exists(path)]
         return search_prefixes
     elif partition_type == 'h3':
         grids_hex = h3.h3shape_to_cells_experimental(h3.geo_to_h3shape(geojson_geometry), resolution, overlap)
@@ -323,7 +591,7 @@ def get_overlapping_grid_names(
         grids = [int(hs, 16) for hs in grids_hex]
         prefixes = [f'{base_href}/{p}' for p in grids]
         # TODO: implement year filtering
-        search_prefixes = [f'{prefix}/**/*.parquet' for prefix in prefixes if path_exists(prefix)]
+        search_prefixes = [f'{prefix}/**/*.parquet' for prefix in prefixes if exists(prefix)]
         return search_prefixes
     else:
         raise NotImplementedError(f'Partition {partition_type} not implemented.')
@@ -371,11 +639,53 @@ def path_exists(path: str) -> bool:
         return os.path.exists(path)
 
 
+def list_partitions(base_href: str, partition_type: str = 'latlon') -> set:
+    """
+    List the spatial partitions that exist under a geoparquet catalog.
+
+    The result can be passed to `get_overlapping_grid_names` (or `serverless_search`) as `partitions`
+    so that a long-lived process resolves the catalog layout once instead of on every search.
+
+    Args:
+        base_href (str): Base path of the partitioned catalog, local or s3://
+        partition_type (str, optional): "latlon" (mission/grid partitions) or "h3" (one level of cells).
+
+    Returns:
+        set: Partition prefixes in the same form `get_overlapping_grid_names` builds them.
+    """
+    base_href = base_href.rstrip('/')
+
+    def list_dirs(path):
+        if path.startswith('s3://'):
+            return [f's3://{entry["name"]}' for entry in s3_fs.ls(path, detail=True) if entry['type'] == 'directory']
+        if not os.path.isdir(path):
+            return []
+        return [f'{path}/{name}' for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+    if partition_type == 'latlon':
+        return {partition for mission in list_dirs(base_href) for partition in list_dirs(mission)}
+    elif partition_type == 'h3':
+        return set(list_dirs(base_href))
+    else:
+        raise NotImplementedError(f'Partition {partition_type} not implemented.')
+
+
+def cql2_properties(expr) -> list:
+    """Names of the properties referenced anywhere in a cql2-json expression, in order of appearance."""
+    if isinstance(expr, dict):
+        if 'property' in expr:
+            return [expr['property']]
+        return [prop for value in expr.values() for prop in cql2_properties(value)]
+    if isinstance(expr, list):
+        return [prop for value in expr for prop in cql2_properties(value)]
+    return []
+
+
 def build_cql2_filter(filters_list):
     valid_filters = [f for f in filters_list if f and f != {}]
     if not valid_filters:
         return None
-    return filters_list[0] if len(filters_list) == 1 else {'op': 'and', 'args': filters_list}
+    return valid_filters[0] if len(valid_filters) == 1 else {'op': 'and', 'args': valid_filters}
 
 
 def serverless_search(
@@ -388,6 +698,8 @@ def serverless_search(
     resolution: int = 2,
     overlap: str = 'overlap',
     asset_type: str = '.nc',
+    duckdb_pool: DuckDBPool | None = None,
+    partitions: set | None = None,
 ):
     """
     Performs a serverless!! search over partitioned STAC catalogs stored in Parquet format for the ITS_LIVE project.
@@ -420,6 +732,11 @@ def serverless_search(
         to handle partial overlaps.
     asset_type : str, optional
         A string suffix filter to match asset HREFs (e.g., ".nc" for NetCDF files).
+    duckdb_pool : DuckDBPool, optional
+        Pool to take the calling thread's DuckDB cursor from when `engine` is "duckdb".
+        Defaults to the process-wide pool returned by `get_duckdb_pool()`.
+    partitions : set, optional
+        Known partition prefixes from `list_partitions`, used to skip per-tile existence checks.
 
     Returns
     -------
@@ -427,6 +744,59 @@ def serverless_search(
         A list of asset URLs (typically `.nc` NetCDF files) that match the search criteria.
 
     """
+    hrefs = [
+        record['href']
+        for record in iter_serverless_search(
+            base_catalog_href=base_catalog_href,
+            search_kwargs=search_kwargs,
+            engine=engine,
+            cache=cache,
+            reduce_spatial_search=reduce_spatial_search,
+            partition_type=partition_type,
+            resolution=resolution,
+            overlap=overlap,
+            asset_type=asset_type,
+            duckdb_pool=duckdb_pool,
+            partitions=partitions,
+        )
+    ]
+    return sorted(list(set(hrefs)))
+
+
+def iter_serverless_search(
+    base_catalog_href: str = 's3://its-live-data/test-space/stac/geoparquet/latlon',
+    search_kwargs: dict = {},
+    engine: str = 'rustac',
+    cache: bool = True,
+    reduce_spatial_search=True,
+    partition_type: str = 'latlon',
+    resolution: int = 2,
+    overlap: str = 'overlap',
+    asset_type: str = '.nc',
+    duckdb_pool: DuckDBPool | None = None,
+    partitions: set | None = None,
+    properties: tuple = (),
+    batch_size: int = 10000,
+):
+    """
+    Streaming version of `serverless_search`, yielding matches as they are read instead of collecting them.
+
+    Takes the same parameters as `serverless_search`, plus:
+
+    properties : tuple, optional
+        Item properties to include with each record, e.g. ("datetime", "percent_valid_pixels").
+    batch_size : int, optional
+        Number of rows converted to records at a time.
+
+    The duckdb engine streams each prefix's result in batches of `batch_size` rows, while rustac returns the
+    whole result of a prefix at once, so with rustac memory peaks at the result of one prefix.
+
+    Yields
+    ------
+    dict
+        One record per matching item with the data asset `href` and the requested `properties`.
+        Records are neither sorted nor deduplicated.
+    """
     store = base_catalog_href
     search_prefixes = []
 
@@ -439,6 +809,7 @@ def serverless_search(
                 partition_type=partition_type,
                 resolution=resolution,
                 overlap=overlap,
+                partitions=partitions,
             )
     else:
         if partition_type == 'latlon':
@@ -455,10 +826,16 @@ def serverless_search(
     filters = search_kwargs['filter'] if 'filter' in search_kwargs else []
 
     logger.debug(f'Searching in {search_prefixes} with filters: {filters} ')
-    hrefs = []
+    # rustac takes the STAC search parameters as they are, with the filters combined into one cql2 expression
+    rustac_kwargs = {key: value for key, value in search_kwargs.items() if key != 'filter'}
+    rustac_kwargs['filter'] = build_cql2_filter(filters)
+    # rustac applies the filter to the included columns, so the filtered properties have to be read as well
+    rustac_include = list(dict.fromkeys(['assets', *properties, *cql2_properties(rustac_kwargs['filter'])]))
+    selected_properties = ''.join(f', "{prop}"' for prop in properties)
     # TODO: this could run in parallel on a thread or could be passed all to DuckDB/rustac as a combined list of paths.
     # for debugging purposes querying one by one is more convenient for now.
     for prefix in search_prefixes:
+        matches = 0
         try:
             if engine == 'duckdb':
                 # TODO: make it more flexible
@@ -478,32 +855,40 @@ def serverless_search(
                         date_filter_sql = f"AND datetime <= TIMESTAMP '{end_date}'"
                 query = f"""
                     SELECT 
-                        assets -> 'data' ->> 'href' AS data_href
+                        assets -> 'data' ->> 'href' AS data_href{selected_properties}
                     FROM read_parquet('{prefix}', union_by_name=true)
                     WHERE ST_Intersects(
                         geometry,
                         ST_GeomFromGeoJSON('{geojson_str}')
                     )
+                    AND ends_with(data_href, '{asset_type}')
                     {date_filter_sql}
-                    AND {filters_sql}
+                    {f'AND {filters_sql}' if filters_sql else ''}
                 """
                 logger.debug(f'Running DuckDB query: {query}')
-                items = con.execute(query).df()  # memory intensive?
-                links = items['data_href'].to_list()
-                hrefs.extend(links)
+                cursor = (duckdb_pool or get_duckdb_pool()).cursor()
+                reader = cursor.execute(query).to_arrow_reader(batch_size)
+                for batch in reader:
+                    columns = {name: batch.column(name).to_pylist() for name in batch.schema.names}
+                    for i, href in enumerate(columns.pop('data_href')):
+                        yield {'href': href, **{prop: columns[prop][i] for prop in properties}}
+                    matches += batch.num_rows
             elif engine == 'rustac':
-                # can we use include to only bring the asset links?
-                search_kwargs['filter'] = build_cql2_filter(filters)
-                client = rustac.DuckdbClient()
-                items = client.search(prefix, **search_kwargs)
-                for item in items:
-                    for asset in item['assets'].values():
-                        if 'data' in asset['roles'] and asset['href'].endswith('.nc'):
-                            hrefs.append(asset['href'])
+                # only the assets (and requested properties) are read, and they come back as Arrow columns
+                # instead of one python dict per item
+                table = get_rustac_client().search_to_arrow(prefix, include=rustac_include, **rustac_kwargs)
+                if table is not None:
+                    for batch in pa.RecordBatchReader.from_stream(table):
+                        for offset in range(0, batch.num_rows, batch_size):
+                            chunk = batch.slice(offset, batch_size)
+                            hrefs = pc.struct_field(chunk.column('assets'), ['data', 'href']).to_pylist()
+                            columns = {prop: chunk.column(prop).to_pylist() for prop in properties}
+                            for i, href in enumerate(hrefs):
+                                if href and href.endswith(asset_type):
+                                    yield {'href': href, **{prop: columns[prop][i] for prop in properties}}
+                                    matches += 1
             else:
                 raise NotImplementedError(f'Not a valid query engine: {engine}')
-            logger.info(f'Prefx: {prefix} | matching items: {len(items)}')
+            logger.info(f'Prefx: {prefix} | matching items: {matches}')
         except Exception as e:
             logger.error(f'Error while searching in {prefix}: {e}')
-
-    return sorted(list(set(hrefs)))
@@ -0,0 +1,235 @@
+"""
+Archive-wide virtual Zarr stores built from the per-granule kerchunk references.
+
+`save_metadata` writes one `<id>.ref.json` per granule, so opening N granules costs N metadata fetches.
+`build_virtual_stores` merges the references of a region into one kerchunk parquet reference store per
+prefix and year (the grouping `BatchWriter` and `RegionTracker` use for the STAC items), with each granule
+as a Zarr group named after its id. A reader fetches the store's `.zmetadata` once and then loads the
+parquet partitions of only the variables it touches:
+
+    ds = open_virtual_granule('N60W040/2015.parq', granule_id, remote_options={'anon': True})
+
+References are streamed: each granule is read, added and released, and partitions are written out every
+`flush_every` granules, so only the (small) metadata of the whole store is kept in memory.
+"""
+
+import argparse
+import json
+import logging
+import posixpath
+from collections import defaultdict
+from collections.abc import Iterable
+
+import fsspec
+import xarray as xr
+from fsspec.implementations.reference import LazyReferenceMapper
+
+from .generatebatched import get_mid_date_from_filename
+
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_SUFFIX = '.ref.json'
+STORE_SUFFIX = '.parq'
+
+ZGROUP = json.dumps({'zarr_format': 2})
+
+
+def _is_metadata_key(key: str) -> bool:
+    return key.rsplit('/', 1)[-1].startswith('.z')
+
+
+class VirtualStoreBuilder:
+    """
+    Merges kerchunk references of many granules into one parquet reference store.
+
+    Every granule becomes a group named after its id. Zarr metadata keys are written before the chunk keys
+    of a granule, as the partition of a chunk is derived from its array's `.zarray`.
+    """
+
+    def __init__(self, url: str, fs=None, record_size: int = 10_000, flush_every: int = 500):
+        if fs is None:
+            fs, _ = fsspec.core.url_to_fs(url)
+        self.url = url
+        self.flush_every = flush_every
+        self.granule_ids = set()
+        self.pending = 0
+        self.out = LazyReferenceMapper.create(url, fs=fs, record_size=record_size)
+        self.out['.zgroup'] = ZGROUP
+
+    def add(self, granule_id: str, refs: dict):
+        """Add the references of one granule, as returned by `SingleHdf5ToZarr.translate` or read from `.ref.json`."""
+        if granule_id in self.granule_ids:
+            logger.warning(f'Skipping duplicate references for {granule_id}')
+            return False
+
+        refs = refs.get('refs', refs)
+        for key in sorted(refs, key=lambda key: not _is_metadata_key(key)):
+            self.out[f'{granule_id}/{key}'] = refs[key]
+        self.granule_ids.add(granule_id)
+
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Write the buffered partitions and the store metadata."""
+        self.out.flush()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        logger.info(f'Wrote virtual store of {len(self.granule_ids)} granules to {self.url}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def granule_id_from_reference(path: str) -> str:
+    """The granule id of a `<id>.ref.json` file, as written by `save_metadata`."""
+    return posixpath.basename(path).removesuffix(REFERENCE_SUFFIX)
+
+
+def group_reference_files(paths: Iterable[str]) -> dict:
+    """
+    Group reference files by prefix (their directory) and mid-date year, like `BatchWriter` groups STAC items.
+
+    Returns:
+        dict: `{(prefix, year): [paths]}`, with the paths of every group sorted.
+    """
+    groups = defaultdict(list)
+    for path in paths:
+        year = get_mid_date_from_filename(granule_id_from_reference(path))[0:4]
+        groups[(posixpath.dirname(path), year)].append(path)
+    return {key: sorted(group) for key, group in sorted(groups.items())}
+
+
+def build_virtual_store(
+    reference_paths: Iterable[str],
+    url: str,
+    fs=None,
+    reference_fs=None,
+    record_size: int = 10_000,
+    flush_every: int = 500,
+) -> int:
+    """
+    Stream the `.ref.json` files in `reference_paths` into one parquet reference store at `url`.
+
+    Args:
+        reference_paths (Iterable[str]): Paths of per-granule references.
+        url (str): Directory of the store, local or s3://. Existing contents are removed.
+        fs (fsspec.AbstractFileSystem, optional): Filesystem to write the store with, derived from `url`.
+        reference_fs (fsspec.AbstractFileSystem, optional): Filesystem of the references, `fs` if not given.
+        record_size (int, optional): Number of references per parquet partition.
+        flush_every (int, optional): Granules buffered before their partitions are written.
+
+    Returns:
+        int: the number of granules in the store.
+    """
+    if fs is None:
+        fs, _ = fsspec.core.url_to_fs(url)
+    reference_fs = reference_fs or fs
+    with VirtualStoreBuilder(url, fs=fs, record_size=record_size, flush_every=flush_every) as builder:
+        for path in reference_paths:
+            with reference_fs.open(path, 'rb') as f:
+                builder.add(granule_id_from_reference(path), json.load(f))
+    return len(builder.granule_ids)
+
+
+def build_virtual_stores(
+    references: str, output: str, record_size: int = 10_000, flush_every: int = 500, storage_options: dict | None = None
+) -> dict:
+    """
+    Build one virtual store per prefix and year from all the `.ref.json` files under `references`.
+
+    Stores are written to `<output>/<prefix relative to references>/<year>.parq`, mirroring the
+    `<prefix>/<year>.ndjson` layout of the STAC items.
+
+    Returns:
+        dict: `{store url: number of granules}`.
+    """
+    fs, root = fsspec.core.url_to_fs(references, **(storage_options or {}))
+    out_fs, out_root = fsspec.core.url_to_fs(output, **(storage_options or {}))
+    paths = [path for path in fs.find(root) if path.endswith(REFERENCE_SUFFIX)]
+    logger.info(f'Found {len(paths)} kerchunk references under {references}')
+
+    stores = {}
+    for (prefix, year), group in group_reference_files(paths).items():
+        relative = posixpath.relpath(prefix, root.rstrip('/'))
+        url = posixpath.normpath(posixpath.join(out_root, relative, f'{year}{STORE_SUFFIX}'))
+        count = build_virtual_store(
+            group, url, fs=out_fs, reference_fs=fs, record_size=record_size, flush_every=flush_every
+        )
+        stores[out_fs.unstrip_protocol(url)] = count
+    return stores
+
+
+def virtual_store_granules(url: str, storage_options: dict | None = None) -> list:
+    """List the granule ids of a virtual store from its `.zmetadata` alone."""
+    fs, root = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    metadata = json.loads(fs.cat_file(f'{root.rstrip("/")}/.zmetadata'))['metadata']
+    return sorted(key.split('/', 1)[0] for key in metadata if key.count('/') == 1 and key.endswith('/.zgroup'))
+
+
+def open_virtual_granule(
+    url: str, granule_id: str, remote_protocol: str = 's3', remote_options: dict | None = None, **kwargs
+) -> xr.Dataset:
+    """
+    Open one granule of a virtual store lazily with xarray.
+
+    Opening several granules of the same store reuses the cached reference filesystem, so the store metadata
+    is only fetched once.
+
+    Args:
+        url (str): Virtual store written by `build_virtual_store`.
+        granule_id (str): Group of the granule in the store.
+        remote_protocol (str, optional): Protocol of the granules the references point to.
+        remote_options (dict, optional): Storage options of the granules, e.g. `{'anon': True}`.
+        kwargs: Passed on to `xarray.open_dataset`.
+    """
+    storage_options = {'fo': url, 'remote_protocol': remote_protocol, 'remote_options': remote_options or {}}
+    # The group is part of the URL: zarr lists `group=` paths with a leading slash the reference filesystem rejects
+    return xr.open_dataset(
+        f'reference://{granule_id}',
+        engine='zarr',
+        zarr_format=2,
+        consolidated=False,
+        storage_options=storage_options,
+        **kwargs,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge per-granule kerchunk references into one virtual Zarr store per prefix and year'
+    )
+    parser.add_argument('-r', '--references', required=True, help='Local or s3:// prefix containing .ref.json files')
+    parser.add_argument('-o', '--output', required=True, help='Local or s3:// directory of the virtual stores')
+    parser.add_argument('--record-size', type=int, default=10_000, help='References per parquet partition')
+    parser.add_argument('--flush-every', type=int, default=500, help='Granules buffered before writing partitions')
+    parser.add_argument('--anon', action='store_true', help='Read and write S3 anonymously')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p',
+        level=logging.INFO,
+    )
+    stores = build_virtual_stores(
+        args.references,
+        args.output,
+        record_size=args.record_size,
+        flush_every=args.flush_every,
+        storage_options={'anon': True} if args.anon else None,
+    )
+    for url, count in stores.items():
+        logger.info(f'{url}: {count} granules')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+"""
+Pull-based work queue shared by batch tasks, instead of a static unit per `COILED_BATCH_TASK_ID`.
+
+The queue is a lease table of work units (e.g. the shards of a `shards` manifest). A task claims a unit, renews
+its lease with heartbeats while it processes it and marks it done, then claims the next one until the queue is
+drained, so fast tasks keep pulling work while slow ones finish theirs. A unit whose lease expires, because its
+task was preempted or died, is claimed again by another task; a unit that fails `max_attempts` times is marked
+failed instead of being retried forever. A task that finds its lease lost (a heartbeat failed) stops the unit at
+its next `check_lease`, so two tasks never write the outputs of the same unit.
+
+There is no central service. The lease table is either
+
+- a SQLite database (`SQLiteWorkQueue`), for tests and tasks sharing a filesystem, or
+- one JSON object per unit in an object store (`ObjectStoreWorkQueue`), updated with conditional writes
+  (`If-None-Match`/`If-Match` on S3), so two tasks can never hold the same lease.
+
+    queue = open_queue('s3://bucket/queues/landsat')
+    queue.add(str(shard) for shard in range(500))
+    run_worker(queue, lambda unit: process_row_group(manifest, int(unit), manifest=True, use_batch_task_id=False))
+"""
+
+import abc
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+import fsspec
+import obstore as obs
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from obstore.exceptions import AlreadyExistsError, PreconditionError
+from obstore.store import MemoryStore, from_url
+
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 600
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, LEASED, DONE, FAILED)
+
+
+def _claimable(state: dict, now: float) -> bool:
+    return state['state'] == PENDING or (state['state'] == LEASED and state['lease_expires'] < now)
+
+
+class WorkQueue(abc.ABC):
+    """
+    Lease table of work units, identified by strings.
+
+    Args:
+        max_attempts (int, optional): Claims of a unit before it is marked failed when it is released with an
+            error or its lease expires.
+    """
+
+    def __init__(self, max_attempts: int = 3):
+        self.max_attempts = max_attempts
+
+    @abc.abstractmethod
+    def add(self, units: Iterable[str]) -> int:
+        """Add pending units; units already in the queue are left as they are. Returns the number added."""
+
+    @abc.abstractmethod
+    def claim(self, worker: str, lease_seconds: float = LEASE_SECONDS) -> str | None:
+        """Lease a pending (or expired) unit to `worker`, or return None if there is none."""
+
+    @abc.abstractmethod
+    def heartbeat(self, unit: str, worker: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        """Extend the lease of `worker` on `unit`; False if the lease was lost (expired and claimed by another)."""
+
+    @abc.abstractmethod
+    def complete(self, unit: str, worker: str) -> bool:
+        """Mark a unit leased by `worker` as done; False if the lease was lost."""
+
+    @abc.abstractmethod
+    def release(self, unit: str, worker: str, error: str | None = None) -> bool:
+        """Give a unit back after a failure: pending again, or failed after `max_attempts` claims."""
+
+    @abc.abstractmethod
+    def counts(self) -> dict:
+        """Number of units in each state."""
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue in a SQLite database, for tests and for tasks that share a filesystem."""
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        super().__init__(max_attempts=max_attempts)
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'unit TEXT PRIMARY KEY, state TEXT NOT NULL, owner TEXT, lease_expires REAL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, error TEXT)'
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per operation, so the heartbeat thread never shares one with the worker
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _update(self, query: str, parameters: tuple) -> bool:
+        connection = self._connect()
+        try:
+            return connection.execute(query, parameters).rowcount == 1
+        finally:
+            connection.close()
+
+    def add(self, units: Iterable[str]) -> int:
+        connection = self._connect()
+        try:
+            before = connection.total_changes
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(
+                'INSERT OR IGNORE INTO units (unit, state) VALUES (?, ?)', ((unit, PENDING) for unit in units)
+            )
+            connection.execute('COMMIT')
+            return connection.total_changes - before
+        finally:
+            connection.close()
+
+    def claim(self, worker: str, lease_seconds: float = LEASE_SECONDS) -> str | None:
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'UPDATE units SET state = ?, owner = NULL WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                (FAILED, LEASED, now, self.max_attempts),
+            )
+            row = connection.execute(
+                'SELECT unit FROM units WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                'ORDER BY attempts, unit LIMIT 1',
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE units SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE unit = ?',
+                    (LEASED, worker, now + lease_seconds, row[0]),
+                )
+            connection.execute('COMMIT')
+            return None if row is None else row[0]
+        finally:
+            connection.close()
+
+    def heartbeat(self, unit: str, worker: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        return self._update(
+            'UPDATE units SET lease_expires = ? WHERE unit = ? AND owner = ? AND state = ?',
+            (time.time() + lease_seconds, unit, worker, LEASED),
+        )
+
+    def complete(self, unit: str, worker: str) -> bool:
+        return self._update(
+            'UPDATE units SET state = ?, error = NULL WHERE unit = ? AND owner = ? AND state = ?',
+            (DONE, unit, worker, LEASED),
+        )
+
+    def release(self, unit: str, worker: str, error: str | None = None) -> bool:
+        return self._update(
+            'UPDATE units SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, owner = NULL, error = ? '
+            'WHERE unit = ? AND owner = ? AND state = ?',
+            (self.max_attempts, FAILED, PENDING, error, unit, worker, LEASED),
+        )
+
+    def counts(self) -> dict:
+        connection = self._connect()
+        try:
+            rows = dict(connection.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall())
+        finally:
+            connection.close()
+        return {state: rows.get(state, 0) for state in STATES}
+
+
+class ObjectStoreWorkQueue(WorkQueue):
+    """
+    Work queue of one `units/<unit>.json` object per unit in an obstore store.
+
+    Units are created with `If-None-Match` and every state change is a write conditioned on the ETag the task
+    read (`If-Match`), so of two tasks claiming the same unit only one succeeds. The store must support
+    conditional writes, as S3 and `MemoryStore` do.
+    """
+
+    def __init__(self, store, max_attempts: int = 3):
+        super().__init__(max_attempts=max_attempts)
+        self.store = store
+
+    @staticmethod
+    def _path(unit: str) -> str:
+        return f'units/{unit}.json'
+
+    def _read(self, unit: str) -> tuple[dict, str]:
+        result = obs.get(self.store, self._path(unit))
+        return json.loads(bytes(result.bytes())), result.meta['e_tag']
+
+    def _write(self, unit: str, state: dict, e_tag: str) -> bool:
+        try:
+            obs.put(self.store, self._path(unit), json.dumps(state).encode(), mode={'e_tag': e_tag})
+        except PreconditionError:
+            return False
+        return True
+
+    def _units(self) -> list:
+        return [
+            meta['path'].rsplit('/', 1)[-1].removesuffix('.json')
+            for batch in obs.list(self.store, prefix='units/')
+            for meta in batch
+        ]
+
+    def add(self, units: Iterable[str]) -> int:
+        added = 0
+        for unit in units:
+            state = {'state': PENDING, 'owner': None, 'lease_expires': None, 'attempts': 0, 'error': None}
+            try:
+                obs.put(self.store, self._path(unit), json.dumps(state).encode(), mode='create')
+                added += 1
+            except AlreadyExistsError:
+                pass
+        return added
+
+    def claim(self, worker: str, lease_seconds: float = LEASE_SECONDS) -> str | None:
+        units = self._units()
+        # start at a random unit, so tasks starting together don't all race for the first one
+        start = random.randrange(len(units)) if units else 0
+        for unit in units[start:] + units[:start]:
+            state, e_tag = self._read(unit)
+            now = time.time()
+            if not _claimable(state, now):
+                continue
+            if state['state'] == LEASED and state['attempts'] >= self.max_attempts:
+                self._write(unit, {**state, 'state': FAILED, 'owner': None}, e_tag)
+                continue
+            claimed = {
+                **state,
+                'state': LEASED,
+                'owner': worker,
+                'lease_expires': now + lease_seconds,
+                'attempts': state['attempts'] + 1,
+            }
+            if self._write(unit, claimed, e_tag):
+                return unit
+        return None
+
+    def _update_lease(self, unit: str, worker: str, **changes) -> bool:
+        state, e_tag = self._read(unit)
+        if state['state'] != LEASED or state['owner'] != worker:
+            return False
+        return self._write(unit, {**state, **changes}, e_tag)
+
+    def heartbeat(self, unit: str, worker: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        return self._update_lease(unit, worker, lease_expires=time.time() + lease_seconds)
+
+    def complete(self, unit: str, worker: str) -> bool:
+        return self._update_lease(unit, worker, state=DONE, error=None)
+
+    def release(self, unit: str, worker: str, error: str | None = None) -> bool:
+        state, _ = self._read(unit)
+        next_state = FAILED if state['attempts'] >= self.max_attempts else PENDING
+        return self._update_lease(unit, worker, state=next_state, owner=None, error=error)
+
+    def counts(self) -> dict:
+        counts = dict.fromkeys(STATES, 0)
+        for unit in self._units():
+            counts[self._read(unit)[0]['state']] += 1
+        return counts
+
+
+def open_queue(url: str, max_attempts: int = 3) -> WorkQueue:
+    """
+    Open a work queue: `sqlite:///path` or a `.db`/`.sqlite` path for SQLite, `memory://` for an in-process
+    queue, or an object store URL (e.g. `s3://bucket/prefix`).
+    """
+    if url.startswith('sqlite://'):
+        return SQLiteWorkQueue(url.removeprefix('sqlite://'), max_attempts=max_attempts)
+    if url.endswith(('.db', '.sqlite')):
+        return SQLiteWorkQueue(url, max_attempts=max_attempts)
+    if url.startswith('memory://'):
+        return ObjectStoreWorkQueue(MemoryStore(), max_attempts=max_attempts)
+    return ObjectStoreWorkQueue(from_url(url), max_attempts=max_attempts)
+
+
+class LeaseLost(Exception):
+    """Raised by `check_lease` when the unit being processed was claimed by another task."""
+
+
+# The lease of the unit `run_worker` is processing in this thread, set by its heartbeat once lost
+_lease = threading.local()
+
+
+def check_lease():
+    """
+    Raise `LeaseLost` if the lease of the unit `run_worker` is processing in this thread was lost.
+
+    `process` calls it before it writes or uploads the results of a unit, so a task whose lease expired and was
+    claimed by another task stops instead of writing the same outputs. Outside `run_worker` it does nothing.
+    """
+    lost = getattr(_lease, 'lost', None)
+    if lost is not None and lost.is_set():
+        raise LeaseLost(f'The lease of {_lease.unit} was lost')
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def run_worker(
+    queue: WorkQueue,
+    process: Callable[[str], object],
+    worker: str | None = None,
+    lease_seconds: float = LEASE_SECONDS,
+    heartbeat_seconds: float | None = None,
+    poll_seconds: float = 30,
+) -> dict:
+    """
+    Claim and process units of `queue` until it is drained.
+
+    While `process(unit)` runs, the lease is renewed every `heartbeat_seconds` (a third of the lease by default).
+    A unit is marked done when `process` returns, and released when it raises. When no unit can be claimed but
+    others are still leased, the worker waits `poll_seconds` and tries again, so it picks up the units of tasks
+    that died once their leases expire.
+
+    If a heartbeat finds the lease lost, `check_lease` raises `LeaseLost` in `process` from then on. The unit
+    is left to the task that holds it now and counted as lost, as is a unit `process` finished after losing it.
+
+    Returns:
+        dict: the number of units this worker completed, failed and lost.
+    """
+    worker = worker or default_worker_id()
+    heartbeat_seconds = heartbeat_seconds or lease_seconds / 3
+    processed = {'done': 0, 'failed': 0, 'lost': 0}
+
+    while True:
+        unit = queue.claim(worker, lease_seconds=lease_seconds)
+        if unit is None:
+            if queue.counts()[LEASED] == 0:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        logger.info(f'{worker} claimed {unit}')
+        stop, lost = threading.Event(), threading.Event()
+
+        def beat(unit=unit, stop=stop, lost=lost):
+            while not stop.wait(heartbeat_seconds):
+                if not queue.heartbeat(unit, worker, lease_seconds=lease_seconds):
+                    logger.warning(f'{worker} lost the lease of {unit}, stopping it')
+                    lost.set()
+                    return
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        _lease.unit, _lease.lost = unit, lost
+        heartbeat.start()
+        try:
+            process(unit)
+        except LeaseLost:
+            processed['lost'] += 1
+        except Exception as e:
+            logger.error(f'{worker} failed to process {unit}: {e}')
+            queue.release(unit, worker, error=str(e))
+            processed['failed'] += 1
+        else:
+            if queue.complete(unit, worker):
+                processed['done'] += 1
+            else:
+                logger.warning(f'{worker} finished {unit} after losing its lease')
+                processed['lost'] += 1
+        finally:
+            _lease.lost = None
+            stop.set()
+            heartbeat.join()
+
+    logger.info(f'{worker} is done: {processed}, queue {queue.counts()}')
+    return processed
+
+
+def manifest_units(manifest: str, storage_options: dict | None = None) -> list:
+    """The shard ids of a `shards` manifest, as work units."""
+    if storage_options is None:
+        storage_options = {'anon': True} if manifest.startswith('s3://') else {}
+    fs, path = fsspec.core.url_to_fs(manifest, **storage_options)
+    shards = pq.read_table(path, filesystem=fs, columns=['shard'])
+    return [str(shard) for shard in sorted(pc.unique(shards['shard']).to_pylist())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the work queue shared by batch tasks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='Add the shards of a manifest (or N units) to a queue')
+    init_parser.add_argument('-q', '--queue', required=True, help='Queue URL: s3://bucket/prefix or a .db path')
+    source = init_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-m', '--manifest', help='Shard manifest (see plan-shards)')
+    source.add_argument('-n', '--units', type=int, help='Add units 0 to N-1')
+
+    status_parser = subparsers.add_parser('status', help='Count the units of a queue in each state')
+    status_parser.add_argument('-q', '--queue', required=True, help='Queue URL: s3://bucket/prefix or a .db path')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p',
+        level=logging.INFO,
+    )
+    queue = open_queue(args.queue)
+    if args.command == 'init':
+        units = manifest_units(args.manifest) if args.manifest else [str(unit) for unit in range(args.units)]
+        logger.info(f'Added {queue.add(units)} of {len(units)} units to {args.queue}')
+    logger.info(f'{args.queue}: {queue.counts()}')
+
+
+if __name__ == '__main__':
+    main()
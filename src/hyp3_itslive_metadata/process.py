@@ -4,16 +4,18 @@ import logging
 from pathlib import Path
 
 from hyp3_itslive_metadata.cryoforge import generate_itslive_metadata, save_metadata
+from hyp3_itslive_metadata.cryoforge.timing import StageTimer
 
 
 log = logging.getLogger(__name__)
 
 
-def process_itslive_metadata(granule_uri: str) -> tuple[Path, Path, Path]:
+def process_itslive_metadata(granule_uri: str, timer: StageTimer | None = None) -> tuple[Path, Path, Path]:
     """Generates ITS_LIVE granule metadata files from a source S3 bucket and prefix.
 
     Args:
         granule_uri: URI to the granule or folder (s3://<bucket>/<prefix>) for the granule.
+        timer: Optional `StageTimer` recording the time spent in each stage for this granule.
 
     Outputs:
         stac_item: local path to the generated STAC item.
@@ -24,6 +26,8 @@ def process_itslive_metadata(granule_uri: str) -> tuple[Path, Path, Path]:
     metadata = generate_itslive_metadata(
         url=granule_uri,
         store=None,  # Store is for Obstore
+        timer=timer,
+        reader='h5py',  # only the attributes are needed, not a decoded Dataset
     )
 
     # saves the stac item and the NSIDC spatial+premet metadata files
@@ -0,0 +1,70 @@
+"""Synthetic, ITS_LIVE-shaped stac-geoparquet catalogs for offline tests and benchmarks."""
+
+from pathlib import Path
+
+import numpy as np
+import rustac
+
+
+MISSIONS = ('landsatOLI', 'sentinel1', 'sentinel2')
+
+
+def _grid_name(lat: int, lon: int) -> str:
+    lat_name = f'N{abs(lat):02d}' if lat >= 0 else f'S{abs(lat):02d}'
+    lon_name = f'E{abs(lon):03d}' if lon >= 0 else f'W{abs(lon):03d}'
+    return f'{lat_name}{lon_name}'
+
+
+def make_item(item_id: str, lon: float, lat: float, percent_valid_pixels: int, datetime: str) -> dict:
+    """A STAC item with a small square footprint centered on lon/lat and a NetCDF data asset."""
+    minx, miny, maxx, maxy = lon - 0.5, lat - 0.5, lon + 0.5, lat + 0.5
+    return {
+        'type': 'Feature',
+        'stac_version': '1.1.0',
+        'id': item_id,
+        'collection': 'itslive-granules',
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]],
+        },
+        'bbox': [minx, miny, maxx, maxy],
+        'properties': {'datetime': datetime, 'percent_valid_pixels': percent_valid_pixels, 'proj:code': 'EPSG:3413'},
+        'assets': {
+            'data': {'href': f's3://its-live-data/velocity_image_pair/{item_id}.nc', 'roles': ['data']},
+            'thumbnail': {'href': f's3://its-live-data/velocity_image_pair/{item_id}.png', 'roles': ['thumbnail']},
+        },
+        'links': [],
+    }
+
+
+def write_latlon_catalog(
+    directory: Path, centers=((60, -40), (70, -50)), items_per_partition: int = 100, seed: int = 0
+) -> Path:
+    """Write a catalog with the `{mission}/{grid}/**/*.parquet` layout searched with `partition_type='latlon'`.
+
+    Items are scattered over each 10x10 degree cell centered on `centers` (lat, lon), with one parquet file
+    per mission and cell. The same `seed` always produces the same catalog.
+    """
+    rng = np.random.default_rng(seed)
+    directory = Path(directory)
+    for mission in MISSIONS:
+        for lat, lon in centers:
+            grid = _grid_name(lat, lon)
+            lons = rng.uniform(lon - 4, lon + 4, items_per_partition)
+            lats = rng.uniform(lat - 4, lat + 4, items_per_partition)
+            valid = rng.integers(0, 101, items_per_partition)
+            days = rng.integers(0, 365 * 5, items_per_partition)
+            items = [
+                make_item(
+                    f'{mission}_{grid}_{i:06d}',
+                    float(lons[i]),
+                    float(lats[i]),
+                    int(valid[i]),
+                    str(np.datetime64('2018-01-01T00:00:00') + np.timedelta64(int(days[i]), 'D')) + 'Z',
+                )
+                for i in range(items_per_partition)
+            ]
+            partition = directory / mission / grid / 'year=all'
+            partition.mkdir(parents=True, exist_ok=True)
+            rustac.write_sync(str(partition / 'items.parquet'), items)
+    return directory
@@ -0,0 +1,8 @@
+import pytest
+
+from granules import write_granule
+
+
+@pytest.fixture
+def granule(tmp_path):
+    return write_granule(tmp_path, mission='landsat')
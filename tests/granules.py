@@ -0,0 +1,84 @@
+"""Synthetic, ITS_LIVE-shaped granules for offline tests and benchmarks."""
+
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from pyproj import CRS
+
+
+GRANULE_NAMES = {
+    'landsat': ('LC08_L1TP_011002_20150720_20170406_01_T1_X_LC08_L1TP_011002_20150821_20170405_01_T1_G0120V02_P038.nc'),
+    'sentinel1': (
+        'S1A_IW_SLC__1SSH_20170221T204710_20170221T204737_015387_0193F6_AB07_X_'
+        'S1B_IW_SLC__1SSH_20170227T204628_20170227T204655_004491_007D11_6654_G0120V02_P094.nc'
+    ),
+    'sentinel2': (
+        'S2A_MSIL1C_20170711T125301_N0205_R138_T27VXL_20170711T125302_X_'
+        'S2A_MSIL1C_20170830T125301_N0205_R138_T27VXL_20170830T125302_G0120V02_P080.nc'
+    ),
+    'nisar': (
+        'NISAR_L1_PR_RSLC_001_005_A_219_2005_DHDH_A_20251011T120000_20251011T120030_X_'
+        'NISAR_L1_PR_RSLC_002_005_A_219_2005_DHDH_A_20251023T120000_20251023T120030_G0120V02_P090.nc'
+    ),
+}
+
+
+def _scene_ids(name: str) -> tuple[str, str]:
+    first, second = name.split('_X_')
+    second = second.rsplit('_G', 1)[0]
+    return first, second
+
+
+def write_granule(
+    directory: Path, mission: str = 'landsat', size: int = 64, epsg: int = 3413, variables: tuple = ('v',)
+) -> Path:
+    """Write a granule with the coordinates, mapping and img_pair_info attributes of an ITS_LIVE granule.
+
+    `variables` are filled with random float32 values, compressed and chunked like the velocity layers of
+    a production granule.
+    """
+    name = GRANULE_NAMES[mission]
+    scene_1_id, scene_2_id = _scene_ids(name)
+    pixel = 120.0
+    rng = np.random.default_rng(0)
+    x0, y0 = -200_000.0, -2_200_000.0
+    x = x0 + pixel * np.arange(size)
+    y = y0 - pixel * np.arange(size)
+
+    img_pair_info = {
+        'id_img1': scene_1_id,
+        'id_img2': scene_2_id,
+        'acquisition_date_img1': '20150720T15:30:49.14271',
+        'acquisition_date_img2': '20150821T15:30:52.',
+        'date_center': '20150805T15:30:50.57135',
+        'date_dt': 32.0000,
+        'roi_valid_percentage': 38.4,
+    }
+    if mission == 'sentinel1':
+        img_pair_info.update(
+            {'flight_direction_img1': 'ascending', 'frame_img1': '0193F6', 'frame_img2': '007D11'},
+        )
+
+    ds = xr.Dataset(
+        {
+            **{name: (('y', 'x'), rng.random((size, size), dtype=np.float32)) for name in variables},
+            'img_pair_info': ((), np.array(b'', dtype='S1'), img_pair_info),
+            'mapping': (
+                (),
+                np.array(b'', dtype='S1'),
+                {
+                    'crs_wkt': CRS.from_epsg(epsg).to_wkt(),
+                    'GeoTransform': f'{x0 - pixel / 2} {pixel} 0 {y0 + pixel / 2} 0 {-pixel}',
+                    'spatial_epsg': epsg,
+                },
+            ),
+        },
+        coords={'x': x, 'y': y},
+        attrs={'date_created': '13-Jun-2022 19:47:09', 'date_updated': '14-Jun-2022 08:01:12'},
+    )
+    path = Path(directory) / name
+    chunks = (min(size, 256), min(size, 256))
+    encoding = {name: {'zlib': True, 'complevel': 2, 'chunksizes': chunks} for name in variables}
+    ds.to_netcdf(path, engine='h5netcdf', encoding=encoding)
+    return path
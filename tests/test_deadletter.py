@@ -0,0 +1,157 @@
+import datetime
+
+import orjson
+import pytest
+from botocore.exceptions import ClientError
+
+from hyp3_itslive_metadata.cryoforge.deadletter import (
+    RETRY_TIERS,
+    DeadLetterWriter,
+    dead_letter,
+    generate_with_retries,
+    read_dead_letters,
+    retry_dead_letters,
+    summarize,
+    write_dead_letters,
+)
+from hyp3_itslive_metadata.cryoforge.fetch import is_transient
+
+
+def test_is_transient():
+    assert is_transient(ConnectionResetError('Connection reset by peer'))
+    assert is_transient(TimeoutError())
+    assert is_transient(OSError('SlowDown: Please reduce your request rate.'))
+    assert is_transient(RuntimeError('Generic S3 error: request timed out'))
+    assert not is_transient(FileNotFoundError('granule.nc'))
+    assert not is_transient(KeyError('img_pair_info'))
+
+
+def test_granule_names_are_not_transient():
+    url = (
+        's3://its-live-data/velocity_image_pair/landsatOLI/v02/N70W040/'
+        'LC08_L1TP_011002_20150503_20200909_02_T1_X_LC08_L1TP_011002_20150519_20200909_02_T1_G0120V02_P091.nc'
+    )
+    assert not is_transient(FileNotFoundError(url))
+    assert not is_transient(ValueError(f'Could not open {url.replace("P091", "P503")}'))
+    assert is_transient(ClientError({'ResponseMetadata': {'HTTPStatusCode': 500}}, 'GetObject'))
+    assert not is_transient(ClientError({'ResponseMetadata': {'HTTPStatusCode': 403}}, 'GetObject'))
+
+    calls = []
+
+    def missing(timer):
+        calls.append(timer)
+        raise FileNotFoundError(url)
+
+    _, _, letter = generate_with_retries(url, missing, retries=2, backoff=0)
+    assert letter is not None
+    assert len(calls) == 1
+    assert (letter['attempts'], letter['transient']) == (1, False)
+    assert not dead_letter(url, FileNotFoundError(url))['transient']
+
+
+def test_generate_with_retries():
+    calls = []
+
+    def flaky(timer):
+        calls.append(timer)
+        with timer.stage('fetch'):
+            if len(calls) < 3:
+                raise ConnectionResetError('Connection reset by peer')
+        return 'item'
+
+    assert generate_with_retries('s3://bucket/a.nc', flaky, retries=2, backoff=0)[::2] == ('item', None)
+    assert len(calls) == 3
+
+    calls.clear()
+    item, timer, letter = generate_with_retries('s3://bucket/a.nc', flaky, retries=1, backoff=0)
+    assert item is None
+    assert letter is not None
+    assert letter['error_class'] == 'ConnectionResetError'
+    assert letter['stage'] == 'fetch'
+    assert letter['attempts'] == 2
+    assert letter['transient']
+    assert timer.failed_stage == 'fetch'
+
+    def corrupt(timer):
+        with timer.stage('fetch'):
+            pass
+        with timer.stage('open'):
+            raise OSError('Unable to synchronously open file (file signature not found)')
+
+    _, _, letter = generate_with_retries('s3://bucket/b.nc', corrupt, retries=2, backoff=0)
+    assert letter is not None
+    assert (letter['stage'], letter['attempts'], letter['transient']) == ('open', 1, False)
+    assert letter['seconds'] >= 0
+
+
+@pytest.mark.parametrize('suffix', ['jsonl', 'parquet'])
+def test_read_write_dead_letters(tmp_path, suffix):
+    letters = [dead_letter(f's3://bucket/{i}.nc', ValueError('bad'), 'stac', seconds=0.5) for i in range(3)]
+    path = write_dead_letters(letters, str(tmp_path / f'dead_letters.{suffix}'))
+    assert read_dead_letters(path) == letters
+
+
+def test_dead_letter_writer_keeps_remote_letters(tmp_path):
+    remote = str(tmp_path / 'remote' / 'dead_letters.jsonl')
+    (tmp_path / 'remote').mkdir()
+
+    with DeadLetterWriter(tmp_path / 'first' / 'dead_letters.jsonl', remote=remote) as writer:
+        writer.write(dead_letter('s3://bucket/a.nc', 'failed'))
+        writer.sync()
+
+    # a task resumed on another machine appends to the synced letters
+    with DeadLetterWriter(tmp_path / 'second' / 'dead_letters.jsonl', remote=remote) as writer:
+        writer.write(dead_letter('s3://bucket/b.nc', 'failed'))
+        writer.sync()
+    assert [letter['url'] for letter in read_dead_letters(remote)] == ['s3://bucket/a.nc', 's3://bucket/b.nc']
+
+    with DeadLetterWriter(tmp_path / 'second' / 'dead_letters.jsonl', mode='w') as writer:
+        assert writer.count == 0
+    assert read_dead_letters(str(writer.path)) == []
+
+
+def test_retry_dead_letters(tmp_path):
+    now = datetime.datetime.now(datetime.UTC)
+
+    def letter(name, tier=0, age=RETRY_TIERS[-1], transient=True):
+        record = dead_letter(f's3://bucket/{name}.nc', 'failed', attempts=3, tier=tier)
+        record.update(transient=transient, failed_at=(now - datetime.timedelta(seconds=age)).isoformat())
+        return record
+
+    letters = [
+        letter('recovers'),
+        letter('fails'),
+        letter('recent', tier=1, age=RETRY_TIERS[0]),
+        letter('exhausted', tier=len(RETRY_TIERS)),
+        letter('permanent', transient=False),
+    ]
+
+    def generate(url, timer):
+        if 'fails' in url:
+            raise KeyError('img_pair_info')
+        return orjson.dumps({'id': url, 'properties': {'mid_datetime': '2019-06-01T00:00:00Z'}})
+
+    output = tmp_path / 'items.ndjson'
+    left = retry_dead_letters(letters, str(output), transient_only=True, generate=generate)
+
+    assert [orjson.loads(line)['id'] for line in output.read_bytes().splitlines()] == ['s3://bucket/recovers.nc']
+    by_url = {record['url'].rsplit('/', 1)[-1]: record for record in left}
+    assert sorted(by_url) == ['exhausted.nc', 'fails.nc', 'permanent.nc', 'recent.nc']
+    assert by_url['fails.nc']['tier'] == 1
+    assert by_url['fails.nc']['attempts'] == 4
+    assert by_url['fails.nc']['error_class'] == 'KeyError'
+    assert by_url['recent.nc'] == letters[2]
+
+    left = retry_dead_letters(left, str(output), ignore_backoff=True, generate=generate)
+    assert sorted(record['url'].rsplit('/', 1)[-1] for record in left) == ['exhausted.nc', 'fails.nc']
+    assert summarize(left)['tier'] == {str(len(RETRY_TIERS)): 1, '2': 1}
+
+    # into a directory, items land in the <prefix>/<year>.ndjson file of their granule
+    output_dir = tmp_path / 'row_group_0'
+    letters = [letter('N70W040/a'), letter('N70W040/b'), letter('S80E160/c')]
+    assert retry_dead_letters(letters, str(output_dir), generate=generate) == []
+    assert sorted(str(path.relative_to(output_dir)) for path in output_dir.rglob('*.ndjson')) == [
+        'N70W040/2019.ndjson',
+        'S80E160/2019.ndjson',
+    ]
+    assert len((output_dir / 'N70W040' / '2019.ndjson').read_bytes().splitlines()) == 2
@@ -26,3 +26,33 @@ def test_generate_from_parquet(script_runner):
 def test_search_items(script_runner):
     ret = script_runner.run(['search-items', '-h'])
     assert ret.success
+
+
+def test_search_service(script_runner):
+    ret = script_runner.run(['search-service', '-h'])
+    assert ret.success
+
+
+def test_build_virtual_store(script_runner):
+    ret = script_runner.run(['build-virtual-store', '-h'])
+    assert ret.success
+
+
+def test_header_cache(script_runner):
+    ret = script_runner.run(['header-cache', '-h'])
+    assert ret.success
+
+
+def test_plan_shards(script_runner):
+    ret = script_runner.run(['plan-shards', '-h'])
+    assert ret.success
+
+
+def test_work_queue(script_runner):
+    ret = script_runner.run(['work-queue', '-h'])
+    assert ret.success
+
+
+def test_dead_letters(script_runner):
+    ret = script_runner.run(['dead-letters', '-h'])
+    assert ret.success
@@ -0,0 +1,350 @@
+import asyncio
+import errno
+import heapq
+import io
+import itertools
+import mmap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
+import pytest
+from botocore.exceptions import ClientError
+from fsspec.implementations.local import LocalFileSystem
+from obstore.store import LocalStore, S3Store
+
+from hyp3_itslive_metadata.cryoforge import fetch
+from hyp3_itslive_metadata.cryoforge.fetch import (
+    AdaptiveLimiter,
+    AsyncFetcher,
+    BufferReader,
+    HedgedReader,
+    is_throttled,
+    object_path,
+)
+from hyp3_itslive_metadata.cryoforge.generate import fetch_granule, generate_itslive_metadata
+from hyp3_itslive_metadata.cryoforge.generatebatched import parse_granule
+
+
+def test_object_path(tmp_path):
+    store = S3Store('its-live-data', region='us-west-2', skip_signature=True)
+    assert object_path('s3://its-live-data/velocity_image_pair/a.nc', store) == 'velocity_image_pair/a.nc'
+    assert object_path('s3://other-bucket/velocity_image_pair/a.nc') == 'velocity_image_pair/a.nc'
+    with pytest.raises(ValueError, match='not in the bucket'):
+        object_path('s3://other-bucket/a.nc', store)
+
+    prefixed = S3Store('its-live-data', prefix='velocity_image_pair', region='us-west-2', skip_signature=True)
+    assert object_path('s3://its-live-data/velocity_image_pair/landsatOLI/a.nc', prefixed) == 'landsatOLI/a.nc'
+    assert object_path(str(tmp_path / 'a.nc'), LocalStore(tmp_path)) == 'a.nc'
+
+
+def test_buffer_reader():
+    data = bytearray(range(256))
+    reader = BufferReader(data)
+
+    assert reader.read(4) == bytes(range(4))
+    assert reader.seek(-2, io.SEEK_END) == 254
+    assert reader.read() == bytes([254, 255])
+    assert reader.read(10) == b''
+    reader.seek(10)
+    target = bytearray(6)
+    assert reader.readinto(target) == 6
+    assert target == bytes(range(10, 16))
+    assert reader.tell() == 16
+
+    with reader.getbuffer() as view:
+        assert np.shares_memory(np.frombuffer(view, dtype='u1'), np.frombuffer(data, dtype='u1'))
+    reader.close()
+    with pytest.raises(ValueError, match='closed'):
+        reader.read()
+
+
+def test_fetch_granule_does_not_copy(granule):
+    content = bytearray(granule.read_bytes())
+    reader = fetch_granule(str(granule), content=content)
+    with reader.getbuffer() as view:
+        assert np.shares_memory(np.frombuffer(view, dtype='u1'), np.frombuffer(content, dtype='u1'))
+
+    local = fetch_granule(str(granule))
+    assert isinstance(local._buffer, mmap.mmap)
+    assert local.read() == granule.read_bytes()
+    local.close()
+
+
+@pytest.mark.parametrize('part_size', [None, 1000, 2**30])
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_fetch(granule, part_size, adaptive):
+    limiter = AdaptiveLimiter(initial=2, maximum=4) if adaptive else None
+    fetcher = AsyncFetcher(max_concurrency=4, part_size=part_size, limiter=limiter)
+    content = asyncio.run(fetcher.fetch(str(granule)))
+    assert bytes(content) == granule.read_bytes()
+    assert limiter is None or limiter.in_flight == 0
+
+
+def test_map(granule, tmp_path):
+    urls = [str(granule)] * 5 + [str(tmp_path / 'missing.nc')]
+    fetcher = AsyncFetcher(max_concurrency=2, part_size=4096)
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return [result async for result in fetcher.map(urls, parse_granule, executor, max_pending=1)]
+
+    results = asyncio.run(run())
+
+    assert len(results) == len(urls)
+    failed = [result for result in results if result['error']]
+    assert [result['url'] for result in failed] == [str(tmp_path / 'missing.nc')]
+    # a missing granule is not retried
+    assert failed[0]['attempts'] == 1
+
+    expected = generate_itslive_metadata(str(granule), reader='h5py')['stac'].to_dict()
+    for result in results:
+        if not result['error']:
+            assert orjson.loads(result['metadata']) == expected
+            assert result['timing']['bytes_read'] == granule.stat().st_size
+            assert result['timing']['stages']['fetch'] > 0
+
+
+def test_map_retries_transient_errors(granule, monkeypatch):
+    fetcher = AsyncFetcher(part_size=None)
+    fetch_once = fetcher.fetch
+    attempts = []
+
+    async def flaky_fetch(url):
+        attempts.append(url)
+        if len(attempts) < 3:
+            raise ConnectionResetError('Connection reset by peer')
+        return await fetch_once(url)
+
+    monkeypatch.setattr(fetcher, 'fetch', flaky_fetch)
+
+    async def run(retries):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return [result async for result in fetcher.map([str(granule)], parse_granule, executor, retries=retries)]
+
+    [failed] = asyncio.run(run(retries=1))
+    assert failed['attempts'] == 2
+    assert isinstance(failed['exception'], ConnectionResetError)
+
+    [result] = asyncio.run(run(retries=1))
+    assert result['error'] is None
+    assert len(attempts) == 3
+
+
+def test_adaptive_limiter_follows_latency():
+    # reads run on a fake clock: the store slows down tenfold beyond 6 concurrent reads
+    now = 0.0
+    limiter = AdaptiveLimiter(initial=2, maximum=32, window=16, clock=lambda: now)
+    in_flight: list[tuple[float, float]] = []  # heap of (finish, started)
+    running = {'max': 0, 'limit': 0}
+
+    for _ in range(1500):
+        if limiter.in_flight >= limiter.limit:
+            # the next read waits for a slot, freed by the reads in flight that finish first
+            limiter._waited = True
+            while limiter.in_flight >= limiter.limit:
+                now, started = heapq.heappop(in_flight)
+                limiter._release(started, nbytes=1024)
+        started = limiter._acquire()
+        heapq.heappush(in_flight, (started + (0.05 if limiter.in_flight > 6 else 0.005), started))
+        running['max'] = max(running['max'], limiter.in_flight)
+        running['limit'] = max(running['limit'], limiter.limit)
+    while in_flight:
+        now, started = heapq.heappop(in_flight)
+        limiter._release(started, nbytes=1024)
+
+    # it probes past the knee but never runs away towards the maximum
+    assert running['max'] > 6
+    assert running['limit'] <= 10
+    assert 1 <= limiter.limit <= 10
+    assert limiter.stats()['in_flight'] == 0
+
+
+def test_adaptive_limiter_backs_off_when_throttled():
+    limiter = AdaptiveLimiter(initial=8, backoff=0.001)
+    responses = iter([OSError('SlowDown: Please reduce your request rate.'), OSError('503 Service Unavailable')])
+
+    def read():
+        if error := next(responses, None):
+            raise error
+        return b'granule'
+
+    assert limiter.call(read) == b'granule'
+    assert limiter.throttled == 2
+    assert limiter.limit == 2
+
+    def missing():
+        raise FileNotFoundError('granule.nc')
+
+    with pytest.raises(FileNotFoundError):
+        limiter.call(missing)
+    assert limiter.throttled == 2
+    assert limiter.in_flight == 0
+    assert not is_throttled(FileNotFoundError('granule.nc'))
+
+
+MISSING_503 = (
+    's3://its-live-data/velocity_image_pair/landsatOLI/v02/N70W040/'
+    'LC08_L1TP_011002_20150503_20200909_02_T1_X_LC08_L1TP_011002_20150519_20200909_02_T1_G0120V02_P091.nc'
+)
+
+
+def test_is_throttled_by_status_not_granule_name():
+    assert not is_throttled(FileNotFoundError(MISSING_503))
+    assert not is_throttled(
+        ValueError('Could not open S1A_IW_SLC__1SSH_20170221T204710_20170221T204737_015387_0193F6_5030.nc')
+    )
+    assert not is_throttled(OSError(f'Generic S3 error: status 404 Not Found for {MISSING_503}'))
+    assert is_throttled(OSError('Generic S3 error: Server returned non-2xx status code: 503 Service Unavailable'))
+    assert is_throttled(OSError(errno.EBUSY, 'Please reduce your request rate.'))  # as raised by s3fs
+
+    slow_down = ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+    no_such_key = ClientError(
+        {'Error': {'Code': 'NoSuchKey'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject'
+    )
+    assert is_throttled(slow_down)
+    assert not is_throttled(no_such_key)
+    try:
+        raise FileNotFoundError(MISSING_503) from no_such_key
+    except FileNotFoundError as e:
+        assert not is_throttled(e)
+
+    limiter = AdaptiveLimiter(initial=8, backoff=0.001)
+
+    def missing():
+        raise FileNotFoundError(MISSING_503)
+
+    with pytest.raises(FileNotFoundError):
+        limiter.call(missing)
+    assert limiter.throttled == 0
+    assert limiter.limit == 8
+
+
+def test_fetch_granule_uses_read_limiter(granule, monkeypatch):
+    limiter = AdaptiveLimiter(window=1)
+    monkeypatch.setattr(fetch, '_read_limiter', limiter)
+
+    reader = fetch_granule(str(granule), store=LocalStore(granule.parent))
+    assert reader.read() == granule.read_bytes()
+    assert limiter.stats()['throughput'] > 0
+
+
+class StallingFileSystem(LocalFileSystem):
+    """A local stand-in for S3 where every `stall_every`-th open hangs until `release` is set."""
+
+    cachable = False
+
+    def __init__(self, stall_every: int, **kwargs):
+        super().__init__(**kwargs)
+        self.stall_every = stall_every
+        self.opens = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+
+    def open(self, path, *args, **kwargs):
+        with self.lock:
+            self.opens += 1
+            stall = self.opens % self.stall_every == 0
+        if stall:
+            self.release.wait(10)
+        return super().open(path, *args, **kwargs)
+
+
+def test_hedged_reader_cuts_stragglers():
+    # every read is timed at 1ms, so the deadline stays at min_delay, well above the 2ms reads
+    hedger = HedgedReader(min_samples=20, max_rate=0.2, min_delay=0.2, clock=itertools.count(0, 0.001).__next__)
+    release = threading.Event()
+    calls = []
+
+    def read_factory(i):
+        def read():
+            calls.append(i)
+            # after the first 20, the first copy of every 10th read stalls
+            if i >= 20 and i % 10 == 0 and calls.count(i) == 1:
+                release.wait(10)
+            else:
+                time.sleep(0.002)
+            return i
+
+        return read
+
+    start = time.monotonic()
+    try:
+        assert [hedger.call(read_factory(i)) for i in range(100)] == list(range(100))
+        elapsed = time.monotonic() - start
+    finally:
+        release.set()
+        hedger.close()
+
+    # each stall would otherwise hold the loop for 10s
+    assert elapsed < 5
+    stats = hedger.stats()
+    assert stats['reads'] == 100
+    assert stats['hedges_won'] >= 8
+    assert 8 <= stats['hedged'] <= 20
+
+
+def test_hedge_rate_is_capped():
+    # every read is timed at 1ms, so the deadline stays at min_delay
+    clock = itertools.count(0, 0.001).__next__
+    hedger = HedgedReader(min_samples=10, max_rate=0.1, burst=1, min_delay=0.001, clock=clock)
+    for _ in range(10):
+        hedger.call(lambda: None)
+    # every read is now slower than the deadline, but only one in ten may be hedged
+    for _ in range(20):
+        hedger.call(lambda: time.sleep(0.02))
+    hedger.close()
+
+    assert hedger.stats()['hedged'] == 2
+
+
+def test_fetch_granule_hedges_stalled_reads(granule, monkeypatch):
+    fs = StallingFileSystem(stall_every=7)
+    hedger = HedgedReader(min_samples=5, max_rate=0.5, min_delay=0.01)
+    monkeypatch.setattr(fetch, '_read_hedger', hedger)
+
+    start = time.monotonic()
+    try:
+        for _ in range(20):
+            assert fetch_granule(str(granule), store=fs).read() == granule.read_bytes()
+        elapsed = time.monotonic() - start
+    finally:
+        fs.release.set()
+        hedger.close()
+
+    # opens 7, 14 and 21 stall; without hedging each would hold the batch for 10s
+    assert elapsed < 10
+    assert hedger.stats()['hedges_won'] >= 2
+
+
+def test_hedged_reader_async_cancels_loser():
+    hedger = HedgedReader(min_samples=5, min_delay=0.01, max_rate=1)
+    cancelled = []
+
+    async def fast():
+        await asyncio.sleep(0.002)
+        return 'fast'
+
+    async def run():
+        for _ in range(5):
+            assert await hedger.call_async(fast) == 'fast'
+
+        attempts: list[None] = []
+
+        async def stalls_once():
+            attempts.append(None)
+            if len(attempts) == 1:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return 'hedge'
+
+        return await asyncio.wait_for(hedger.call_async(stalls_once), timeout=5)
+
+    assert asyncio.run(run()) == 'hedge'
+    assert cancelled == [True]
+    assert hedger.stats()['hedges_won'] == 1
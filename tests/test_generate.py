@@ -0,0 +1,188 @@
+import json
+from pathlib import Path
+
+import fsspec
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import xarray as xr
+
+from granules import GRANULE_NAMES, write_granule
+from hyp3_itslive_metadata.cryoforge.generate import (
+    create_stac_item,
+    create_stac_item_dict,
+    create_stac_item_dicts,
+    generate_itslive_metadata,
+    generate_many,
+    get_geom,
+    get_transformer,
+    iter_granule_urls,
+    open_granule_h5,
+    save_metadata,
+    stac_item_json,
+    utc_isoformats,
+)
+
+
+def open_references(fo):
+    return xr.open_dataset(
+        'reference://',
+        engine='zarr',
+        zarr_format=2,
+        backend_kwargs={'consolidated': False, 'storage_options': {'fo': fo, 'remote_protocol': 'file'}},
+    )
+
+
+@pytest.mark.parametrize('mission', ['landsat', 'sentinel1', 'sentinel2'])
+def test_h5py_reader_matches_xarray(tmp_path, mission):
+    granule = write_granule(tmp_path, mission=mission)
+    from_xarray = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='xarray')
+    from_h5py = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='h5py')
+    from_xarray['ds'].close()
+
+    assert from_h5py['stac'].to_dict() == from_xarray['stac'].to_dict()
+    assert from_h5py['nsidc_meta'] == from_xarray['nsidc_meta']
+    assert from_h5py['nsidc_spatial'] == from_xarray['nsidc_spatial']
+    assert from_h5py['kerchunk'] == from_xarray['kerchunk']
+
+
+def test_kerchunk_references_inline_coordinates(granule):
+    refs = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='h5py')['kerchunk']
+
+    assert refs['refs']['x/0'].startswith('base64:')
+    assert refs['refs']['y/0'].startswith('base64:')
+    assert isinstance(refs['refs']['v/0.0'], list)
+
+    with open_references(refs) as virtual, xr.open_dataset(granule, engine='h5netcdf') as ds:
+        np.testing.assert_array_equal(virtual['x'].values, ds['x'].values)
+        np.testing.assert_array_equal(virtual['v'].values, ds['v'].values)
+
+
+def test_save_parquet_references(granule, tmp_path):
+    metadata = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='h5py')
+    _, _, _, kerchunk = save_metadata(metadata, str(tmp_path), kerchunk_format='parquet')
+
+    assert kerchunk.endswith('.ref.parquet')
+    assert (tmp_path / f'{metadata["stac"].id}.stac.json').exists()
+    with open_references(kerchunk) as virtual, xr.open_dataset(granule, engine='h5netcdf') as ds:
+        np.testing.assert_array_equal(virtual['v'].values, ds['v'].values)
+        assert virtual['img_pair_info'].attrs['id_img1'] == ds['img_pair_info'].attrs['id_img1']
+
+
+@pytest.mark.parametrize('mission', GRANULE_NAMES)
+def test_stac_item_dict_matches_pystac(tmp_path, mission):
+    granule = str(write_granule(tmp_path, mission=mission))
+    header, _ = open_granule_h5(granule)
+    geom = get_geom(header, 4, 4326)
+
+    item = create_stac_item(header, geom, granule)
+    item_dict = create_stac_item_dict(header, geom, granule)
+
+    assert stac_item_json(item_dict) == orjson.dumps(item.to_dict())
+    assert stac_item_json(item_dict, indent=True) == json.dumps(item.to_dict(), indent=2).encode()
+
+
+def test_save_metadata_from_dict(granule, tmp_path):
+    from_pystac = generate_itslive_metadata(str(granule), reader='h5py')
+    from_dict = generate_itslive_metadata(str(granule), reader='h5py', item_format='dict')
+    assert from_dict['nsidc_meta'] == from_pystac['nsidc_meta']
+
+    (tmp_path / 'pystac').mkdir()
+    (tmp_path / 'dict').mkdir()
+    expected = save_metadata(from_pystac, str(tmp_path / 'pystac'))
+    written = save_metadata(from_dict, str(tmp_path / 'dict'))
+    for expected_path, written_path in zip(expected[:3], written[:3]):
+        assert Path(written_path).read_bytes() == Path(expected_path).read_bytes()
+
+
+def test_save_metadata_compact_and_remote(granule, tmp_path):
+    metadata = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='h5py', item_format='dict')
+    indented = save_metadata(metadata, str(tmp_path))
+    compact = save_metadata(metadata, 'memory://sidecars', compact=True)
+    assert compact[0] == f'memory://sidecars/{metadata["stac"]["id"]}.stac.json'
+
+    fs = fsspec.filesystem('memory')
+    for indented_path, compact_path in zip(indented, compact):
+        content = fs.cat(compact_path)
+        if compact_path.endswith('.json'):
+            assert b'\n' not in content
+            assert orjson.loads(content) == json.loads(Path(indented_path).read_bytes())
+        else:
+            assert content == Path(indented_path).read_bytes()
+
+
+def test_generate_without_dataset(granule):
+    kept = generate_itslive_metadata(str(granule))
+    kept['ds'].close()
+    closed = generate_itslive_metadata(str(granule), keep_dataset=False)
+    assert closed['ds'] is None
+    assert closed['stac'].to_dict() == kept['stac'].to_dict()
+
+
+DATES = [
+    '20150720T15:30:49.14271',
+    '20150821T15:30:52.',
+    '20150821T15:30:52',
+    '20170221T20:47:10.123456',
+    '20170221T20:47:10.123456789',
+    '20150720',
+    '2015-07-20T15:30:49.5',
+    '13-Jun-2022 19:47:09',
+    '13-JUN-2022 00:00:00',
+]
+
+
+def test_utc_isoformats_match_pandas():
+    expected = [pd.to_datetime(date).tz_localize('UTC').isoformat().replace('+00:00', 'Z') for date in DATES]
+    assert utc_isoformats(DATES) == expected
+    assert utc_isoformats([]) == []
+
+    assert utc_isoformats(['', '31-Foo-2022 19:47:09', '20151321T15:30:52', DATES[0]], errors='coerce') == [
+        None,
+        None,
+        None,
+        expected[0],
+    ]
+    with pytest.raises(ValueError):
+        utc_isoformats(['20151321T15:30:52'])
+
+
+def test_create_stac_item_dicts(tmp_path):
+    granules = [str(write_granule(tmp_path, mission=mission)) for mission in GRANULE_NAMES]
+    headers = [open_granule_h5(granule)[0] for granule in granules]
+    geoms = [get_geom(header, 4, 4326) for header in headers]
+
+    items = create_stac_item_dicts(headers, geoms, granules)
+    assert items == [create_stac_item(*args).to_dict() for args in zip(headers, geoms, granules)]
+
+
+@pytest.mark.parametrize('combined', ['items.ndjson', 'items.parquet'])
+def test_generate_many(tmp_path, combined):
+    granules = [str(write_granule(tmp_path, mission=mission)) for mission in ('landsat', 'sentinel1', 'sentinel2')]
+    listing = tmp_path / 'granules.txt'
+    listing.write_text('# granules\n\n' + '\n'.join([*granules, str(tmp_path / 'missing.nc')]) + '\n')
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+
+    counts = generate_many(iter_granule_urls(str(listing)), str(outdir), workers=2, combined=str(tmp_path / combined))
+    assert counts == {'done': len(granules), 'failed': 1}
+
+    expected = {
+        generate_itslive_metadata(granule, reader='h5py', item_format='dict')['stac']['id'] for granule in granules
+    }
+    assert {path.name.removesuffix('.stac.json') for path in outdir.glob('*.stac.json')} == expected
+    if combined.endswith('.parquet'):
+        ids = pq.read_table(tmp_path / combined).column('id').to_pylist()
+    else:
+        ids = [orjson.loads(line)['id'] for line in (tmp_path / combined).read_bytes().splitlines()]
+    assert sorted(ids) == sorted(expected)
+
+
+def test_get_transformer_is_cached(granule):
+    get_transformer.cache_clear()
+    for _ in range(3):
+        generate_itslive_metadata(str(granule), reader='h5py', item_format='dict')
+    assert get_transformer.cache_info().misses == 1
+    assert get_transformer.cache_info().hits == 2
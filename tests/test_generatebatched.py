@@ -0,0 +1,178 @@
+import threading
+import time
+
+import pytest
+from dask.distributed import Client, LocalCluster
+
+from hyp3_itslive_metadata.cryoforge import generatebatched
+from hyp3_itslive_metadata.cryoforge.deadletter import DeadLetterWriter, read_dead_letters
+from hyp3_itslive_metadata.cryoforge.generatebatched import (
+    CHECKPOINT_PARTS,
+    BatchWriter,
+    Checkpoint,
+    iter_windowed,
+    process_files_dask,
+)
+from hyp3_itslive_metadata.cryoforge.workqueue import LeaseLost, SQLiteWorkQueue, run_worker
+
+
+_lock = threading.Lock()
+_running = {'now': 0, 'max': 0}
+
+
+def _fake_metadata(url):
+    with _lock:
+        _running['now'] += 1
+        _running['max'] = max(_running['max'], _running['now'])
+    try:
+        # later granules finish first, so completion order differs from submission order
+        time.sleep(0.05 / (1 + int(url.rsplit('_', 1)[-1].removesuffix('.nc'))))
+        if url.endswith('_3.nc'):
+            raise RuntimeError('worker died')
+        return {'metadata': f'{{"url": "{url}"}}'.encode(), 'url': url, 'error': None, 'timing': None}
+    finally:
+        with _lock:
+            _running['now'] -= 1
+
+
+@pytest.fixture
+def client():
+    with Client(LocalCluster(n_workers=1, threads_per_worker=8, processes=False, dashboard_address=':0')) as client:
+        yield client
+
+
+def test_iter_windowed(client):
+    _running['max'] = 0
+    urls = [f's3://bucket/granule_{i}.nc' for i in range(12)]
+
+    results = list(iter_windowed(client, _fake_metadata, urls, window=3))
+
+    assert sorted(result['url'] for result in results) == sorted(urls)
+    assert _running['max'] <= 3
+    [failed] = [result for result in results if result['error']]
+    assert failed['url'] == 's3://bucket/granule_3.nc'
+    assert failed['metadata'] is None
+
+
+def test_process_files_dask_writes_by_url(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(generatebatched, 'generate_stac_metadata', _fake_metadata)
+    files = [(f'prefix_{i % 3}', f'granule_{i}.nc', str(2015 + i % 2)) for i in range(10)]
+    writer = BatchWriter(tmp_path)
+
+    timings = process_files_dask(files, writer, max_in_flight=4, batch_size=4, client=client)
+    writer.close()
+
+    assert len(timings) == len(files)
+    assert writer.processed_count == len(files) - 1
+    for prefix, filename, year in files:
+        lines = (tmp_path / prefix / f'{year}.ndjson').read_text().splitlines()
+        expected = f'{{"url": "{generatebatched.granule_uri(prefix, filename)}"}}'
+        assert (expected in lines) == (filename != 'granule_3.nc')
+
+
+def test_process_files_dask_writes_dead_letters(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(generatebatched, 'generate_stac_metadata', _fake_metadata)
+    files = [('prefix', f'granule_{i}.nc', '2015') for i in range(5)]
+    writer = BatchWriter(tmp_path)
+
+    with DeadLetterWriter(tmp_path / 'dead_letters.jsonl', mode='w') as dead_letters:
+        process_files_dask(files, writer, client=client, dead_letters=dead_letters)
+    writer.close()
+
+    [letter] = read_dead_letters(str(tmp_path / 'dead_letters.jsonl'))
+    assert letter['url'] == generatebatched.granule_uri('prefix', 'granule_3.nc')
+    assert (letter['error_class'], letter['error'], letter['stage']) == ('RuntimeError', 'worker died', 'task')
+    # dead letters are never taken for items
+    assert [path.name for path in tmp_path.rglob('*.ndjson')] == ['2015.ndjson']
+
+
+def test_checkpoint_resumes_after_preemption(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(generatebatched, 'generate_stac_metadata', _fake_metadata)
+    files = [(f'prefix_{i % 2}', f'granule_{i}.nc', '2015') for i in range(3, 13)]
+    # granule_3 always fails, so it is retried after the restart but never written
+    urls = {generatebatched.granule_uri(prefix, filename) for prefix, filename, _ in files[1:]}
+    remote = str(tmp_path / 'remote')
+
+    # the first task writes 7 items, saving every 3, and is preempted mid-line
+    writer = BatchWriter(tmp_path / 'first')
+    checkpoint = Checkpoint(writer, remote=remote, every=3)
+    assert checkpoint.restore() == set()
+    process_files_dask(files[1:8], writer, client=client, checkpoint=checkpoint)
+    writer.file_handles['prefix_0/2015'].write(b'{"url": "trunc')
+    writer.close()
+
+    # the restarted task, on a new machine, only has what was synced
+    writer = BatchWriter(tmp_path / 'second')
+    checkpoint = Checkpoint(writer, remote=remote, every=3)
+    done = checkpoint.restore()
+    assert len(done) == 6
+    assert writer.processed_count == 6
+
+    left = [file for file in files if generatebatched.granule_uri(file[0], file[1]) not in done]
+    process_files_dask(left, writer, client=client, checkpoint=checkpoint)
+    checkpoint.save()
+    writer.close()
+
+    lines = [line for path in (tmp_path / 'second').rglob('*.ndjson') for line in path.read_text().splitlines()]
+    assert sorted(lines) == sorted(f'{{"url": "{url}"}}' for url in urls)
+    assert writer.processed_count == len(urls)
+    assert Checkpoint(BatchWriter(tmp_path / 'third'), remote=remote).restore() == urls
+
+
+def test_checkpoint_uploads_appended_parts(tmp_path):
+    remote = tmp_path / 'remote'
+    writer = BatchWriter(tmp_path / 'local')
+    checkpoint = Checkpoint(writer, remote=str(remote), every=2)
+    for i in range(9):
+        writer.write_item(f'{{"url": "{i}"}}'.encode(), f'prefix_{i % 2}', '2015', f'granule_{i}.nc')
+        checkpoint.record(str(i))
+    checkpoint.save()
+    writer.close()
+
+    # every save uploads only what was appended, so each byte is uploaded once
+    parts = sorted(path for path in (remote / CHECKPOINT_PARTS).rglob('*.part'))
+    assert len(parts) == 9
+    assert sum(path.stat().st_size for path in parts) == sum(
+        path.stat().st_size for path in (tmp_path / 'local').rglob('*.ndjson')
+    )
+    assert not list(remote.rglob('*.ndjson'))
+
+    restored = BatchWriter(tmp_path / 'restored')
+    assert Checkpoint(restored, remote=str(remote)).restore() == {str(i) for i in range(9)}
+    for path in (tmp_path / 'local').rglob('*.ndjson'):
+        assert (tmp_path / 'restored' / path.relative_to(tmp_path / 'local')).read_bytes() == path.read_bytes()
+
+    # once the whole files are uploaded, the ledger points at them and the parts are dropped
+    for path in (tmp_path / 'local').rglob('*.ndjson'):
+        target = remote / path.relative_to(tmp_path / 'local')
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(path.read_bytes())
+    checkpoint.finish()
+    assert not (remote / CHECKPOINT_PARTS).exists()
+    assert Checkpoint(BatchWriter(tmp_path / 'finished'), remote=str(remote)).restore() == {str(i) for i in range(9)}
+
+
+def test_checkpoint_not_synced_after_lost_lease(tmp_path):
+    queue = SQLiteWorkQueue(str(tmp_path / 'queue.db'))
+    queue.add(['0'])
+    remote = tmp_path / 'remote'
+
+    def process(unit):
+        writer = BatchWriter(tmp_path / 'local')
+        checkpoint = Checkpoint(writer, remote=str(remote), every=1)
+        writer.write_item(b'{"url": "a"}', 'prefix_0', '2015', 'granule_0.nc')
+        checkpoint.record('a')
+        # the lease expires and another task claims the row group before the next save
+        time.sleep(0.1)
+        assert queue.claim('other', lease_seconds=60) == unit
+        time.sleep(0.3)
+        writer.write_item(b'{"url": "b"}', 'prefix_0', '2015', 'granule_1.nc')
+        with pytest.raises(LeaseLost):
+            checkpoint.record('b')
+        writer.close()
+        assert queue.complete(unit, 'other')
+
+    processed = run_worker(queue, process, worker='preempted', lease_seconds=0.05, heartbeat_seconds=0.2)
+
+    assert processed['lost'] == 1
+    assert Checkpoint(BatchWriter(tmp_path / 'restored'), remote=str(remote)).restore() == {'a'}
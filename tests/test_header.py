@@ -0,0 +1,19 @@
+import xarray as xr
+
+from hyp3_itslive_metadata.cryoforge.generate import get_geom
+from hyp3_itslive_metadata.cryoforge.header import read_granule_header
+
+
+def test_read_granule_header(granule):
+    header = read_granule_header(str(granule))
+
+    with xr.open_dataset(granule, engine='h5netcdf') as ds:
+        assert header.attrs == ds.attrs
+        for name in ('img_pair_info', 'mapping'):
+            assert name in header
+            assert header[name].attrs.keys() == ds[name].attrs.keys()
+        assert header['img_pair_info'].id_img1 == ds['img_pair_info'].id_img1
+        assert header['x'].values is not None
+        assert header['x'].values.tolist() == [ds['x'].values[0], ds['x'].values[-1]]
+
+        assert get_geom(header, precision=4, projection=4326) == get_geom(ds, precision=4, projection=4326)
@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+
+import fsspec
+import orjson
+from fsspec.implementations.memory import MemoryFileSystem
+
+from granules import GRANULE_NAMES, write_granule
+from hyp3_itslive_metadata.cryoforge.generate import (
+    create_stac_item,
+    get_geom,
+    open_granule_h5,
+)
+from hyp3_itslive_metadata.cryoforge.headercache import (
+    build_header_cache,
+    granule_etag,
+    iter_header_records,
+    read_cached_headers,
+    stac_items_from_cache,
+)
+from hyp3_itslive_metadata.cryoforge.search_items import get_bbox_wgs84
+
+
+def test_header_record_round_trip(granule):
+    header, _ = open_granule_h5(str(granule))
+    record = header.to_record(etag='abc')
+
+    geom = get_geom(header, 4, 4326)
+    assert get_geom(record, 4, 4326)['bbox'] == geom['bbox']
+    assert (
+        create_stac_item(record, geom, str(granule)).to_dict() == create_stac_item(header, geom, str(granule)).to_dict()
+    )
+
+
+def test_build_header_cache(tmp_path):
+    granules = [str(write_granule(tmp_path, mission=mission)) for mission in GRANULE_NAMES]
+    cache = str(tmp_path / 'headers.parquet')
+
+    counts = build_header_cache([*granules, str(tmp_path / 'missing.nc')], cache, max_workers=2, row_group_size=2)
+    assert counts == {'extracted': len(granules), 'reused': 0, 'failed': 1}
+
+    headers = read_cached_headers(cache)
+    assert sorted(headers) == sorted(granules)
+    assert list(read_cached_headers(cache, urls=granules[:1])) == granules[:1]
+
+    # only the granule that changed is read again
+    stat = Path(granules[0]).stat()
+    os.utime(granules[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    counts = build_header_cache(granules, cache, previous=cache)
+    assert counts == {'extracted': 1, 'reused': len(granules) - 1, 'failed': 0}
+    assert sum(len(records) for records in iter_header_records(cache)) == len(granules)
+
+    assert get_bbox_wgs84(granules[0], header_cache=cache) == get_bbox_wgs84(granules[0])
+    assert not Path(f'{cache}.partial').exists()
+
+
+def test_build_header_cache_mixed_filesystems(tmp_path):
+    granule = str(write_granule(tmp_path))
+    remote = f'memory://granules/{Path(granule).name}'
+    fsspec.filesystem('memory').pipe(remote, Path(granule).read_bytes())
+
+    # every granule is read with the filesystem of its own protocol
+    counts = build_header_cache([granule, remote], str(tmp_path / 'headers.parquet'))
+    assert counts == {'extracted': 2, 'reused': 0, 'failed': 0}
+
+
+def test_stac_items_from_cache(tmp_path):
+    granules = [str(write_granule(tmp_path, mission=mission)) for mission in GRANULE_NAMES]
+    cache = str(tmp_path / 'headers.parquet')
+    build_header_cache(granules, cache)
+
+    output = tmp_path / 'items.ndjson'
+    assert stac_items_from_cache(cache, str(output)) == len(granules)
+
+    items = {item['id']: item for item in map(orjson.loads, output.read_bytes().splitlines())}
+    for granule in granules:
+        header, _ = open_granule_h5(granule)
+        expected = create_stac_item(header, get_geom(header, 4, 4326), granule).to_dict()
+        assert items[expected['id']] == expected
+
+
+class ListedS3FileSystem(MemoryFileSystem):
+    """A stand-in for s3fs, whose entries carry the object's ETag next to fields that vary with the request."""
+
+    protocol = ('s3', 's3a')
+    requests = 0
+
+    def info(self, path, **kwargs):
+        self.requests += 1
+        return {**super().info(path, **kwargs), 'ETag': '"9b2cf535f27731c974343645a3985328"', 'request': self.requests}
+
+
+def test_granule_etag(tmp_path):
+    fs = ListedS3FileSystem()
+    fs.pipe('s3://bucket/granule.nc', b'granule')
+    assert granule_etag(fs, 's3://bucket/granule.nc') == '9b2cf535f27731c974343645a3985328'
+    assert granule_etag(fs, 's3://bucket/granule.nc') == '9b2cf535f27731c974343645a3985328'
+
+    local = fsspec.filesystem('file')
+    path = tmp_path / 'granule.nc'
+    path.write_bytes(b'granule')
+    assert granule_etag(local, str(path)) == granule_etag(local, str(path))
@@ -0,0 +1,42 @@
+import pyarrow.parquet as pq
+import xarray as xr
+from pyproj import Transformer
+
+from hyp3_itslive_metadata.cryoforge.generate import get_geom
+from hyp3_itslive_metadata.cryoforge.search_items import HrefDeduplicator, get_bbox_wgs84, write_records
+
+
+def test_get_bbox_wgs84(granule):
+    bbox = get_bbox_wgs84(str(granule))
+
+    with xr.open_dataset(granule, engine='h5netcdf') as ds:
+        assert bbox == get_geom(ds, precision=4, projection=4326)['bbox']
+
+        # the densified footprint contains the transformed corners of the pixel-center extent
+        transformer = Transformer.from_crs('EPSG:3413', 'EPSG:4326', always_xy=True)
+        for x in (ds['x'].values.min(), ds['x'].values.max()):
+            for y in (ds['y'].values.min(), ds['y'].values.max()):
+                lon, lat = transformer.transform(x, y)
+                assert bbox[0] <= lon <= bbox[2]
+                assert bbox[1] <= lat <= bbox[3]
+
+
+def test_write_records(tmp_path):
+    records = [{'href': f's3://bucket/{i % 3}.nc', 'percent_valid_pixels': i} for i in range(5)]
+
+    text = tmp_path / 'hrefs.txt'
+    assert write_records(iter(records), output=str(text), dedup=True) == 3
+    assert text.read_text().splitlines() == ['s3://bucket/0.nc', 's3://bucket/1.nc', 's3://bucket/2.nc']
+
+    parquet = tmp_path / 'hrefs.parquet'
+    assert write_records(iter(records), output=str(parquet), output_format='parquet', batch_size=2) == 5
+    table = pq.read_table(parquet)
+    assert table.column_names == ['href', 'percent_valid_pixels']
+    assert table.column('percent_valid_pixels').to_pylist() == [0, 1, 2, 3, 4]
+
+
+def test_href_deduplicator():
+    deduplicator = HrefDeduplicator()
+    assert deduplicator.add('s3://bucket/a.nc')
+    assert deduplicator.add('s3://bucket/b.nc')
+    assert not deduplicator.add('s3://bucket/a.nc')
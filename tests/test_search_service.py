@@ -0,0 +1,78 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from hyp3_itslive_metadata.cryoforge.search_service import SearchService, make_server, parse_search_request
+
+
+def test_parse_search_request():
+    cql = {'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, 50]}
+    search_kwargs = parse_search_request({'bbox': '-50,60,-40,70', 'datetime': '2020-01-01/2021-01-01', 'filter': cql})
+    assert search_kwargs['intersects']['coordinates'][0][0] == [-50.0, 60.0]
+    assert search_kwargs['datetime'] == '2020-01-01/2021-01-01'
+    assert search_kwargs['filter'] == [cql]
+
+    assert parse_search_request({'bbox': [0, 0, 1, 1], 'filter': {'op': 'and', 'args': [cql, cql]}})['filter'] == [
+        cql,
+        cql,
+    ]
+
+    with pytest.raises(ValueError):
+        parse_search_request({'datetime': '2020-01-01/2021-01-01'})
+
+
+def test_search_service_roundtrip(tmp_path):
+    (tmp_path / '123456').mkdir()
+    service = SearchService(catalog=str(tmp_path), engine='rustac', cache=False)
+    assert service.partitions == {f'{tmp_path}/123456'}
+
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        with urllib.request.urlopen(f'{base_url}/health') as response:
+            assert json.loads(response.read())['partitions'] == 1
+
+        request = urllib.request.Request(
+            f'{base_url}/search', data=json.dumps({'bbox': [-50, 60, -40, 70]}).encode(), method='POST'
+        )
+        with urllib.request.urlopen(request) as response:
+            body = json.loads(response.read())
+        assert body['hrefs'] == []
+        assert body['numberReturned'] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_search_service_reuses_worker_threads(tmp_path, monkeypatch):
+    service = SearchService(catalog=str(tmp_path), engine='rustac', cache=False)
+    threads = []
+
+    def search(body):
+        threads.append(threading.get_ident())
+        return []
+
+    monkeypatch.setattr(service, 'search', search)
+
+    server = make_server(service, port=0, workers=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for _ in range(10):
+            request = urllib.request.Request(
+                f'http://127.0.0.1:{server.server_address[1]}/search',
+                data=json.dumps({'bbox': [-50, 60, -40, 70]}).encode(),
+                method='POST',
+            )
+            with urllib.request.urlopen(request) as response:
+                assert json.loads(response.read())['numberReturned'] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+    # requests are handled by the same threads, which keep their DuckDB cursors
+    assert len(threads) == 10
+    assert len(set(threads)) <= 2
@@ -0,0 +1,100 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from granules import GRANULE_NAMES
+from hyp3_itslive_metadata.cryoforge.generatebatched import get_shard_files
+from hyp3_itslive_metadata.cryoforge.shards import (
+    granule_costs,
+    list_granules,
+    plan_shards,
+    read_shard,
+    shard_groups,
+    write_manifest,
+)
+
+
+def make_listing(num_regions=6, seed=0):
+    rng = np.random.default_rng(seed)
+    rows: dict[str, list] = {'prefix': [], 'path': [], 'region': [], 'size': []}
+    for region in range(num_regions):
+        # a few huge regions and many small ones, like the archive
+        for i in range(int(rng.pareto(1.0) * 20) + 1):
+            rows['prefix'].append(f'velocity_image_pair/landsatOLI/v02/R{region:02d}')
+            rows['path'].append(f'granule_{i:05d}.nc')
+            rows['region'].append(f'R{region:02d}')
+            rows['size'].append(int(rng.integers(1, 100) * 2**20))
+    return pa.table(rows)
+
+
+def test_list_granules(tmp_path):
+    for region, size in (('N60W040', 10), ('N70W050', 20)):
+        (tmp_path / region / 'sub').mkdir(parents=True)
+        (tmp_path / region / 'sub' / 'a.nc').write_bytes(b'x' * size)
+        (tmp_path / region / 'a.txt').write_bytes(b'x')
+
+    listing = list_granules(str(tmp_path))
+
+    assert listing['region'].to_pylist() == ['N60W040', 'N70W050']
+    assert listing['path'].to_pylist() == ['a.nc', 'a.nc']
+    assert listing['size'].to_pylist() == [10, 20]
+    assert listing['prefix'].to_pylist()[0].endswith('N60W040/sub')
+
+
+@pytest.mark.parametrize('num_shards', [1, 4, 7])
+def test_plan_shards_is_balanced(num_shards):
+    listing = make_listing()
+    planned = plan_shards(listing, num_shards)
+
+    assert planned.num_rows == listing.num_rows
+    costs = np.bincount(planned['shard'].to_numpy(), weights=planned['cost'].to_numpy(), minlength=num_shards)
+    assert costs.max() - costs.min() <= 2 * granule_costs(listing).max()
+    # shards are contiguous runs of the sorted listing
+    keys = list(zip(planned['prefix'].to_pylist(), planned['path'].to_pylist()))
+    assert keys == sorted(keys)
+
+
+def test_plan_shards_keeps_groups_together():
+    listing = make_listing(num_regions=20)
+    planned = plan_shards(listing, 4, group_by='region')
+
+    shards_per_region: dict[str, set] = {}
+    for region, shard in zip(planned['region'].to_pylist(), planned['shard'].to_pylist()):
+        shards_per_region.setdefault(region, set()).add(shard)
+    assert all(len(shards) == 1 for shards in shards_per_region.values())
+
+    costs = np.bincount(planned['shard'].to_numpy(), weights=planned['cost'].to_numpy(), minlength=4)
+    region_costs = np.bincount(
+        np.unique(listing['region'].to_numpy(zero_copy_only=False), return_inverse=True)[1],
+        weights=granule_costs(listing),
+    )
+    # largest-first packing: no shard exceeds the mean by more than the largest region
+    assert costs.max() <= costs.mean() + region_costs.max()
+
+
+def test_manifest(tmp_path):
+    listing = pa.table(
+        {
+            'prefix': ['velocity_image_pair/landsatOLI/v02/N60W040'] * 2
+            + ['velocity_image_pair/sentinel1/v02/N60W040'],
+            'path': [
+                GRANULE_NAMES['landsat'],
+                GRANULE_NAMES['landsat'].replace('P038', 'P039'),
+                GRANULE_NAMES['sentinel1'],
+            ],
+            'region': ['landsatOLI', 'landsatOLI', 'sentinel1'],
+        }
+    )
+    manifest = str(tmp_path / 'manifest.parquet')
+    write_manifest(plan_shards(listing, 2, group_by='region'), manifest)
+
+    assert pq.ParquetFile(manifest).num_row_groups == 2
+    shards = {shard: read_shard(manifest, shard)['path'].to_pylist() for shard in range(2)}
+    assert sorted(path for paths in shards.values() for path in paths) == sorted(listing['path'].to_pylist())
+
+    [landsat_shard] = [shard for shard in range(2) if shard_groups(manifest, shard) == ['landsatOLI']]
+    assert get_shard_files(manifest, landsat_shard) == [
+        ('velocity_image_pair/landsatOLI/v02/N60W040', GRANULE_NAMES['landsat'], '2015'),
+        ('velocity_image_pair/landsatOLI/v02/N60W040', GRANULE_NAMES['landsat'].replace('P038', 'P039'), '2015'),
+    ]
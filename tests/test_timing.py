@@ -0,0 +1,51 @@
+import json
+
+from hyp3_itslive_metadata.cryoforge.generate import generate_itslive_metadata, save_metadata
+from hyp3_itslive_metadata.cryoforge.timing import DURATION_EDGES, StageTimer, aggregate_timings, write_timings
+
+
+def test_stage_timer_records_generation_stages(granule, tmp_path):
+    timer = StageTimer(str(granule))
+    metadata = generate_itslive_metadata(str(granule), with_kerchunk=True, timer=timer)
+    save_metadata(metadata, str(tmp_path))
+    metadata['ds'].close()
+
+    record = timer.record()
+    assert list(record['stages']) == ['fetch', 'kerchunk', 'open', 'geometry', 'stac', 'nsidc', 'save']
+    assert all(duration >= 0 for duration in record['stages'].values())
+    assert record['total_s'] == sum(record['stages'].values())
+    assert record['bytes_read'] == granule.stat().st_size
+    assert record['peak_rss_bytes'] > 0
+
+
+def test_generate_without_timer(granule):
+    metadata = generate_itslive_metadata(str(granule))
+    metadata['ds'].close()
+    assert metadata['timer'] is None
+
+
+def test_aggregate_timings(tmp_path):
+    records = [
+        {
+            'url': f'granule_{i}.nc',
+            'stages': {'fetch': 0.1 * i, 'open': 0.01},
+            'total_s': 0.1 * i + 0.01,
+            'bytes_read': 2**20,
+            'peak_rss_bytes': 2**28,
+        }
+        for i in range(1, 11)
+    ]
+    summary = aggregate_timings([*records, None])
+
+    assert summary['granules'] == 10
+    assert list(summary['stages']) == ['fetch', 'open']
+    fetch = summary['stages']['fetch']
+    assert fetch['count'] == 10
+    assert fetch['max'] == 1.0
+    assert sum(fetch['histogram']['counts']) == 10
+    assert len(fetch['histogram']['edges']) == len(DURATION_EDGES) - 1
+    assert summary['bytes_read']['sum'] == 10 * 2**20
+
+    path = write_timings(records, tmp_path / 'timings.json')
+    assert json.loads(path.read_text())['granules'] == 10
+    assert aggregate_timings([]) == {'granules': 0, 'stages': {}}
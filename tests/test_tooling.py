@@ -0,0 +1,92 @@
+import os
+import threading
+
+from dask.distributed import Client, LocalCluster, as_completed
+
+from catalogs import write_latlon_catalog
+from hyp3_itslive_metadata.cryoforge.tooling import (
+    DuckDBPool,
+    RecyclePlugin,
+    cql2_properties,
+    get_rustac_client,
+    iter_serverless_search,
+    serverless_search,
+    trim_workers,
+)
+
+
+def test_duckdb_pool_per_thread_cursors():
+    pool = DuckDBPool(threads=2, memory_limit='512MB', extensions=())
+
+    main_cursor = pool.cursor()
+    assert pool.cursor() is main_cursor
+
+    settings = dict(
+        main_cursor.execute(
+            'SELECT name, value FROM duckdb_settings() '
+            "WHERE name IN ('threads', 'enable_object_cache', 'enable_http_metadata_cache')"
+        ).fetchall()
+    )
+    assert settings == {'threads': '2', 'enable_object_cache': 'true', 'enable_http_metadata_cache': 'true'}
+
+    cursors = []
+    thread = threading.Thread(target=lambda: cursors.append(pool.cursor()))
+    thread.start()
+    thread.join()
+    assert cursors[0] is not main_cursor
+
+    # cursors share the same database
+    main_cursor.execute('CREATE TABLE granules AS SELECT 1 AS id')
+    assert cursors[0].execute('SELECT count(*) FROM granules').fetchone() == (1,)
+
+    pool.close()
+    assert pool.cursor() is not main_cursor
+
+
+def test_cql2_properties():
+    expr = {
+        'op': 'and',
+        'args': [
+            {'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, 50]},
+            {'op': '=', 'args': [{'property': 'proj:code'}, 'EPSG:3413']},
+        ],
+    }
+    assert cql2_properties(expr) == ['percent_valid_pixels', 'proj:code']
+    assert cql2_properties(None) == []
+
+
+def test_rustac_engine_matches_duckdb(tmp_path):
+    catalog = str(write_latlon_catalog(tmp_path, items_per_partition=50))
+    search_kwargs = {
+        'intersects': {'type': 'Polygon', 'coordinates': [[[-44, 58], [-36, 58], [-36, 64], [-44, 64], [-44, 58]]]},
+        'datetime': '2019-01-01T00:00:00Z/2021-01-01T00:00:00Z',
+        'filter': [{'op': '>=', 'args': [{'property': 'percent_valid_pixels'}, 50]}],
+    }
+
+    rustac_hrefs = serverless_search(catalog, dict(search_kwargs), engine='rustac', cache=False)
+    duckdb_hrefs = serverless_search(catalog, dict(search_kwargs), engine='duckdb', cache=False)
+    assert rustac_hrefs
+    assert rustac_hrefs == duckdb_hrefs
+    assert get_rustac_client() is get_rustac_client()
+    for engine in ('rustac', 'duckdb'):
+        assert serverless_search(catalog, dict(search_kwargs), engine=engine, cache=False, asset_type='.h5') == []
+
+    records = list(
+        iter_serverless_search(catalog, dict(search_kwargs), engine='rustac', cache=False, properties=('datetime',))
+    )
+    assert sorted(record['href'] for record in records) == rustac_hrefs
+    assert all(set(record) == {'href', 'datetime'} for record in records)
+
+
+def test_recycle_plugin_restarts_workers():
+    with Client(LocalCluster(n_workers=2, threads_per_worker=1, processes=True, dashboard_address=':0')) as client:
+        client.register_plugin(RecyclePlugin(max_tasks=10))
+        # results are released as they are fetched, as in generatebatched.iter_windowed
+        futures = as_completed([client.submit(os.getpid, pure=False) for _ in range(30)])
+        pids = [future.result() for future in futures]
+
+        # every task completed, on more processes than the two workers started with
+        assert len(pids) == 30
+        assert len(set(pids)) > 2
+        client.wait_for_workers(2)
+        assert len(trim_workers(client)) == 2
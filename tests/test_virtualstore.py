@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import xarray as xr
+
+from granules import write_granule
+from hyp3_itslive_metadata.cryoforge.generate import generate_itslive_metadata, save_metadata
+from hyp3_itslive_metadata.cryoforge.virtualstore import (
+    build_virtual_stores,
+    group_reference_files,
+    open_virtual_granule,
+    virtual_store_granules,
+)
+
+
+def write_references(directory, missions=('landsat', 'sentinel1', 'sentinel2')):
+    granules = {}
+    for mission in missions:
+        granule = write_granule(directory, mission=mission)
+        metadata = generate_itslive_metadata(str(granule), with_kerchunk=True, reader='h5py')
+        save_metadata(metadata, str(directory))
+        granules[metadata['stac'].id] = granule
+    return granules
+
+
+def test_group_reference_files():
+    paths = [
+        'refs/N60W040/LC08_L1TP_011002_20150720_20170406_01_T1_X_LC08_L1TP_011002_20150821_20170405_01_T1_G0120V02_P038.ref.json',
+        'refs/N60W040/LC08_L1TP_011002_20141220_20170406_01_T1_X_LC08_L1TP_011002_20150121_20170405_01_T1_G0120V02_P038.ref.json',
+        'refs/N70W050/LC08_L1TP_011002_20150720_20170406_01_T1_X_LC08_L1TP_011002_20150821_20170405_01_T1_G0120V02_P038.ref.json',
+    ]
+    groups = group_reference_files(paths)
+
+    assert list(groups) == [('refs/N60W040', '2015'), ('refs/N70W050', '2015')]
+    assert groups[('refs/N60W040', '2015')] == sorted(paths[:2])
+
+
+def test_build_virtual_stores(tmp_path):
+    references = tmp_path / 'references' / 'N60W040'
+    references.mkdir(parents=True)
+    granules = write_references(references)
+
+    stores = build_virtual_stores(str(tmp_path / 'references'), str(tmp_path / 'stores'), flush_every=2)
+
+    store = tmp_path / 'stores' / 'N60W040' / '2017.parq'
+    assert stores == {f'file://{store.with_name("2015.parq")}': 1, f'file://{store}': 2}
+    sentinel = sorted(granule_id for granule_id in granules if granule_id.startswith('S'))
+    assert virtual_store_granules(str(store)) == sentinel
+    metadata = json.loads((store / '.zmetadata').read_text())
+    assert {key.split('/', 1)[0] for key in metadata['metadata'] if '/' in key} == set(sentinel)
+
+    for granule_id in sentinel:
+        granule = granules[granule_id]
+        with (
+            open_virtual_granule(str(store), granule_id, remote_protocol='file') as virtual,
+            xr.open_dataset(granule, engine='h5netcdf') as ds,
+        ):
+            np.testing.assert_array_equal(virtual['v'].values, ds['v'].values)
+            np.testing.assert_array_equal(virtual['x'].values, ds['x'].values)
+            assert virtual['img_pair_info'].attrs['id_img1'] == ds['img_pair_info'].attrs['id_img1']
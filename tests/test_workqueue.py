@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pyarrow as pa
+import pytest
+from obstore.store import MemoryStore
+
+from hyp3_itslive_metadata.cryoforge.shards import plan_shards, write_manifest
+from hyp3_itslive_metadata.cryoforge.workqueue import (
+    LeaseLost,
+    ObjectStoreWorkQueue,
+    SQLiteWorkQueue,
+    WorkQueue,
+    check_lease,
+    manifest_units,
+    open_queue,
+    run_worker,
+)
+
+
+@pytest.fixture(params=['sqlite', 'object_store'])
+def queue(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteWorkQueue(str(tmp_path / 'queue.db'), max_attempts=2)
+    return ObjectStoreWorkQueue(MemoryStore(), max_attempts=2)
+
+
+def test_claim_complete_release(queue):
+    assert queue.add(['a', 'b']) == 2
+    assert queue.add(['a', 'c']) == 1
+
+    first, second, third = queue.claim('one'), queue.claim('two'), queue.claim('three')
+    assert {first, second, third} == {'a', 'b', 'c'}
+    assert queue.claim('four') is None
+    assert queue.counts() == {'pending': 0, 'leased': 3, 'done': 0, 'failed': 0}
+
+    assert queue.heartbeat(first, 'one')
+    assert not queue.heartbeat(first, 'two')
+    assert not queue.complete(first, 'two')
+
+    # a released unit is claimed again until it has been claimed max_attempts times
+    assert queue.release(second, 'two', error='boom')
+    assert queue.claim('five') == second
+    assert queue.release(second, 'five', error='boom')
+    assert queue.claim('six') is None
+
+    assert queue.complete(first, 'one')
+    assert queue.complete(third, 'three')
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 2, 'failed': 1}
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.add(['a'])
+    assert queue.claim('preempted', lease_seconds=0.05) == 'a'
+    assert queue.claim('other') is None
+
+    time.sleep(0.1)
+    assert queue.claim('other') == 'a'
+    assert not queue.heartbeat('a', 'preempted')
+    assert not queue.complete('a', 'preempted')
+    assert queue.complete('a', 'other')
+    assert queue.counts()['done'] == 1
+
+
+def test_run_worker_drains_queue(queue):
+    units = [str(unit) for unit in range(20)]
+    queue.add(units)
+    processed = []
+    lock = threading.Lock()
+
+    def process(unit):
+        if unit == '7':
+            raise RuntimeError('bad shard')
+        time.sleep(0.01)
+        with lock:
+            processed.append(unit)
+
+    workers = [
+        threading.Thread(target=run_worker, args=(queue, process), kwargs={'worker': f'w{i}', 'poll_seconds': 0.01})
+        for i in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sorted(processed) == sorted(unit for unit in units if unit != '7')
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 19, 'failed': 1}
+
+
+@pytest.mark.parametrize('checks_lease', [True, False])
+def test_run_worker_stops_on_lost_lease(queue, checks_lease):
+    queue.add(['a'])
+    written = []
+
+    def process(unit):
+        # the lease expires before the first heartbeat, and another task claims the unit
+        time.sleep(0.1)
+        assert queue.claim('other', lease_seconds=60) == unit
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                check_lease()
+            except LeaseLost:
+                if checks_lease:
+                    assert queue.complete(unit, 'other')
+                    raise
+                break
+            time.sleep(0.01)
+        written.append(unit)
+        assert queue.complete(unit, 'other')
+
+    processed = run_worker(queue, process, worker='preempted', lease_seconds=0.05, heartbeat_seconds=0.2)
+
+    assert processed == {'done': 0, 'failed': 0, 'lost': 1}
+    assert written == ([] if checks_lease else ['a'])
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0}
+    check_lease()  # outside run_worker it does nothing
+
+
+def test_work_queue_is_abstract():
+    with pytest.raises(TypeError):
+        WorkQueue()  # type: ignore[abstract]
+
+
+def test_open_queue(tmp_path):
+    assert isinstance(open_queue(str(tmp_path / 'queue.db')), SQLiteWorkQueue)
+    assert isinstance(open_queue(f'sqlite://{tmp_path}/other.db'), SQLiteWorkQueue)
+    assert isinstance(open_queue('memory://'), ObjectStoreWorkQueue)
+
+
+def test_manifest_units(tmp_path):
+    listing = pa.table({'prefix': ['p'] * 6, 'path': [f'{i}.nc' for i in range(6)]})
+    manifest = write_manifest(plan_shards(listing, 3), str(tmp_path / 'manifest.parquet'))
+    assert manifest_units(manifest) == ['0', '1', '2']